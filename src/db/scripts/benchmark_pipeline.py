@@ -0,0 +1,59 @@
+"""
+Benchmark the wall time of `transform_data` against the number of interactions on synthetic data: the former row-wise
+embedding (one `encode` call per cell) vs. deduplicated batches, with a cold & a warm embedding cache.
+Usage: `python benchmark_pipeline.py [--interactions 1000 10000 100000] [--legacy-max 10000]`
+"""
+from argparse import ArgumentParser
+from time import perf_counter
+import pandas as pd, numpy as np
+from src.lib.data.constants import EMBEDDER_NAME, PIPELINE_EMBED_BATCH_SIZE, PIPELINE_EMBEDDING_CACHE_SIZE
+from src.lib.utils.cache import CachedEmbeddings
+import src.db.scripts.recommendation_data_pipeline as pipeline
+
+
+def make_tables(n_interactions: int):
+    rng = np.random.default_rng(0)
+    n_users, n_products = max(n_interactions // 20, 2), max(n_interactions // 50, 2)
+    users_df = pd.DataFrame({'username': [f'user{i}' for i in range(n_users)], 'bio': [f'I like hobby number {i % 97}' for i in range(n_users)]})
+    products_df = pd.DataFrame({
+        'product_id': np.arange(1, n_products + 1), 'name': [f'Product {i}' for i in range(n_products)],
+        'description': [f'A great item of type {i % 311}' for i in range(n_products)], 'price': rng.uniform(1, 500, n_products),
+        'category': rng.choice(['Books', 'Toys', 'Tech'], n_products), 'owner': rng.choice(users_df['username'], n_products)
+    })
+    interactions_df = pd.DataFrame({
+        'username': rng.choice(users_df['username'], n_interactions), 'product_id': rng.integers(1, n_products + 1, n_interactions),
+        'rating': rng.integers(0, 2, n_interactions), 'sentiments': [[int(s)] for s in rng.integers(-1, 2, n_interactions)],
+        'in_cart': rng.integers(0, 2, n_interactions).astype(bool)
+    }).drop_duplicates(['username', 'product_id'], ignore_index=True)
+    return interactions_df, users_df, products_df
+
+
+def legacy_embed(interactions_df: pd.DataFrame, users_df: pd.DataFrame, products_df: pd.DataFrame, model) -> None:
+    """The former text embedding step: one `encode` call per row & text column"""
+    result_df = interactions_df.merge(users_df, on='username', how='left').merge(products_df, on='product_id', how='left')
+    for col in ['bio', 'name', 'description']:
+        result_df[col] = result_df[col].fillna('').apply(lambda x: np.array(model.encode(x)))
+    result_df[['bio', 'name', 'description']].apply(lambda x: np.concatenate(x.values), axis=1)
+
+
+def seconds(run) -> float:
+    start = perf_counter()
+    run()
+    return perf_counter() - start
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('--interactions', type=int, nargs='+', default=[1_000, 10_000, 100_000])
+    parser.add_argument('--legacy-max', type=int, default=10_000, help='Skip the (slow) former path above this size')
+    args = parser.parse_args()
+
+    model = pipeline._SentenceEmbeddings(EMBEDDER_NAME, PIPELINE_EMBED_BATCH_SIZE)
+    model.embed_documents(['warm up'])  # Load the model once, outside the timings
+    for n_interactions in args.interactions:
+        tables = make_tables(n_interactions)
+        pipeline.text_embedder = CachedEmbeddings(model, PIPELINE_EMBEDDING_CACHE_SIZE)  # Cold, in-memory cache
+        cold = seconds(lambda: pipeline.transform_data(*tables))
+        warm = seconds(lambda: pipeline.transform_data(*tables))
+        legacy = f'{seconds(lambda: legacy_embed(*tables, model._client)):8.2f} s' if len(tables[0]) <= args.legacy_max else '  (skipped)'
+        print(f'{len(tables[0]):>7} interactions: former embedding {legacy} | transform_data {cold:6.2f} s cold, {warm:6.2f} s warm')
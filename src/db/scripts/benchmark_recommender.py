@@ -0,0 +1,67 @@
+"""Benchmark the per-request latency of recommendations on synthetic data: parsing the CSV on every request vs. the memory-mapped service (user profiles vs. item vectors)"""
+from sklearn.preprocessing import LabelEncoder
+from sklearn.metrics.pairwise import cosine_similarity
+from tempfile import TemporaryDirectory
+from time import perf_counter
+from typing import Callable, List
+import os, sys, pandas as pd, numpy as np
+from src.lib.utils.artifacts import save_feature_store
+from src.server.models.recommender import RecommenderService
+from src.server.models.similarity import normalize_rows
+from src.server.models.profiles import aggregate_rows
+
+N_FEATURES = 1160  # 8 interaction/product columns + 3 embeddings of 384 dims
+
+
+def make_data(n_rows: int, n_users: int, n_products: int) -> pd.DataFrame:
+    rng = np.random.default_rng(0)
+    df = pd.DataFrame(rng.normal(size=(n_rows, N_FEATURES - 8)).astype(np.float32))
+    columns = {
+        'username': rng.integers(0, n_users, n_rows), 'product_id': rng.integers(1, n_products + 1, n_rows),
+        'rating': rng.integers(0, 6, n_rows), 'sentiments': rng.normal(size=n_rows), 'in_cart': rng.integers(0, 2, n_rows),
+        'price': rng.normal(size=n_rows), 'category': rng.integers(0, 10, n_rows), 'owner': rng.integers(0, n_users, n_rows)
+    }
+    return pd.concat([pd.DataFrame(columns), df], axis=1)
+
+
+def legacy_recommend(path: str, username: str, encoders: Callable, top_k: int = 5) -> List[int]:
+    """The former request path: parse the CSV & refit the encoders on every request"""
+    df = pd.read_csv(path).fillna(0)
+    encoded_username = encoders()['username'].transform([username])[0]
+    target_index = df[df['username'] == encoded_username].index[0]
+    similarities = cosine_similarity(df.iloc[target_index].values.reshape(1, -1), df.values)[0]
+    recommendations = []
+    for index in np.argsort(similarities)[::-1][1:]:
+        if (product_id := df.loc[index, 'product_id']) not in recommendations: recommendations.append(product_id)
+        if len(recommendations) >= top_k: break
+    return recommendations
+
+
+def time_per_request(recommend: Callable[[str], List[int]], usernames: List[str]) -> float:
+    start = perf_counter()
+    for username in usernames: recommend(username)
+    return (perf_counter() - start) / len(usernames) * 1000
+
+
+if __name__ == '__main__':
+    n_rows = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    n_users, n_requests = max(n_rows // 10, 1), 20
+    usernames = [f'user{i}' for i in range(n_users)]
+    encoders = lambda: {'username': LabelEncoder().fit(usernames)}
+    df = make_data(n_rows, n_users, n_products=100)
+    queried = [usernames[i] for i in np.random.default_rng(1).choice(df['username'].unique(), n_requests)]
+
+    with TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, 'transformed_interactions.csv')
+        df.to_csv(path, index=False)
+        unit_vectors = normalize_rows(df.to_numpy())
+        save_feature_store(
+            os.path.join(tmp_dir, 'artifacts'), df.columns, *aggregate_rows(unit_vectors, [usernames[code] for code in df['username']]),
+            *aggregate_rows(unit_vectors, df['product_id']), preprocessing={'encoders': encoders()}
+        )
+        service = RecommenderService(os.path.join(tmp_dir, 'artifacts'))
+        service.recommend(queried[0])  # Initial load
+
+        before = time_per_request(lambda username: legacy_recommend(path, username, encoders), queried)
+        after = time_per_request(service.recommend, queried)
+    print(f'{n_rows} rows x {N_FEATURES} columns: {before:.2f} ms/request before, {after:.2f} ms/request after ({before / after:.0f}x faster)')
@@ -0,0 +1,55 @@
+"""
+Benchmark the top-k similarity search on synthetic data: the former kernel (cosine similarity, full argsort & a Python
+dedupe loop) vs. `SimilarityEngine` for single queries & blocked batches.
+Usage: `python benchmark_similarity.py [--rows 10000 100000 1000000] [--dim 1160]` (1M x 1160 floats take ~4.6 GB).
+"""
+from sklearn.metrics.pairwise import cosine_similarity
+from argparse import ArgumentParser
+from time import perf_counter
+from typing import List
+import pandas as pd, numpy as np
+from src.lib.data.constants import TOP_K_RECOMMENDED
+from src.server.models.similarity import SimilarityEngine, normalize_rows
+
+
+def legacy_top_products(df: pd.DataFrame, row: int, top_k: int) -> List[int]:
+    similarities = cosine_similarity(df.iloc[row].values.reshape(1, -1), df.values)[0]
+    recommendations = []
+    for index in np.argsort(similarities)[::-1][1:]:
+        if (product_id := df.loc[index, 'product_id']) not in recommendations: recommendations.append(product_id)
+        if len(recommendations) >= top_k: break
+    return recommendations
+
+
+def ms_per_query(search, n_queries: int) -> float:
+    start = perf_counter()
+    search()
+    return (perf_counter() - start) / n_queries * 1000
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('--rows', type=int, nargs='+', default=[10_000, 100_000, 1_000_000])
+    parser.add_argument('--dim', type=int, default=1160)
+    parser.add_argument('--queries', type=int, default=20)
+    parser.add_argument('--batch', type=int, default=1000)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    for n_rows in args.rows:
+        vectors = rng.normal(size=(n_rows, args.dim)).astype(np.float32)
+        product_ids = rng.integers(1, max(n_rows // 20, 2), n_rows)
+        rows = rng.integers(0, n_rows, max(args.queries, args.batch))
+
+        df = pd.DataFrame(vectors)
+        df['product_id'] = product_ids
+        legacy = ms_per_query(lambda: [legacy_top_products(df, row, TOP_K_RECOMMENDED) for row in rows[:args.queries]], args.queries)
+        del df
+
+        engine = SimilarityEngine(normalize_rows(vectors), product_ids)
+        single = ms_per_query(lambda: [engine.top_products_for_rows(rows[i:i+1], TOP_K_RECOMMENDED) for i in range(args.queries)], args.queries)
+        batched = ms_per_query(lambda: engine.top_products_for_rows(rows[:args.batch], TOP_K_RECOMMENDED), args.batch)
+        print(
+            f'{n_rows:>9} rows x {args.dim}: former {legacy:8.2f} ms/query | engine {single:7.2f} ms/query ({legacy / single:.0f}x), '
+            f'{batched:6.3f} ms/query in batches of {args.batch} ({legacy / batched:.0f}x)'
+        )
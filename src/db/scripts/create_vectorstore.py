@@ -1,13 +1,67 @@
-"""Quickly create a vectorstore"""
+"""
+Incrementally create/update the vectorstore along with the chunk store of the BM25 index.
+Chunks are identified by the hash of their source & content, so only new or changed chunks are embedded & chunks that
+disappeared from the sources are deleted. Usage: `python create_vectorstore.py [path or glob ...]` (defaults to `DOCS_SOURCES`).
+"""
 from langchain_chroma import Chroma
-from langchain.schema import Document
 from langchain.text_splitter import RecursiveCharacterTextSplitter
-from src.lib.data.constants import CHUNK_SIZE, CHUNK_OVERLAP, EMBEDDER, VECSTORE_PERSIST_DIR
+from concurrent.futures import ThreadPoolExecutor
+from glob import glob
+from typing import Dict, List
+import os, sys
+from src.lib.data.constants import (
+    CURRENT_DIR, CHUNK_SIZE, CHUNK_OVERLAP, EMBEDDER, VECSTORE_PERSIST_DIR, CHUNK_STORE_PATH, DOCS_SOURCES, EMBED_MAX_BATCH, LLM_CONCURRENCY
+)
+from src.lib.utils.logger import log
+from src.server.models.retriever import Chunk, make_chunk, save_chunks
 
-if __name__ == '__main__':
-    with open('../data/company_docs.txt') as file:
-        splitter = RecursiveCharacterTextSplitter(chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP)
-        splitted = splitter.split_text(text=file.read())
+ROOT_DIR = os.path.abspath(os.path.join(CURRENT_DIR, '../../..'))
+
+
+def split_sources(patterns: List[str]) -> Dict[str, Chunk]:
+    """Splits every source file into chunks, keyed by their IDs (in source order)"""
+    splitter = RecursiveCharacterTextSplitter(chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP)
+    paths = sorted({os.path.abspath(path) for pattern in patterns for path in glob(pattern)})
+    if not paths: raise FileNotFoundError(f'No source files match {patterns}')
+
+    chunks = {}
+    for path in paths:
+        with open(path) as file:
+            source = os.path.relpath(path, ROOT_DIR)
+            for text in splitter.split_text(text=file.read()):
+                chunk = make_chunk(text, source)
+                chunks[chunk['id']] = chunk
+    return chunks
+
+
+def embed_chunks(vectorstore: Chroma, chunks: List[Chunk]) -> None:
+    """Embeds the chunks in parallel batches & upserts them into the vectorstore"""
+    batches = [chunks[i:i+EMBED_MAX_BATCH] for i in range(0, len(chunks), EMBED_MAX_BATCH)]
+    with ThreadPoolExecutor(max_workers=LLM_CONCURRENCY) as pool:
+        embedded = pool.map(lambda batch: EMBEDDER.embed_documents([c['text'] for c in batch]), batches)
+        for batch, vectors in zip(batches, embedded):  # Writes stay on this thread
+            vectorstore._collection.upsert(
+                ids=[c['id'] for c in batch],
+                embeddings=vectors,
+                documents=[c['text'] for c in batch],
+                metadatas=[{'source': c['source']} for c in batch]
+            )
 
-    docs = [Document(page_content=text, metadata={'source': 'src/db/data/company_docs.txt'}) for text in splitted]
-    Chroma.from_documents(docs, embedding=EMBEDDER, persist_directory=VECSTORE_PERSIST_DIR)
\ No newline at end of file
+
+def update_vectorstore(patterns: List[str], persist_dir: str = VECSTORE_PERSIST_DIR, chunk_store_path: str = CHUNK_STORE_PATH) -> int:
+    """Syncs the vectorstore & chunk store with the sources, returning the number of embedded chunks"""
+    chunks = split_sources(patterns)
+    vectorstore = Chroma(persist_directory=persist_dir, embedding_function=EMBEDDER)
+    stored_ids = set(vectorstore.get(include=[])['ids'])
+
+    if stale := list(stored_ids - chunks.keys()):
+        for i in range(0, len(stale), 1000): vectorstore.delete(ids=stale[i:i+1000])
+    new = [chunk for chunk_id, chunk in chunks.items() if chunk_id not in stored_ids]
+    embed_chunks(vectorstore, new)
+    save_chunks(list(chunks.values()), chunk_store_path)
+    log(f'[create_vectorstore.py] Embedded {len(new)} new chunks, deleted {len(stale)} stale ones & kept {len(chunks) - len(new)}', 'model')
+    return len(new)
+
+
+if __name__ == '__main__':
+    update_vectorstore(sys.argv[1:] or DOCS_SOURCES)
@@ -0,0 +1,67 @@
+"""
+Evaluate the size/quality trade-off of compressed vectors: recall@k of the recommendations computed on reduced &
+quantized user profiles & item vectors against the full-precision ones, from the current artifact version (if it was
+published uncompressed) or from synthetic data with a low intrinsic dimension.
+Usage: `python evaluate_compression.py [--dims 32 64 128 256] [--methods none pca random] [--quantizations float32 float16 int8] [--k 5] [--synthetic]`
+"""
+from argparse import ArgumentParser
+from time import perf_counter
+import tracemalloc, numpy as np
+from src.lib.data.constants import ARTIFACTS_DIR, TOP_K_RECOMMENDED
+from src.lib.utils.artifacts import load_feature_store
+from src.server.models.compression import fit_reducer, compress, recall_at_k
+from src.server.models.similarity import SimilarityEngine, normalize_rows
+
+
+def make_vectors(n_users: int, n_products: int, dim: int, intrinsic_dim: int = 48):
+    """Unit vectors with a low intrinsic dimension (like text embeddings), embedded in `dim` dimensions with a little noise"""
+    rng = np.random.default_rng(0)
+    basis = rng.normal(size=(intrinsic_dim, dim)).astype(np.float32)
+    make = lambda n: rng.normal(size=(n, intrinsic_dim)).astype(np.float32) @ basis + rng.normal(scale=.5, size=(n, dim)).astype(np.float32)
+    return normalize_rows(make(n_users)), np.arange(1, n_products + 1), normalize_rows(make(n_products))
+
+
+def load_vectors(max_users: int):
+    """The user profiles & item vectors of the current version, unless it is missing or already compressed"""
+    store = load_feature_store(ARTIFACTS_DIR)
+    if store is None or store.item_vectors.dtype != np.float32 or store.preprocessing.get('compression', {}).get('reducer') is not None: return None
+    rows = np.random.default_rng(0).permutation(len(store.usernames))[:max_users]
+    return np.asarray(store.user_vectors[np.sort(rows)]), store.product_ids, np.asarray(store.item_vectors)
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('--dims', type=int, nargs='+', default=[32, 64, 128, 256])
+    parser.add_argument('--methods', nargs='+', default=['none', 'pca', 'random'])
+    parser.add_argument('--quantizations', nargs='+', default=['float32', 'float16', 'int8'])
+    parser.add_argument('--k', type=int, default=TOP_K_RECOMMENDED)
+    parser.add_argument('--users', type=int, default=2000, help='Users evaluated')
+    parser.add_argument('--synthetic', action='store_true', help='Ignore the published artifacts')
+    parser.add_argument('--products', type=int, default=20_000, help='Synthetic products')
+    parser.add_argument('--dim', type=int, default=1160, help='Synthetic full-precision dimensions')
+    args = parser.parse_args()
+
+    vectors = None if args.synthetic else load_vectors(args.users)
+    print('Source:', 'synthetic data' if vectors is None else f'artifact version in {ARTIFACTS_DIR}')
+    user_vectors, product_ids, item_vectors = vectors or make_vectors(args.users, args.products, args.dim)
+    start = perf_counter()
+    expected = SimilarityEngine(item_vectors, product_ids).top_products(user_vectors, args.k)
+    full_ms, full_bytes = (perf_counter() - start) / len(user_vectors) * 1000, item_vectors.nbytes
+    print(f'  full precision: {item_vectors.shape[1]} dims float32, {full_bytes / 2**20:.1f} MB of item vectors, {full_ms:.3f} ms/query')
+
+    for method in args.methods:
+        for dim in ([item_vectors.shape[1]] if method == 'none' else args.dims):
+            reducer = None if method == 'none' else fit_reducer(np.vstack([item_vectors, user_vectors]), method, dim)
+            for quantization in args.quantizations:
+                users, items = compress(user_vectors, reducer, quantization), compress(item_vectors, reducer, quantization)
+                engine = SimilarityEngine(items, product_ids)
+                tracemalloc.start()
+                start = perf_counter()
+                actual = engine.top_products(users, args.k)
+                ms, peak_bytes = (perf_counter() - start) / len(users) * 1000, tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+                print(
+                    f'{method:>6} {items.shape[1]:>5} dims {quantization:>7}: recall@{args.k} {recall_at_k(expected, actual, args.k):.3f} | '
+                    f'{engine.unit_vectors.nbytes / 2**20:7.1f} MB held ({full_bytes / engine.unit_vectors.nbytes:4.0f}x smaller), '
+                    f'{peak_bytes / 2**20:.1f} MB peak while scoring | {ms:.3f} ms/query'
+                )
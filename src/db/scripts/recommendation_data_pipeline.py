@@ -1,92 +1,588 @@
-"""Script that runs on the background to process interaction data, which will be utilized by the recommendation system"""
+"""Script that runs on the background to incrementally process interaction data, which will be utilized by the recommendation system"""
 from sklearn.preprocessing import LabelEncoder, StandardScaler
 from sentence_transformers import SentenceTransformer
-from typing import Dict, Tuple
-from time import sleep
+from langchain_core.embeddings import Embeddings
+from sqlalchemy import text
+from concurrent.futures import ProcessPoolExecutor
+from collections import deque
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
 from datetime import datetime
-import pandas as pd, numpy as np
+from time import monotonic, time_ns
+import os, pickle, pandas as pd, numpy as np
 from src.lib.utils.logger import log
-from src.lib.data.constants import PIPELINE_INTERVAL, TRANSFORMED_DATA_PATH, EMBEDDER_NAME
-from src.server.models.recommender import _retrieve
+from src.lib.data.constants import (
+    PIPELINE_INTERVAL, PIPELINE_DEBOUNCE, PIPELINE_MAX_DELAY, PIPELINE_REFIT_TOLERANCE, PIPELINE_FULL_REFRESH, PIPELINE_STATE_PATH, PIPELINE_EMBED_BATCH_SIZE, PIPELINE_EMBEDDING_CACHE_SIZE, EMBEDDING_CACHE_PATH,
+    PIPELINE_STREAMING, PIPELINE_CHUNK_SIZE, PIPELINE_WORKERS, ARTIFACTS_DIR, ARTIFACT_VERSIONS_KEPT, ARTIFACT_VERSION, TRANSFORMED_DATA_PATH, EXPORT_TRANSFORMED_CSV, EMBEDDER_NAME, TOP_K_RECOMMENDED, FALLBACK_SIZE,
+    COMPRESSION_METHOD, COMPRESSION_DIM, QUANTIZATION, NEIGHBOR_WEIGHTS, SIMILARITY_BLOCK_SIZE
+)
+from src.lib.utils.artifacts import save_feature_store, create_staging, publish_feature_store, current_version
+from src.lib.data.db import engine
+from src.lib.utils.cache import CachedEmbeddings
+from src.lib.utils.events import Debouncer
+from src.lib.utils.db import change_bus
+from src.server.models.recommender import _retrieve, precompute_recommendations
+from src.server.models.similarity import SimilarityEngine, normalize_rows
+from src.server.models.profiles import aggregate_rows, signal_weights, rank_popular
+from src.server.models.compression import fit_reducer, compress
+from src.server.models.neighbors import NeighborIndex
 
-def extract_interaction_data() -> pd.DataFrame:
-    """Extracts interaction data from the interactions table"""
-    return _retrieve("""
-        SELECT username, product_id, rating, sentiments, in_cart
-        FROM interactions;
-    """)
+class _SentenceEmbeddings(Embeddings):
+    """LangChain adapter of a SentenceTransformer, loaded once per process on the first cache miss"""
+    def __init__(self, model_name: str, batch_size: int) -> None:
+        self.model, self.batch_size, self._client = model_name, batch_size, None
 
+    def embed_documents(self, texts: List[str]) -> List[np.ndarray]:
+        if self._client is None: self._client = SentenceTransformer(self.model)
+        return list(self._client.encode(texts, batch_size=self.batch_size, convert_to_numpy=True).astype(np.float32, copy=False))
 
-def transform_data(interactions_df: pd.DataFrame) -> Tuple[pd.DataFrame, StandardScaler, Dict[str, LabelEncoder]]:
-    """Transforms the data: embeddings, scaling, and encoding"""
-    # Step 1: Read user and product tables
-    users_df = _retrieve("SELECT username, bio FROM users")
-    products_df = _retrieve("SELECT product_id, name, description, price, category, owner FROM products")
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_documents([text])[0]
 
-    # Step 2: Merge data
-    result_df = interactions_df.merge(users_df, on="username", how="left")
-    result_df = result_df.merge(products_df, on="product_id", how="left")
 
-    # Step 3: Text Embedding
-    text_columns = ['bio', 'name', 'description']
-    embedder = SentenceTransformer(EMBEDDER_NAME)
+text_embedder = CachedEmbeddings(_SentenceEmbeddings(EMBEDDER_NAME, PIPELINE_EMBED_BATCH_SIZE), PIPELINE_EMBEDDING_CACHE_SIZE, EMBEDDING_CACHE_PATH or None)
+
+
+class ChangeTracker:
+    """
+    Mirrors the users, products & interactions tables, fetching only the rows written since the last run. The watermark
+    is the Postgres transaction ID (`xmin`) of row versions, so no change-log table is needed; deletions are found by
+    comparing primary keys. The mirror & watermark are persisted, so a restart resumes incrementally.
+    """
+    TABLES = {
+        'users': (['username'], 'username, bio'),
+        'products': (['product_id'], 'product_id, name, description, price, category, owner'),
+        'interactions': (['username', 'product_id'], 'username, product_id, rating, sentiments, in_cart')
+    }
+
+    def __init__(self, state_path: str = PIPELINE_STATE_PATH) -> None:
+        self.state_path = state_path
+        self.watermark: Optional[int] = None
+        self.tables: Dict[str, pd.DataFrame] = {}
+        self.changes: Dict[str, Tuple[pd.Index, pd.Index]] = {}  # Keys of the rows inserted/updated & deleted by the last sync
+        if os.path.exists(state_path):
+            with open(state_path, 'rb') as file: self.watermark, self.tables = pickle.load(file)
+
+
+    def sync(self) -> int:
+        """Applies the changes since the last run to the mirror, returning the number of inserted, updated & deleted rows"""
+        # Transactions running now may commit rows with lower IDs later, so the next run re-reads from the oldest one
+        snapshot_xmin = int(_retrieve("SELECT txid_snapshot_xmin(txid_current_snapshot()) % 4294967296 AS xid")['xid'][0])
+        full = self.watermark is None or snapshot_xmin - 1 < self.watermark  # First run or transaction ID wraparound
+        n_changed = 0
+        for table, (keys, columns) in self.TABLES.items():
+            changed = _retrieve(f'SELECT {columns} FROM {table}' + ('' if full else f' WHERE xmin::text::bigint > {self.watermark}')).set_index(keys)
+            live = changed.index if full else _retrieve(f'SELECT {", ".join(keys)} FROM {table}').set_index(keys).index
+            mirror = self.tables.get(table, changed.iloc[:0])
+
+            kept = mirror[mirror.index.isin(live)]
+            common = changed.index.intersection(kept.index)
+            unchanged = common[(kept.loc[common].astype(str) == changed.loc[common].astype(str)).all(axis=1).to_numpy()]  # Re-read rows
+            n_changed += len(mirror) - len(kept) + len(changed) - len(unchanged)
+            self.changes[table] = (changed.index.difference(unchanged), mirror.index.difference(kept.index))
+            self.tables[table] = pd.concat([kept.drop(common), changed])
+
+        self.watermark = snapshot_xmin - 1
+        tmp_path = f'{self.state_path}.tmp'
+        with open(tmp_path, 'wb') as file: pickle.dump((self.watermark, self.tables), file)
+        os.replace(tmp_path, self.state_path)
+        return n_changed
+
 
-    def _embed_text(column: pd.Series) -> pd.Series:
-        return column.fillna('').apply(lambda x: embedder.encode(x) if isinstance(x, str) else embedder.encode(''))
+    def get_table(self, table: str) -> pd.DataFrame:
+        return self.tables[table].reset_index()
 
-    for col in text_columns:
-        result_df[col] = _embed_text(result_df[col])
-        result_df[col] = result_df[col].apply(lambda x: np.array(x))
 
-    # Step 4: Process sentiments column (sum the list)
-    def _sum_sentiments(sentiments: any) -> float:
-        return float(sum(sentiments)) if isinstance(sentiments, list) else 0.0
+    def changed_interactions(self) -> Tuple[pd.Index, pd.Index]:
+        """Keys of the interactions changed by the last sync (themselves or through their user or product) & of the deleted ones"""
+        (upserted, deleted), interactions = self.changes['interactions'], self.tables['interactions'].index
+        users, products = self.changes['users'][0].union(self.changes['users'][1]), self.changes['products'][0].union(self.changes['products'][1])
+        through = interactions[interactions.get_level_values('username').isin(users) | interactions.get_level_values('product_id').isin(products)]
+        return upserted.union(through), deleted
 
+
+# Identifiers (username, product ID & owner) are left out of the features: their arbitrary codes would dominate the
+# cosine similarity of the profiles, which must only follow the signals & the content of the interacted products
+_SIGNAL_COLUMNS = ['rating', 'sentiments', 'in_cart', 'price']
+_LABEL_COLUMNS = ['category']  # One-hot encoded
+
+def _sum_sentiments(sentiments: any) -> float:
+    return float(sum(sentiments)) if isinstance(sentiments, list) else 0.0
+
+
+def _merge(interactions_df: pd.DataFrame, users_df: pd.DataFrame, products_df: pd.DataFrame) -> pd.DataFrame:
+    """Joins the user & product columns to the interactions & sums their sentiments"""
+    result_df = interactions_df.merge(users_df, on='username', how='left').merge(products_df, on='product_id', how='left')
     result_df['sentiments'] = result_df['sentiments'].apply(_sum_sentiments)
+    return result_df
+
+
+def fit_transformers(merged_df: pd.DataFrame) -> Tuple[Dict[str, StandardScaler], Dict[str, LabelEncoder]]:
+    """Fits the scalers of the continuous features & the label encoders of the discrete ones on merged interactions"""
+    scalers = {col: StandardScaler().fit(merged_df[[col]]) for col in ['price', 'sentiments']}
+    encoders = {col: LabelEncoder().fit(merged_df[col].fillna('Unknown')) for col in _LABEL_COLUMNS}
+    return scalers, encoders
+
+
+def _features(merged_df: pd.DataFrame, scalers: Dict[str, StandardScaler], encoders: Dict[str, LabelEncoder], embeddings: np.ndarray) -> pd.DataFrame:
+    """Feature rows of merged interactions: their signals with the scaled continuous features, the one-hot discrete ones & the text embeddings"""
+    result_df = merged_df[_SIGNAL_COLUMNS].reset_index(drop=True)
+    for col, scaler in scalers.items(): result_df[col] = scaler.transform(result_df[[col]])
+    one_hot = [
+        pd.DataFrame(np.eye(len(encoder.classes_), dtype=np.float32)[encoder.transform(merged_df[col].fillna('Unknown'))], columns=_one_hot_columns(col, encoder))
+        for col, encoder in encoders.items()
+    ]
+    return pd.concat([result_df.astype(np.float32).fillna(0), *one_hot, pd.DataFrame(embeddings)], axis=1)  # Unknown products get the mean price
+
+
+def _one_hot_columns(col: str, encoder: LabelEncoder) -> List[str]:
+    return [f'{col}={label}' for label in encoder.classes_]
+
+
+def transform_rows(merged_df: pd.DataFrame, scalers: Dict[str, StandardScaler], encoders: Dict[str, LabelEncoder]) -> pd.DataFrame:
+    """Transforms merged interactions with fitted scalers & encoders: embeddings, scaling, and encoding"""
+    # Text Embedding (each unique text once, in batches, & only if it is missing from the cache)
+    text_columns = ['bio', 'name', 'description']
+    codes, unique_texts = pd.factorize(merged_df[text_columns].fillna('').astype(str).to_numpy().ravel())
+    vectors = text_embedder.embed_documents_array(list(unique_texts))
+    embeddings = vectors[codes].reshape(len(merged_df), len(text_columns) * vectors.shape[1])  # Row-wise concatenation
+    return _features(merged_df, scalers, encoders, embeddings)
+
+
+def transform_data(interactions_df: pd.DataFrame, users_df: pd.DataFrame, products_df: pd.DataFrame) -> Tuple[pd.DataFrame, Dict[str, StandardScaler], Dict[str, LabelEncoder]]:
+    """Transforms the data: embeddings, scaling, and encoding"""
+    merged_df = _merge(interactions_df, users_df, products_df)
+    scalers, encoders = fit_transformers(merged_df)
+    return transform_rows(merged_df, scalers, encoders), scalers, encoders
+
+
+# Streaming mode: the interactions are read in chunks through a server-side cursor & transformed across a process pool
+_TEXT_ROWS = ['bio_row', 'name_row', 'description_row']  # Row of each text in the embedding table (0 is the empty text)
+_worker: Dict[str, object] = {}  # Context of a pool process
+
+
+def _read_chunks(connection, chunk_size: int) -> Iterator[pd.DataFrame]:
+    return pd.read_sql(text(f'SELECT {ChangeTracker.TABLES["interactions"][1]} FROM interactions'), connection, chunksize=chunk_size)
+
+
+def _embed_texts(users_df: pd.DataFrame, products_df: pd.DataFrame) -> Tuple[np.ndarray, pd.DataFrame, pd.DataFrame]:
+    """Embeds every unique user & product text once, replacing the text columns with rows of the returned embedding table"""
+    texts = [users_df['bio'], products_df['name'], products_df['description']]
+    codes, unique_texts = pd.factorize(np.concatenate([[''], *(col.fillna('').astype(str).to_numpy() for col in texts)]))
+    bio_end, name_end = 1 + len(users_df), 1 + len(users_df) + len(products_df)
+    users_df = users_df.drop(columns='bio').assign(bio_row=codes[1:bio_end])
+    products_df = products_df.drop(columns=['name', 'description']).assign(name_row=codes[bio_end:name_end], description_row=codes[name_end:])
+    return text_embedder.embed_documents_array(list(unique_texts)), users_df, products_df
+
+
+def fit_streaming_transform(chunks: Iterator[pd.DataFrame], users_df: pd.DataFrame, products_df: pd.DataFrame) -> Tuple[int, Dict[str, StandardScaler], Dict[str, LabelEncoder]]:
+    """First pass over the chunks: fits the scalers & label encoders of `transform_data` without holding the interactions in memory"""
+    scalers, values, n_rows = {'price': StandardScaler(), 'sentiments': StandardScaler()}, {col: set() for col in _LABEL_COLUMNS}, 0
+    for chunk in chunks:
+        result_df = _merge(chunk, users_df, products_df)
+        for col, scaler in scalers.items(): scaler.partial_fit(result_df[[col]])
+        for col in _LABEL_COLUMNS: values[col].update(result_df[col].fillna('Unknown'))
+        n_rows += len(result_df)
+    return n_rows, scalers, {col: LabelEncoder().fit(sorted(values[col])) for col in _LABEL_COLUMNS}
+
+
+def _init_worker(context: Dict[str, object]) -> None:
+    _worker.update(context)
+
 
-    # Step 5: Scale continuous features
-    scaler = StandardScaler()
-    result_df['price'] = scaler.fit_transform(result_df[['price']])
-    result_df['sentiments'] = scaler.fit_transform(result_df[['sentiments']])
+def transform_chunk(chunk: pd.DataFrame, matrix_path: str, offset: int) -> None:
+    """Second pass (in a pool process): transforms a chunk like `transform_data` & writes its normalized rows into the matrix at `offset`"""
+    result_df, vectors = _merge(chunk, _worker['users'], _worker['products']), _worker['text_vectors']
+    embeddings = vectors[result_df[_TEXT_ROWS].fillna(0).to_numpy(dtype=np.int64)].reshape(len(result_df), len(_TEXT_ROWS) * vectors.shape[1])
+    features = _features(result_df, _worker['scalers'], _worker['encoders'], embeddings).to_numpy(dtype=np.float32)
+    matrix = np.load(matrix_path, mmap_mode='r+')
+    matrix[offset:offset + len(features)] = normalize_rows(features)
+    matrix.flush()
 
-    # Step 6: Label Encode discrete features
-    label_encoders = {}
-    for col in ['username', 'category', 'owner']:
-        le = LabelEncoder()
-        result_df[col] = le.fit_transform(result_df[col].fillna("Unknown"))
-        label_encoders[col] = le
 
-    # Step 7: Combine embeddings
-    embedding_features = result_df[text_columns].apply(lambda x: np.concatenate(x.values), axis=1)
-    transformed_df = pd.concat([result_df.drop(columns=text_columns), pd.DataFrame(embedding_features.tolist())], axis=1)
-    return transformed_df, scaler, label_encoders
+def run_streaming_pipeline(chunk_size: int = PIPELINE_CHUNK_SIZE, n_workers: int = PIPELINE_WORKERS) -> int:
+    """
+    Rebuilds the feature store with memory bounded by the chunk size (plus the users, products & their vectors): the
+    interactions are streamed twice from one repeatable-read snapshot, first to fit the scalers & encoders, then to
+    transform chunks in `n_workers` processes that write straight into a memory-mapped scratch matrix, which is then
+    aggregated into profiles. The users & products of the interactions are kept as int32 codes (with their weights), so
+    no Python object is held per interaction. Returns the number of interactions.
+    """
+    synced_at = time_ns()  # Stamps the version: later changes may not be part of it
+    products_df = _retrieve(f'SELECT {ChangeTracker.TABLES["products"][1]} FROM products')
+    neighbors = refresh_neighbors(None, products_df)[0].table()
+    text_vectors, users_df, products_df = _embed_texts(_retrieve(f'SELECT {ChangeTracker.TABLES["users"][1]} FROM users'), products_df)
+    options = {'isolation_level': 'REPEATABLE READ', 'stream_results': True, 'max_row_buffer': chunk_size}
+    with engine.connect().execution_options(**options) as connection, connection.begin():
+        n_rows, scalers, encoders = fit_streaming_transform(_read_chunks(connection, chunk_size), users_df, products_df)
+        one_hot = [column for col, encoder in encoders.items() for column in _one_hot_columns(col, encoder)]
+        columns = _SIGNAL_COLUMNS + one_hot + list(range(len(_TEXT_ROWS) * text_vectors.shape[1]))
+        version, staging_dir = create_staging(ARTIFACTS_DIR, synced_at)
+        matrix_path = os.path.join(staging_dir, 'interactions.npy')
+        np.lib.format.open_memmap(matrix_path, mode='w+', dtype=np.float32, shape=(n_rows, len(columns))).flush()
 
+        context = {'users': users_df, 'products': products_df, 'text_vectors': text_vectors, 'scalers': scalers, 'encoders': encoders}
+        usernames, product_ids = pd.Index(users_df['username']), pd.Index(products_df['product_id'])
+        user_codes, item_codes, weights, pending, offset = [], [], [], deque(), 0
+        with ProcessPoolExecutor(n_workers, initializer=_init_worker, initargs=(context,)) as pool:
+            for chunk in _read_chunks(connection, chunk_size):
+                pending.append(pool.submit(transform_chunk, chunk, matrix_path, offset))
+                usernames, codes = _encode(usernames, chunk['username'])
+                user_codes.append(codes)
+                product_ids, codes = _encode(product_ids, chunk['product_id'])
+                item_codes.append(codes)
+                weights.append(_interaction_weights(chunk))
+                offset += len(chunk)
+                if len(pending) >= 2 * n_workers: pending.popleft().result()  # Bounds the chunks in flight
+            for future in pending: future.result()
 
-def save_transformed_data(df: pd.DataFrame) -> None:
-    """Saves the transformed data to a CSV file."""
-    df.to_csv(TRANSFORMED_DATA_PATH, index=False)
+    categories = dict(zip(products_df['product_id'], products_df['category']))
+    user_codes, item_codes = (np.concatenate(codes or [np.zeros(0, dtype=np.int32)]) for codes in (user_codes, item_codes))
+    weights = np.concatenate(weights or [np.zeros(0)])
+    profiles = _build_profiles(np.load(matrix_path, mmap_mode='r'), user_codes, usernames, item_codes, product_ids, weights, categories)
+    os.remove(matrix_path)
+    profiles['preprocessing'].update(scalers=scalers, encoders=encoders)
+    publish_feature_store(ARTIFACTS_DIR, version, columns, recommendations_k=TOP_K_RECOMMENDED, neighbors=neighbors, keep=ARTIFACT_VERSIONS_KEPT, pinned=[ARTIFACT_VERSION], **profiles)
+    return n_rows
+
+
+def _interaction_weights(interactions_df: pd.DataFrame) -> np.ndarray:
+    return signal_weights(interactions_df['rating'].fillna(0), interactions_df['in_cart'].fillna(False), interactions_df['sentiments'].apply(_sum_sentiments))
+
+
+def build_profiles(unit_vectors: np.ndarray, usernames: Sequence[str], product_ids: Sequence[int], weights: np.ndarray, categories: Dict[int, str]) -> Dict[str, object]:
+    """
+    Aggregates the normalized interaction rows into one profile per user (weighted by the rating, cart & sentiment
+    signals of each interaction) & one item vector per product, optionally compressed (`COMPRESSION_METHOD` to
+    `COMPRESSION_DIM` dimensions & `QUANTIZATION`), then precomputes every user's recommendations on the vectors as served
+    & the popular/trending lists for cold-start users, plus the signal weight of each interaction & their total per
+    profile (so the recommender can fold new signals into it online). Returns them as keyword arguments of `publish_feature_store`.
+    """
+    user_codes, users = pd.factorize(np.asarray(usernames), sort=True)
+    item_codes, products = pd.factorize(np.asarray(product_ids), sort=True)
+    return _build_profiles(unit_vectors, user_codes, users, item_codes, products, weights, categories)
+
+
+def _encode(keys: pd.Index, values: pd.Series) -> Tuple[pd.Index, np.ndarray]:
+    """Returns the int32 codes of the values in `keys`, appending the values it misses (e.g., created after it was read)"""
+    codes = keys.get_indexer(values)
+    if (codes < 0).any():
+        keys = keys.append(pd.Index(values[codes < 0].unique()))
+        codes = keys.get_indexer(values)
+    return keys, codes.astype(np.int32)
+
+
+def _build_profiles(
+        unit_vectors: np.ndarray,
+        user_codes: np.ndarray,
+        usernames: Sequence[str],
+        item_codes: np.ndarray,
+        product_ids: Sequence[int],
+        weights: np.ndarray,
+        categories: Dict[int, str]
+    ) -> Dict[str, object]:
+    """Same as `build_profiles` with the user & product of each row given as codes into `usernames` & `product_ids`"""
+    user_rows, user_vectors = aggregate_rows(unit_vectors, user_codes, weights)
+    item_rows, item_vectors = aggregate_rows(unit_vectors, item_codes)
+    reducer = fit_reducer(np.vstack([item_vectors, user_vectors]), COMPRESSION_METHOD, COMPRESSION_DIM) if COMPRESSION_METHOD else None
+    return _serve_profiles(
+        np.asarray(usernames)[user_rows], user_vectors, np.asarray(product_ids)[item_rows], item_vectors,
+        np.searchsorted(user_rows, user_codes), np.searchsorted(item_rows, item_codes), weights, categories, reducer
+    )
+
+
+def _serve_profiles(
+        users: np.ndarray,
+        user_vectors: np.ndarray,
+        products: np.ndarray,
+        item_vectors: np.ndarray,
+        user_codes: np.ndarray,
+        item_codes: np.ndarray,
+        weights: np.ndarray,
+        categories: Dict[int, str],
+        reducer: Optional[object],
+        popularity: Optional[pd.Series] = None,
+        previous: Optional[Tuple[Dict[str, object], pd.Index, pd.Index]] = None
+    ) -> Dict[str, object]:
+    """
+    Compresses aggregated profiles & precomputes what `build_profiles` serves from them (`weights` of the interactions
+    of the users & products at the `user_codes` & `item_codes` rows). The popular products are ranked by `popularity`
+    (summed signal weight per product ID) if given. With the `previous` served profiles & the users & products
+    re-aggregated since, only the recommendations these may change are recomputed (see `_refresh_recommendations`).
+    """
+    if reducer is not None or QUANTIZATION != 'float32':
+        user_vectors, item_vectors = compress(user_vectors, reducer, QUANTIZATION), compress(item_vectors, reducer, QUANTIZATION)
+    similarity = SimilarityEngine(item_vectors, products)
+    if previous is None or (recommendations := _refresh_recommendations(similarity, users, user_vectors, *previous)) is None:
+        recommendations = precompute_recommendations(similarity, users, user_vectors)
+    weights = np.asarray(weights, dtype=np.float64)
+    if popularity is None: popular, trending = rank_popular(np.asarray(products)[item_codes], weights, categories, FALLBACK_SIZE)
+    else: popular, trending = rank_popular(popularity.index, popularity.to_numpy(), categories, FALLBACK_SIZE)
+    return {
+        'usernames': users, 'user_vectors': user_vectors, 'product_ids': products, 'item_vectors': item_vectors,
+        'recommendations': recommendations, 'popular': popular, 'trending': trending,
+        'user_weights': np.bincount(user_codes, weights, minlength=len(users)), 'interaction_weights': (user_codes, item_codes, weights),
+        'preprocessing': {'compression': {'reducer': reducer, 'quantization': QUANTIZATION}}
+    }
+
+
+def _refresh_recommendations(
+        similarity: SimilarityEngine,
+        users: np.ndarray,
+        user_vectors: np.ndarray,
+        previous: Dict[str, object],
+        stale_users: pd.Index,
+        stale_products: pd.Index,
+        top_k: int = TOP_K_RECOMMENDED
+    ) -> Optional[Dict[str, List[int]]]:
+    """
+    Reuses the `previous` recommendations of every user, except those of the re-aggregated (`stale_users`) & new users,
+    of the users whose list holds a re-aggregated product (`stale_products`, whose score moved) & of the users a
+    re-aggregated product now outscores the last of their list for, which are recomputed: the cost is one blocked product
+    of the users by the stale products rather than by the catalog. Returns `None` if the served vectors of the other
+    users or products changed (e.g., a new int8 scale), so everything must be recomputed.
+    """
+    users, products, item_vectors = pd.Index(users), pd.Index(similarity.products), similarity.unit_vectors
+    previous_users, previous_products = pd.Index(previous['usernames']), pd.Index(previous['product_ids'])
+    kept_users = np.flatnonzero(~users.isin(stale_users) & users.isin(previous_users))
+    kept_products = np.flatnonzero(~products.isin(stale_products) & products.isin(previous_products))
+    if not (
+        np.array_equal(user_vectors[kept_users], previous['user_vectors'][previous_users.get_indexer(users[kept_users])]) and
+        np.array_equal(item_vectors[kept_products], previous['item_vectors'][previous_products.get_indexer(products[kept_products])])
+    ): return None
+
+    reused = [previous['recommendations'][username] for username in users[kept_users]]
+    stale, k = set(stale_products.tolist()), min(top_k, len(products))
+    recompute = np.fromiter((len(ids) < k or not stale.isdisjoint(ids) for ids in reused), dtype=bool, count=len(reused))
+    if len(changed_rows := np.flatnonzero(products.isin(stale_products))):
+        candidates = np.flatnonzero(~recompute)
+        last_rows = products.get_indexer([reused[i][-1] for i in candidates])
+        step = max(SIMILARITY_BLOCK_SIZE // len(changed_rows), 1)
+        for start in range(0, len(candidates), step):
+            block = candidates[start:start + step]
+            queries = normalize_rows(user_vectors[kept_users[block]])
+            last = np.einsum('ij,ij->i', queries, item_vectors[last_rows[start:start + step]].astype(np.float32))
+            best = (queries @ item_vectors[changed_rows].astype(np.float32).T).max(axis=1)
+            recompute[block] |= best >= last - 1e-6  # Ties may reorder the list
+
+    recommendations = {str(users[kept_users[i]]): reused[i] for i in np.flatnonzero(~recompute)}
+    recomputed = np.setdiff1d(np.arange(len(users)), kept_users[~recompute])
+    recommendations.update(precompute_recommendations(similarity, users[recomputed], user_vectors[recomputed], top_k))
+    return recommendations
+
+
+def _replace_rows(keys: np.ndarray, vectors: np.ndarray, stale: pd.Index, new_keys: np.ndarray, new_vectors: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Replaces the vectors of the `stale` keys by the given ones, keeping the keys sorted like `aggregate_rows`"""
+    kept = ~pd.Index(keys).isin(stale)
+    keys, vectors = np.concatenate([keys[kept], new_keys]), np.vstack([vectors[kept], new_vectors])
+    order = np.argsort(keys, kind='stable')
+    return keys[order], vectors[order]
+
+
+class FeatureCache:
+    """
+    Transformed rows of every interaction (keyed by username & product ID) & the profiles aggregated from them, so
+    that a run only transforms the interactions changed by the last sync (themselves or through their user or product)
+    & re-aggregates the users & products they belong to. Every row is standardized & encoded by the same scalers &
+    label encoders, so these stay fixed between full runs: refitting them moves every row, hence every profile, & rows
+    transformed by different fits wouldn't be comparable. A full run re-fits & re-transforms everything whenever a label
+    is new to the encoders, the price or sentiment statistics drift by more than `PIPELINE_REFIT_TOLERANCE` of their
+    fitted standard deviation, or `PIPELINE_FULL_REFRESH` seconds have passed. Between full runs, the popularity of the
+    products is updated by the changed weights & only the recommendations the re-aggregated profiles may change are
+    recomputed, reusing the others from the profiles last served.
+    """
+    def __init__(self) -> None:
+        self.features: Optional[pd.DataFrame] = None  # Transformed rows
+        self.values: Optional[pd.DataFrame] = None  # Merged values fitted by the scalers & encoders, to detect when they go stale
+        self.weights: Optional[pd.Series] = None  # Signal weight of every row
+        self.popularity: Optional[pd.Series] = None  # Summed signal weight per product ID
+        self.served: Optional[Dict[str, object]] = None  # Profiles last served (`None` after a full run)
+        self.stale_users, self.stale_products = pd.Index([]), pd.Index([])  # Re-aggregated since the profiles last served
+        self.scalers: Dict[str, StandardScaler] = {}
+        self.encoders: Dict[str, LabelEncoder] = {}
+        self.reducer: Optional[object] = None
+        self.users = self.user_vectors = self.products = self.item_vectors = None
+        self.refreshed_at = 0.
+
+
+    def update(self, tracker: ChangeTracker) -> Tuple[str, int]:
+        """Applies the tracker's last sync, returning the reason of a full run (empty if incremental) & the number of transformed rows"""
+        interactions, users_df, products_df = tracker.tables['interactions'], tracker.get_table('users'), tracker.get_table('products')
+        if self.features is None: reason = 'first run'
+        elif monotonic() - self.refreshed_at > PIPELINE_FULL_REFRESH: reason = 'periodic refresh'
+        else:
+            changed, deleted = tracker.changed_interactions()
+            stale = changed.union(deleted)
+            merged_df = _merge(interactions.loc[changed].reset_index(), users_df, products_df).set_axis(changed)
+            values = pd.concat([self.values.drop(stale, errors='ignore'), merged_df[self.values.columns]])
+            if not (reason := self._refit_reason(values)):
+                self.values = values
+                rows = transform_rows(merged_df, self.scalers, self.encoders).set_axis(changed) if len(changed) else self.features.iloc[:0]
+                self.features = pd.concat([self.features.drop(stale, errors='ignore'), rows])
+                weights = pd.Series(_interaction_weights(interactions.loc[changed]), index=changed, dtype=np.float64)
+                dropped = self.weights[self.weights.index.isin(stale)]
+                self.popularity = self.popularity.sub(dropped.groupby(level=1).sum(), fill_value=0).add(weights.groupby(level=1).sum(), fill_value=0)
+                self.weights = pd.concat([self.weights.drop(stale, errors='ignore'), weights])
+                self._reaggregate(stale.unique(level=0), stale.unique(level=1))
+                self.stale_users, self.stale_products = self.stale_users.union(stale.unique(level=0)), self.stale_products.union(stale.unique(level=1))
+                return '', len(changed)
+
+        merged_df = _merge(interactions.reset_index(), users_df, products_df).set_axis(interactions.index)
+        self.scalers, self.encoders = fit_transformers(merged_df)
+        self.values = merged_df[list(self.scalers) + _LABEL_COLUMNS]
+        self.features = transform_rows(merged_df, self.scalers, self.encoders).set_axis(interactions.index)
+        self.weights = pd.Series(_interaction_weights(interactions), index=interactions.index, dtype=np.float64)
+        self.popularity, self.served = self.weights.groupby(level=1).sum(), None
+        unit_vectors = normalize_rows(self.features.to_numpy(dtype=np.float32))
+        self.users, self.user_vectors = aggregate_rows(unit_vectors, interactions.index.get_level_values(0), self.weights.to_numpy())
+        self.products, self.item_vectors = aggregate_rows(unit_vectors, interactions.index.get_level_values(1))
+        self.reducer = fit_reducer(np.vstack([self.item_vectors, self.user_vectors]), COMPRESSION_METHOD, COMPRESSION_DIM) if COMPRESSION_METHOD else None
+        self.refreshed_at = monotonic()
+        return reason, len(interactions)
+
+
+    def profiles(self, categories: Dict[int, str]) -> Dict[str, object]:
+        """Same as `build_profiles` on the cached rows, reusing the reducer of the last full run & the recommendations last served"""
+        user_codes = pd.Index(self.users).get_indexer(self.weights.index.get_level_values(0))
+        item_codes = pd.Index(self.products).get_indexer(self.weights.index.get_level_values(1))
+        popularity = self.popularity[self.popularity.index.isin(self.products)]  # Without deleted products
+        previous = (self.served, self.stale_users, self.stale_products) if self.served is not None else None
+        self.served = _serve_profiles(
+            self.users, self.user_vectors, self.products, self.item_vectors, user_codes, item_codes, self.weights.to_numpy(), categories,
+            self.reducer, popularity, previous
+        )
+        self.stale_users, self.stale_products = pd.Index([]), pd.Index([])
+        return self.served
+
+
+    def _refit_reason(self, values: pd.DataFrame) -> str:
+        for col, encoder in self.encoders.items():
+            if not values[col].fillna('Unknown').isin(encoder.classes_).all(): return f'new {col} labels'
+        for col, scaler in self.scalers.items():
+            mean, std, fitted_std = values[col].mean(), values[col].std(ddof=0), scaler.scale_[0]
+            if abs(mean - scaler.mean_[0]) > PIPELINE_REFIT_TOLERANCE * fitted_std or abs(std - fitted_std) > PIPELINE_REFIT_TOLERANCE * fitted_std:
+                return f'{col} statistics drifted'
+        return ''
+
+
+    def _reaggregate(self, users: pd.Index, products: pd.Index) -> None:
+        """Re-aggregates the profiles of the given users & the item vectors of the given products from their current rows"""
+        usernames, product_ids = self.features.index.get_level_values(0), self.features.index.get_level_values(1)
+        rows = usernames.isin(users)
+        new_users, new_vectors = aggregate_rows(normalize_rows(self.features[rows].to_numpy(dtype=np.float32)), usernames[rows], self.weights[rows].to_numpy())
+        self.users, self.user_vectors = _replace_rows(self.users, self.user_vectors, users, new_users, new_vectors)
+        rows = product_ids.isin(products)
+        new_products, new_vectors = aggregate_rows(normalize_rows(self.features[rows].to_numpy(dtype=np.float32)), product_ids[rows])
+        self.products, self.item_vectors = _replace_rows(self.products, self.item_vectors, products, new_products, new_vectors)
+
+
+def product_content_vectors(products_df: pd.DataFrame, price_stats: Optional[Tuple[float, float]] = None) -> Tuple[np.ndarray, Tuple[float, float]]:
+    """
+    Content vectors of products for the similar products table: their name, description & category embeddings plus
+    their log-price, standardized with `price_stats` (fitted if not given), weighted by `NEIGHBOR_WEIGHTS`. Returns the
+    vectors & the price statistics.
+    """
+    text_columns = ['name', 'description', 'category']
+    codes, unique_texts = pd.factorize(products_df[text_columns].fillna('').astype(str).to_numpy().ravel())
+    vectors = normalize_rows(text_embedder.embed_documents_array(list(unique_texts)))
+    embeddings = vectors[codes].reshape(len(products_df), len(text_columns), vectors.shape[1])
+    log_prices = np.log1p(products_df['price'].fillna(0).clip(lower=0).to_numpy(dtype=np.float32))
+    mean, std = price_stats or ((float(log_prices.mean()), float(log_prices.std()) or 1.) if len(log_prices) else (0., 1.))
+    features = [NEIGHBOR_WEIGHTS[col] * embeddings[:, i] for i, col in enumerate(text_columns)] + [NEIGHBOR_WEIGHTS['price'] * (log_prices[:, None] - mean) / std]
+    return np.hstack(features).astype(np.float32), (mean, std)
+
+
+def refresh_neighbors(
+        neighbors: Optional[Tuple[NeighborIndex, Tuple[float, float]]],
+        products_df: pd.DataFrame,
+        changes: Optional[Tuple[pd.Index, pd.Index]] = None
+    ) -> Tuple[NeighborIndex, Tuple[float, float]]:
+    """
+    Builds the similar products table (without a previous index or `changes`), or only refreshes the products inserted,
+    updated & deleted according to `changes`. Returns the index (published with the next artifact version) & its price
+    statistics.
+    """
+    if neighbors is None or changes is None:
+        vectors, price_stats = product_content_vectors(products_df)
+        index = NeighborIndex(products_df['product_id'], vectors)
+    else:
+        (index, price_stats), (upserted, deleted) = neighbors, changes
+        if not len(upserted) and not len(deleted): return neighbors
+        for product_id in deleted: index.remove(product_id)
+        changed_df = products_df[products_df['product_id'].isin(upserted)]
+        if len(changed_df): index.upsert_many(changed_df['product_id'], product_content_vectors(changed_df, price_stats)[0])
+    return index, price_stats
+
+
+def save_transformed_data(
+        df: pd.DataFrame,
+        profiles: Dict[str, object],
+        scalers: Dict[str, StandardScaler],
+        encoders: Dict[str, LabelEncoder],
+        neighbors: NeighborIndex,
+        synced_at: Optional[int] = None
+    ) -> str:
+    """
+    Publishes the profiles built from the transformed data (see `build_profiles`) with the fitted scalers & encoders &
+    the similar products table as a new artifact version (the API hot-reloads it), stamped with the time the data was
+    read (`synced_at`), optionally exporting a CSV for debugging. Returns the published version.
+    """
+    profiles['preprocessing'].update(scalers=scalers, encoders=encoders)
+    version = save_feature_store(ARTIFACTS_DIR, df.columns, recommendations_k=TOP_K_RECOMMENDED, neighbors=neighbors.table(), keep=ARTIFACT_VERSIONS_KEPT, pinned=[ARTIFACT_VERSION], synced_at=synced_at, **profiles)
+    if EXPORT_TRANSFORMED_CSV.lower() == 'true':
+        tmp_path = f'{TRANSFORMED_DATA_PATH}.tmp'
+        df.to_csv(tmp_path)  # Indexed by username & product ID
+        os.replace(tmp_path, TRANSFORMED_DATA_PATH)
+    return version
 
 
 def main() -> None:
-    """Runs the pipeline in the background every 4 minutes"""
+    """Runs the pipeline in the background whenever changes settle, and at least every `PIPELINE_INTERVAL` seconds"""
     print(f'[{datetime.now()}] Starting Recommendation Pipeline...')
+    streaming = PIPELINE_STREAMING.lower() == 'true'
+    tracker = None if streaming else ChangeTracker()
+    cache = FeatureCache()  # Transformed rows & profiles, updated incrementally between full runs
+    neighbors = None  # Similar products index, rebuilt on the first run & refreshed incrementally after
+    debouncer = Debouncer(PIPELINE_DEBOUNCE, PIPELINE_MAX_DELAY, PIPELINE_INTERVAL)
+    change_bus.subscribe(debouncer.notify)
+    n_events = 0
     while True:
         try:
-            print(f'[{datetime.now()}] Extracting data...')
-            interactions_df = extract_interaction_data()
-            log('Extracted interaction data.', 'model')
+            if streaming:
+                print(f'[{datetime.now()}] Streaming interactions in chunks of {PIPELINE_CHUNK_SIZE} ({n_events} change events)...')
+                n_rows = run_streaming_pipeline()
+                log(f'Streamed & saved {n_rows} transformed interactions & the similar products.', 'model')
+                print(f'[{datetime.now()}] Waiting for change events...')
+                n_events = debouncer.wait()
+                continue
+
+            print(f'[{datetime.now()}] Extracting changes ({n_events} change events)...')
+            synced_at = time_ns()  # Stamps the version: later changes may not be part of it
+            n_changed = tracker.sync()
+            log(f'Extracted {n_changed} changed rows after {n_events} change events.', 'model')
+            if n_changed == 0 and current_version(ARTIFACTS_DIR) is not None:
+                print(f'[{datetime.now()}] No changes. Waiting for change events...')
+                n_events = debouncer.wait()
+                continue
 
             print(f'[{datetime.now()}] Transforming data...')
-            transformed_df = transform_data(interactions_df)[0]
-            log('Transformed interaction data.', 'model')
+            reason, n_rows = cache.update(tracker)
+            log(f'Transformed {n_rows} interactions' + (f' (full run: {reason}).' if reason else ' (incremental run).'), 'model')
+
+            print(f'[{datetime.now()}] Building profiles & precomputing recommendations...')
+            products_df = tracker.get_table('products')
+            profiles = cache.profiles(dict(zip(products_df['product_id'], products_df['category'])))
+            log(f'Built {len(profiles["usernames"])} user profiles & {len(profiles["product_ids"])} item vectors.', 'model')
+
+            print(f'[{datetime.now()}] Refreshing similar products...')
+            neighbors = refresh_neighbors(neighbors, products_df, tracker.changes['products'] if neighbors is not None else None)
+            log('Refreshed similar products.', 'model')
 
             print(f'[{datetime.now()}] Saving transformed data...')
-            save_transformed_data(transformed_df)
-            log('Saved transformed data.', 'model')
+            version = save_transformed_data(cache.features, profiles, cache.scalers, cache.encoders, neighbors[0], synced_at)
+            log(f'Published artifact version {version}.', 'model')
 
-            print(f'[{datetime.now()}] Sleeping for {PIPELINE_INTERVAL} seconds...')
-            log(f'Sleeping for {PIPELINE_INTERVAL} seconds.', 'model')
-            sleep(PIPELINE_INTERVAL)
+            print(f'[{datetime.now()}] Waiting for change events...')
+            n_events = debouncer.wait()
         except KeyboardInterrupt:
             print(f'[{datetime.now()}] Stopping pipeline...')
             break
@@ -3,6 +3,8 @@ from langchain_community.llms.ollama import Ollama
 from langchain_community.chat_models.ollama import ChatOllama
 from langchain_community.embeddings import OllamaEmbeddings
 from langchain.schema import SystemMessage
+from src.lib.utils.cache import CachedEmbeddings
+from src.lib.utils.gateway import LLMGateway, Priority
 import os
 
 # Net
@@ -18,18 +20,48 @@ CONDITIONAL_LLM_NAME = os.getenv('CONDITIONAL_LLM', 'llama3')
 BASE_URL = os.getenv('BASE_URL', 'http://ollama_c:11434')
 TEMPERATURE = float(os.getenv('TEMPERATURE', .5))
 MAX_CORES = max(os.cpu_count() - 2, 1)
+CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))  # path with respect to this file
+EMBEDDING_CACHE_SIZE = int(os.getenv('EMBEDDING_CACHE_SIZE', 4096))
+LLM_CONCURRENCY = int(os.getenv('LLM_CONCURRENCY', 2))  # Max. in-flight requests per gateway lane (role)
+LLM_STREAM_CONCURRENCY = int(os.getenv('LLM_STREAM_CONCURRENCY', 4))  # Max. concurrent chatbot streams, which hold a slot for the whole generation
+EMBED_BATCH_WINDOW = .01  # Seconds to wait for more embedding requests to batch together
+EMBED_MAX_BATCH = 32
+EMBEDDING_CACHE_PATH = os.getenv('EMBEDDING_CACHE_PATH', os.path.join(CURRENT_DIR, '../../db/embedding_cache.sqlite'))  # Set to an empty string to disable persistence
 
 MAIN_CONFIG = dict(base_url=BASE_URL, num_thread=MAX_CORES, num_gpu=1)
-CREATIVE_LLM = Ollama(**MAIN_CONFIG, model=CREATIVE_LLM_NAME, temperature=1)
-EMBEDDER = OllamaEmbeddings(**MAIN_CONFIG, model=EMBEDDER_LLM_NAME, temperature=TEMPERATURE)
-CHAT_LLM = ChatOllama(**MAIN_CONFIG, model=CHAT_LLM_NAME, temperature=TEMPERATURE)
-CONDITIONAL_LLM = Ollama(**MAIN_CONFIG, model=CONDITIONAL_LLM_NAME, temperature=0)
+GATEWAY = LLMGateway(default_limit=LLM_CONCURRENCY, limits={'chat/stream': LLM_STREAM_CONCURRENCY})  # Every model call is queued, limited & coalesced here, in one lane per role
+CREATIVE_LLM = GATEWAY.llm(Ollama(**MAIN_CONFIG, model=CREATIVE_LLM_NAME, temperature=1), 'creative', Priority.BACKGROUND)
+EMBEDDER = CachedEmbeddings(
+    GATEWAY.embeddings(
+        OllamaEmbeddings(**MAIN_CONFIG, model=EMBEDDER_LLM_NAME, temperature=TEMPERATURE), 'embeddings',
+        window=EMBED_BATCH_WINDOW, max_batch=EMBED_MAX_BATCH
+    ),
+    max_size=EMBEDDING_CACHE_SIZE,
+    persist_path=EMBEDDING_CACHE_PATH or None
+)
+CHAT_LLM = GATEWAY.llm(ChatOllama(**MAIN_CONFIG, model=CHAT_LLM_NAME, temperature=TEMPERATURE), 'chat', Priority.INTERACTIVE)
+CONDITIONAL_LLM = GATEWAY.llm(Ollama(**MAIN_CONFIG, model=CONDITIONAL_LLM_NAME, temperature=0), 'conditional', Priority.INTERACTIVE)
+SUMMARY_LLM = GATEWAY.llm(Ollama(**MAIN_CONFIG, model=CONDITIONAL_LLM_NAME, temperature=0), 'summary', Priority.INTERACTIVE)
 
 CHUNK_SIZE = 500
 CHUNK_OVERLAP = 200
-CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))  # path with respect to this file
 VECSTORE_PERSIST_DIR = os.path.join(CURRENT_DIR, '../../db/vectorstore')
 TOP_K = 9
+DOCS_SOURCES = os.getenv('DOCS_SOURCES', os.path.join(CURRENT_DIR, '../../db/data/company_docs.txt')).split(',')  # Paths or glob patterns
+CHUNK_STORE_PATH = os.path.join(CURRENT_DIR, '../../db/chunks.json')  # Chunks shared by the dense & BM25 indexes
+RETRIEVAL_MODE = os.getenv('RETRIEVAL_MODE', 'hybrid')  # "hybrid", "dense" or "lexical" (BM25 only, no embedding calls)
+DENSE_TIMEOUT = float(os.getenv('DENSE_TIMEOUT', 2))  # Seconds before hybrid retrieval falls back to BM25 only
+DENSE_COOLDOWN = 30  # Seconds to skip dense retrieval after it fails or times out
+RRF_K = 60  # Reciprocal rank fusion constant
+PROMPT_TOKEN_BUDGET = int(os.getenv('PROMPT_TOKEN_BUDGET', 3072))
+RECENT_TURNS = 6  # Latest conversation messages kept verbatim; older ones are summarized
+CHARS_PER_TOKEN = 4  # Rough estimate for English text
+SUMMARY_CACHE_SIZE = 1024
+
+FAQ_PATH = os.path.join(CURRENT_DIR, '../../db/data/faq.json')
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv('SEMANTIC_CACHE_THRESHOLD', .95))  # Min. cosine similarity for two questions to share an answer
+SEMANTIC_CACHE_TTL = int(os.getenv('SEMANTIC_CACHE_TTL', 3600))  # 1 hour in seconds
+SEMANTIC_CACHE_SIZE = int(os.getenv('SEMANTIC_CACHE_SIZE', 1024))
 
 BASE_SYS_MSG = SystemMessage('You are a helpful assistant that uses EcomGo\'s (our e-commerce company) documents to answer customer questions.')
 ERR_RESPONSE = 'Sorry, something went wrong. Please try again later.'
@@ -41,11 +73,37 @@ PSQL_DB = os.getenv('POSTGRES_DB')
 PSQL_USER = os.getenv('POSTGRES_USER')
 PSQL_PASSWORD = os.getenv('POSTGRES_PASSWORD')
 ENGINE_URL = f'postgresql+psycopg2://{PSQL_USER}:{PSQL_PASSWORD}@{PSQL_HOST}:{PSQL_PORT}/{PSQL_DB}'
+EVENT_BACKEND = os.getenv('EVENT_BACKEND', 'postgres')  # Change events over Postgres LISTEN/NOTIFY ("postgres") or within the process ("local")
+EVENT_CHANNEL = 'ecom_changes'
 
 # Recommendation Data Pipeline
-PIPELINE_INTERVAL = 240  # 4 minutes in seconds
-TRANSFORMED_DATA_PATH = os.path.join(CURRENT_DIR, '../../db/data/transformed_interactions.csv')
+PIPELINE_INTERVAL = 240  # Max. staleness in seconds: the pipeline runs at least this often, even if no change event arrives
+PIPELINE_DEBOUNCE = float(os.getenv('PIPELINE_DEBOUNCE', 5))  # Seconds without new change events before the pipeline runs
+PIPELINE_MAX_DELAY = float(os.getenv('PIPELINE_MAX_DELAY', 30))  # Max. seconds a change event waits during a continuous burst
+PIPELINE_REFIT_TOLERANCE = float(os.getenv('PIPELINE_REFIT_TOLERANCE', .1))  # Drift of the price/sentiment mean or std (in fitted stds) that triggers a full re-scale
+PIPELINE_FULL_REFRESH = float(os.getenv('PIPELINE_FULL_REFRESH', 86_400))  # Max. seconds between full runs (between them, only changed interactions are transformed)
+PIPELINE_STATE_PATH = os.path.join(CURRENT_DIR, '../../db/data/pipeline_state.pkl')  # Mirror of the tables & the watermark of the last run
+PIPELINE_EMBED_BATCH_SIZE = int(os.getenv('PIPELINE_EMBED_BATCH_SIZE', 256))  # Texts per SentenceTransformer forward pass
+PIPELINE_EMBEDDING_CACHE_SIZE = 100_000  # Text embeddings kept in memory between runs (all are also persisted at EMBEDDING_CACHE_PATH)
+ARTIFACTS_DIR = os.path.join(CURRENT_DIR, '../../db/data/artifacts')  # Versioned bundles published by the pipeline (feature matrix, preprocessing & metadata)
+ARTIFACT_VERSIONS_KEPT = int(os.getenv('ARTIFACT_VERSIONS_KEPT', 3))
+ARTIFACT_VERSION = os.getenv('ARTIFACT_VERSION', '')  # Pins the API to a published version (the `current` one if empty), which the pipeline never cleans up
+NEIGHBORS_K = 10  # Similar products kept per product in the table published with each artifact version
+NEIGHBOR_WEIGHTS = {'name': 1., 'description': 1., 'category': .5, 'price': .25}  # Weights of the product content features
+TRANSFORMED_DATA_PATH = os.path.join(CURRENT_DIR, '../../db/data/transformed_interactions.csv')  # Optional debug export
+EXPORT_TRANSFORMED_CSV = os.getenv('EXPORT_TRANSFORMED_CSV', 'false')
+PIPELINE_STREAMING = os.getenv('PIPELINE_STREAMING', 'false')  # Rebuild from chunks of interactions instead of mirroring the tables in memory
+PIPELINE_CHUNK_SIZE = int(os.getenv('PIPELINE_CHUNK_SIZE', 50_000))  # Interactions per chunk in streaming mode
+PIPELINE_WORKERS = int(os.getenv('PIPELINE_WORKERS', os.cpu_count() or 1))  # Processes transforming chunks in streaming mode
 TOP_K_RECOMMENDED = 5
+PROFILE_RATING_WEIGHT = 1.  # Added to an interaction's weight in its user's profile per rating point
+PROFILE_CART_WEIGHT = 1.  # ... if the product is in the cart
+PROFILE_SENTIMENT_WEIGHT = .5  # ... per summed review sentiment (-1 to 1 per review)
+FALLBACK_SIZE = 50  # Product IDs published in the popular list & in each category's trending list for cold-start users
+SIMILARITY_BLOCK_SIZE = 2 ** 24  # Max. similarity scores (float32) computed by one blocked matrix product
+COMPRESSION_METHOD = os.getenv('COMPRESSION_METHOD', '')  # Reduce the published vectors with "pca" or "random" projection (none if empty)
+COMPRESSION_DIM = int(os.getenv('COMPRESSION_DIM', 128))
+QUANTIZATION = os.getenv('QUANTIZATION', 'float32')  # Storage type of the published vectors: "float32", "float16" or "int8"
 EMBEDDER_NAME = 'all-MiniLM-L6-v2'
 
 # Misc
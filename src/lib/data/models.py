@@ -1,5 +1,6 @@
 from typing import List
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
+from src.lib.data.constants import TOP_K_RECOMMENDED
 
 class ReviewAnalystInput(BaseModel):
     """Model for accepting required input for the Review Analyst"""
@@ -11,5 +12,10 @@ class ChatbotInput(BaseModel):
     content: str
     conversation: List = []
 
+class RecommenderBatchInput(BaseModel):
+    """Model for accepting the usernames to recommend products for"""
+    usernames: List[str]
+    top_k: int = Field(TOP_K_RECOMMENDED, gt=0)
+
 class ProductRaterInput(BaseModel):
     ...
\ No newline at end of file
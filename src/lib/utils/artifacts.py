@@ -0,0 +1,189 @@
+from time import time_ns
+from typing import Any, Dict, List, NamedTuple, Optional, Sequence, Tuple
+import os, json, pickle, shutil, numpy as np
+
+class FeatureStore(NamedTuple):
+    """Versioned bundle of user profiles & item vectors published by the recommendation pipeline"""
+    version: str
+    columns: List[str]  # Features of the vectors
+    usernames: List[str]  # Username of each user vector
+    user_vectors: np.ndarray  # Memory-mapped matrix with one (L2-normalized, possibly compressed) profile per user
+    product_ids: np.ndarray  # Product ID of each item vector
+    item_vectors: np.ndarray  # Memory-mapped matrix with one (L2-normalized, possibly compressed) vector per product
+    recommendations: Dict[str, List[int]] = {}  # Precomputed top product IDs per username
+    recommendations_k: int = 0  # Number of products precomputed per username
+    preprocessing: Dict[str, Any] = {}  # Fitted transformers, e.g., {'scalers': {column: StandardScaler}, 'encoders': {column: LabelEncoder}}
+    popular: List[int] = []  # Most popular product IDs, for cold-start users
+    trending: Dict[str, List[int]] = {}  # Most popular product IDs per category (all-time, see `rank_popular`)
+    user_weights: List[float] = []  # Total signal weight of each user's interactions, to fold new signals into the profiles online
+    interaction_keys: np.ndarray = np.zeros(0, dtype=np.int64)  # Memory-mapped, sorted `user row * len(product_ids) + item row` of each interaction
+    interaction_weights: np.ndarray = np.zeros(0, dtype=np.float32)  # Memory-mapped signal weight of each interaction, replaced when folding its changes online
+
+
+# Layout: `<root>/<version>/{users.npy, items.npy, manifest.json, preprocessing.pkl, neighbors.npz, interaction_keys.npy, interaction_weights.npy}`
+# & `<root>/current`, holding the published version
+USERS_FILE, ITEMS_FILE, MANIFEST_FILE, PREPROCESSING_FILE, CURRENT_FILE = 'users.npy', 'items.npy', 'manifest.json', 'preprocessing.pkl', 'current'
+NEIGHBORS_FILE, INTERACTION_KEYS_FILE, INTERACTION_WEIGHTS_FILE = 'neighbors.npz', 'interaction_keys.npy', 'interaction_weights.npy'
+
+
+def _write_atomically(path: str, write) -> None:
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'wb') as file: write(file)
+    os.replace(tmp_path, path)
+
+
+def _stored(vectors: np.ndarray) -> np.ndarray:
+    """Keeps quantized vectors (float16 or int8) as they are & stores anything else as float32"""
+    vectors = np.asarray(vectors)
+    return vectors if vectors.dtype in (np.float16, np.int8) else vectors.astype(np.float32, copy=False)
+
+
+def list_versions(root: str) -> List[str]:
+    """Returns the published versions, oldest first"""
+    if not os.path.isdir(root): return []
+    return sorted((name for name in os.listdir(root) if name.isdigit()), key=int)
+
+
+def current_version(root: str) -> Optional[str]:
+    """Returns the version the `current` pointer refers to (`None` if nothing was published)"""
+    try:
+        with open(os.path.join(root, CURRENT_FILE)) as file: return file.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+def create_staging(root: str, synced_at: Optional[int] = None) -> Tuple[str, str]:
+    """
+    Creates the staging directory of a new version, where the pipeline may keep scratch files (e.g., a memory-mapped
+    matrix filled chunk by chunk) until `publish_feature_store`. The version is the time (in ns) the pipeline read the
+    data it holds (`synced_at`, by default now), so readers know which changes it already includes. Returns the version
+    & the directory.
+    """
+    version = str(synced_at or time_ns())
+    os.makedirs(staging_dir := os.path.join(root, f'{version}.tmp'))
+    return version, staging_dir
+
+
+def publish_feature_store(
+        root: str,
+        version: str,
+        columns: Sequence[str],
+        usernames: Sequence[str],
+        user_vectors: np.ndarray,
+        product_ids: Sequence[int],
+        item_vectors: np.ndarray,
+        recommendations: Optional[Dict[str, List[int]]] = None,
+        recommendations_k: int = 0,
+        preprocessing: Optional[Dict[str, Any]] = None,
+        popular: Optional[List[int]] = None,
+        trending: Optional[Dict[str, List[int]]] = None,
+        user_weights: Optional[Sequence[float]] = None,
+        interaction_weights: Optional[Tuple[np.ndarray, np.ndarray, np.ndarray]] = None,
+        neighbors: Optional[Tuple[np.ndarray, np.ndarray]] = None,
+        keep: int = 3,
+        pinned: Sequence[str] = ()
+    ) -> str:
+    """
+    Completes the version staged by `create_staging` with the user & item matrices, their metadata (the sidecar index of
+    usernames & product IDs with the `user_weights` of the profiles, the lookup table of precomputed
+    top-`recommendations_k` recommendations, plus the `popular` & per-category `trending` fallback lists), the fitted
+    `preprocessing` transformers & the table of similar products (`neighbors`, see `NeighborIndex.table`), plus the
+    `interaction_weights` summed into the profiles (the user rows, item rows & weight of each interaction, kept out of
+    the manifest in memory-mapped sidecars so readers don't parse them), then publishes it: the staging directory is
+    renamed to the version & the `current` pointer is replaced last, so readers never see a partial bundle. Only the
+    latest `keep` versions are retained (for readers that still use a previous one) along with the `pinned` ones, which
+    readers may load by version at any time; staging directories left by crashed publishes are deleted. Returns the
+    published version.
+    """
+    staging_dir = os.path.join(root, f'{version}.tmp')
+    np.save(os.path.join(staging_dir, USERS_FILE), _stored(user_vectors))
+    np.save(os.path.join(staging_dir, ITEMS_FILE), _stored(item_vectors))
+    manifest = {
+        'version': version,
+        'columns': [str(col) for col in columns],
+        'usernames': [str(username) for username in usernames],
+        'user_weights': [float(weight) for weight in (user_weights if user_weights is not None else [])],
+        'product_ids': [int(product_id) for product_id in product_ids],
+        'recommendations': {'top_k': recommendations_k, 'products': recommendations or {}},
+        'fallbacks': {'popular': [int(p) for p in popular or []], 'trending': {str(c): [int(p) for p in ids] for c, ids in (trending or {}).items()}}
+    }
+    with open(os.path.join(staging_dir, MANIFEST_FILE), 'w') as file: json.dump(manifest, file)
+    with open(os.path.join(staging_dir, PREPROCESSING_FILE), 'wb') as file: pickle.dump(preprocessing or {}, file)
+    if interaction_weights is not None:
+        user_rows, item_rows, weights = (np.asarray(values) for values in interaction_weights)
+        keys, inverse = np.unique(user_rows.astype(np.int64) * len(product_ids) + item_rows, return_inverse=True)
+        np.save(os.path.join(staging_dir, INTERACTION_KEYS_FILE), keys)
+        np.save(os.path.join(staging_dir, INTERACTION_WEIGHTS_FILE), np.bincount(inverse.ravel(), weights, minlength=len(keys)).astype(np.float32))
+    if neighbors is not None:
+        table_ids, neighbor_ids = (np.asarray(ids, dtype=np.int32) for ids in neighbors)  # Compact for the API
+        np.savez(os.path.join(staging_dir, NEIGHBORS_FILE), product_ids=table_ids, neighbors=neighbor_ids)
+    os.replace(staging_dir, os.path.join(root, version))
+    _write_atomically(os.path.join(root, CURRENT_FILE), lambda file: file.write(version.encode()))
+
+    for old_version in list_versions(root)[:-keep]:
+        if old_version in pinned: continue
+        shutil.rmtree(os.path.join(root, old_version), ignore_errors=True)
+    for name in os.listdir(root):  # Staging directories (& their scratch files) left by crashed publishes
+        if name.endswith('.tmp') and os.path.isdir(path := os.path.join(root, name)): shutil.rmtree(path, ignore_errors=True)
+    return version
+
+
+def save_feature_store(
+        root: str,
+        columns: Sequence[str],
+        usernames: Sequence[str],
+        user_vectors: np.ndarray,
+        product_ids: Sequence[int],
+        item_vectors: np.ndarray,
+        recommendations: Optional[Dict[str, List[int]]] = None,
+        recommendations_k: int = 0,
+        preprocessing: Optional[Dict[str, Any]] = None,
+        popular: Optional[List[int]] = None,
+        trending: Optional[Dict[str, List[int]]] = None,
+        user_weights: Optional[Sequence[float]] = None,
+        interaction_weights: Optional[Tuple[np.ndarray, np.ndarray, np.ndarray]] = None,
+        neighbors: Optional[Tuple[np.ndarray, np.ndarray]] = None,
+        keep: int = 3,
+        pinned: Sequence[str] = (),
+        synced_at: Optional[int] = None
+    ) -> str:
+    """Stages (see `create_staging`) & publishes a new version in one step (see `publish_feature_store`), returning the published version"""
+    version = create_staging(root, synced_at)[0]
+    return publish_feature_store(
+        root, version, columns, usernames, user_vectors, product_ids, item_vectors, recommendations, recommendations_k, preprocessing,
+        popular, trending, user_weights, interaction_weights, neighbors, keep, pinned
+    )
+
+
+def load_feature_store(root: str, version: Optional[str] = None) -> Optional[FeatureStore]:
+    """
+    Opens a published version (by default the current one) without reading the matrices into memory (`None` if nothing
+    was published). Raises `FileNotFoundError` if a pinned version is not retained.
+    """
+    if (version := version or current_version(root)) is None: return None
+    bundle_dir = os.path.join(root, version)
+    with open(os.path.join(bundle_dir, MANIFEST_FILE)) as file: manifest = json.load(file)
+    with open(os.path.join(bundle_dir, PREPROCESSING_FILE), 'rb') as file: preprocessing = pickle.load(file)
+    user_vectors, item_vectors = (np.load(os.path.join(bundle_dir, name), mmap_mode='r') for name in (USERS_FILE, ITEMS_FILE))
+    if os.path.exists(os.path.join(bundle_dir, INTERACTION_KEYS_FILE)):
+        interactions = tuple(np.load(os.path.join(bundle_dir, name), mmap_mode='r') for name in (INTERACTION_KEYS_FILE, INTERACTION_WEIGHTS_FILE))
+    else:
+        interactions = (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32))
+    recommendations, fallbacks = manifest.get('recommendations', {}), manifest.get('fallbacks', {})
+    return FeatureStore(
+        manifest['version'], manifest['columns'], manifest['usernames'], user_vectors, np.asarray(manifest['product_ids']), item_vectors,
+        recommendations.get('products', {}), recommendations.get('top_k', 0), preprocessing,
+        fallbacks.get('popular', []), fallbacks.get('trending', {}), manifest.get('user_weights', []), *interactions
+    )
+
+
+def load_neighbors(root: str, version: Optional[str] = None) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+    """
+    Reads the product IDs & the (-1 padded) IDs of their most similar products from a published version (by default
+    the current one); `None` if nothing was published or the version has no table.
+    """
+    if (version := version or current_version(root)) is None: return None
+    try:
+        with np.load(os.path.join(root, version, NEIGHBORS_FILE)) as file: return file['product_ids'], file['neighbors']
+    except FileNotFoundError:
+        return None
@@ -0,0 +1,205 @@
+from collections import OrderedDict
+from hashlib import sha256
+from langchain_core.embeddings import Embeddings
+from threading import Lock
+from time import monotonic
+from typing import Any, Dict, Hashable, Iterable, List, Optional, Tuple
+import os, re, sqlite3, numpy as np
+
+def normalize_text(text: str) -> str:
+    """Lowercases the text & collapses its whitespace so trivially different strings share cache keys"""
+    return re.sub(r'\s+', ' ', text).strip().lower()
+
+
+class LRUCache:
+    """Thread-safe, bounded least-recently-used cache whose entries optionally expire after `ttl` seconds"""
+    def __init__(self, max_size: int, ttl: Optional[float] = None) -> None:
+        self.max_size, self.ttl = max_size, ttl
+        self._entries: OrderedDict[Hashable, Tuple[Any, Optional[float]]] = OrderedDict()
+        self._lock = Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        """Returns the cached value (marking it as recently used) or `default` if it is absent or expired"""
+        with self._lock:
+            if key not in self._entries: return default
+            value, expires_at = self._entries[key]
+            if expires_at is not None and expires_at < monotonic():
+                del self._entries[key]
+                return default
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key: Hashable, value: Any) -> None:
+        """Caches a value, evicting the least recently used entry when full"""
+        with self._lock:
+            expires_at = monotonic() + self.ttl if self.ttl is not None else None
+            self._entries[key] = (value, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+
+class CachedEmbeddings(Embeddings):
+    """
+    Wraps an embedding model so the same text is never embedded twice. Vectors are keyed by the model's name & the
+    hash of the normalized text, kept in a bounded in-memory LRU and, if `persist_path` is given, in an SQLite file that is shared
+    by every process (e.g., the API server & the vectorstore build script).
+    """
+    def __init__(self, embedder: Embeddings, max_size: int, persist_path: Optional[str] = None) -> None:
+        self.embedder, self.persist_path = embedder, persist_path
+        self.model_name = str(getattr(embedder, 'model', type(embedder).__name__))
+        self._memory = LRUCache(max_size)
+        self._db: Optional[sqlite3.Connection] = None
+        self._db_lock = Lock()
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._embed([text], 'query')[0].tolist()
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return [vector.tolist() for vector in self._embed(texts, 'document')]
+
+    def embed_documents_array(self, texts: List[str]) -> np.ndarray:
+        """Same as `embed_documents` but returns a float32 matrix, skipping the conversion to lists"""
+        vectors = self._embed(texts or [''], 'document')  # The (cached) empty text gives no texts the model's width
+        return np.stack(vectors)[:len(texts)]
+
+    def _embed(self, texts: List[str], kind: str) -> List[np.ndarray]:
+        """Embeds only the texts missing from both cache levels (queries & documents may be embedded differently)"""
+        model = f'{self.model_name}:{kind}'
+        keys = [sha256(normalize_text(text).encode()).hexdigest() for text in texts]
+        found = {key: vector for key in set(keys) if (vector := self._memory.get((model, key))) is not None}
+
+        if missing := [key for key in dict.fromkeys(keys) if key not in found]:
+            stored = self._load(model, missing)
+            for key, vector in stored.items(): self._memory.set((model, key), vector)
+            found.update(stored)
+
+        if missing := {key: text for key, text in zip(keys, texts) if key not in found}:
+            if kind == 'query': vectors = [self.embedder.embed_query(text) for text in missing.values()]
+            else: vectors = self.embedder.embed_documents(list(missing.values()))
+            computed = {key: np.asarray(vector, dtype=np.float32) for key, vector in zip(missing, vectors)}
+            for key, vector in computed.items(): self._memory.set((model, key), vector)
+            self._save(model, computed)
+            found.update(computed)
+
+        return [found[key] for key in keys]
+
+    def _connect(self) -> Optional[sqlite3.Connection]:
+        """Must be called while holding the DB lock; lazily opens the on-disk cache"""
+        if self.persist_path and self._db is None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.persist_path)), exist_ok=True)
+            self._db = sqlite3.connect(self.persist_path, timeout=30, check_same_thread=False)
+            self._db.execute('CREATE TABLE IF NOT EXISTS embeddings (model TEXT, key TEXT, vector BLOB, PRIMARY KEY (model, key))')
+        return self._db
+
+    def _load(self, model: str, keys: List[str]) -> Dict[str, np.ndarray]:
+        with self._db_lock:
+            if (db := self._connect()) is None: return {}
+            result = {}
+            for i in range(0, len(keys), 500):  # Stay below SQLite's limit of bound parameters
+                batch = keys[i:i+500]
+                rows = db.execute(
+                    f'SELECT key, vector FROM embeddings WHERE model = ? AND key IN ({",".join("?" * len(batch))})',
+                    [model, *batch]
+                )
+                result.update({key: np.frombuffer(vector, dtype=np.float32) for key, vector in rows})
+            return result
+
+    def _save(self, model: str, vectors: Dict[str, np.ndarray]) -> None:
+        with self._db_lock:
+            if (db := self._connect()) is None: return
+            with db:
+                db.executemany(
+                    'INSERT OR REPLACE INTO embeddings (model, key, vector) VALUES (?, ?, ?)',
+                    [(model, key, vector.tobytes()) for key, vector in vectors.items()]
+                )
+
+
+class SemanticCache:
+    """
+    Thread-safe cache that answers near-duplicate questions: a prompt hits an entry when the cosine similarity of their
+    embeddings is >= `threshold`. Learned entries expire after `ttl` seconds & are evicted least-recently-used, whereas
+    seeded entries (e.g., FAQs) are pinned. Seeds are embedded lazily, so an unreachable embedder only delays them.
+    """
+    def __init__(self, embedder: Embeddings, threshold: float, max_size: int, ttl: Optional[float] = None) -> None:
+        self.embedder, self.threshold, self.max_size, self.ttl = embedder, threshold, max_size, ttl
+        self._entries: OrderedDict[str, Tuple[np.ndarray, str, Optional[float]]] = OrderedDict()  # question -> (unit vector, answer, expiry)
+        self._pending_seeds: List[Tuple[str, str]] = []
+        self._matrix: Optional[Tuple[List[str], np.ndarray]] = None
+        self._lock = Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def seed(self, pairs: Iterable[Tuple[str, str]]) -> None:
+        """Queues canonical (question, answer) pairs to be pinned in the cache"""
+        with self._lock:
+            self._pending_seeds.extend(pairs)
+
+    def lookup(self, prompt: str, pinned_only: bool = False) -> Optional[str]:
+        """Returns the answer of the most similar cached question, if any is similar enough"""
+        self._embed_pending_seeds()
+        query = self._embed(prompt)
+        now = monotonic()
+        with self._lock:
+            self._evict_expired(now)
+            if not self._entries: return None
+            questions, matrix = self._get_matrix()
+            scores = matrix @ query
+            if pinned_only:
+                scores = np.where([self._entries[q][2] is None for q in questions], scores, -1)
+            best = int(np.argmax(scores))
+            if scores[best] < self.threshold: return None
+            self._entries.move_to_end(questions[best])
+            return self._entries[questions[best]][1]
+
+    def store(self, prompt: str, answer: str) -> None:
+        """Caches an answer that can be shared with anyone asking a similar question"""
+        question, vector = normalize_text(prompt), self._embed(prompt)
+        with self._lock:
+            if question in self._entries and self._entries[question][2] is None: return  # Never override pinned answers
+            self._put(question, vector, answer, monotonic() + self.ttl if self.ttl is not None else float('inf'))
+
+    def _embed(self, text: str) -> np.ndarray:
+        return self._unit(np.asarray(self.embedder.embed_query(normalize_text(text)), dtype=np.float32))
+
+    def _embed_pending_seeds(self) -> None:
+        with self._lock:
+            seeds, self._pending_seeds = self._pending_seeds, []
+        if not seeds: return
+        try:
+            vectors = [self._embed(question) for question, _ in seeds]  # Same (query) path as the prompts they must match
+        except Exception:
+            with self._lock: self._pending_seeds = seeds + self._pending_seeds  # Retry on the next lookup
+            raise
+        with self._lock:
+            for (question, answer), vector in zip(seeds, vectors):
+                self._put(normalize_text(question), vector, answer, None)
+
+    def _put(self, question: str, vector: np.ndarray, answer: str, expires_at: Optional[float]) -> None:
+        """Must be called while holding the lock; `expires_at=None` pins the entry"""
+        self._entries[question] = (vector, answer, expires_at)
+        self._entries.move_to_end(question)
+        self._matrix = None
+        learned = [q for q, entry in self._entries.items() if entry[2] is not None]
+        for q in learned[:max(len(learned) - self.max_size, 0)]:
+            del self._entries[q]
+
+    def _evict_expired(self, now: float) -> None:
+        expired = [q for q, (_, _, expires_at) in self._entries.items() if expires_at is not None and expires_at < now]
+        for q in expired: del self._entries[q]
+        if expired: self._matrix = None
+
+    def _get_matrix(self) -> Tuple[List[str], np.ndarray]:
+        if self._matrix is None:
+            questions = list(self._entries)
+            self._matrix = (questions, np.stack([self._entries[q][0] for q in questions]))
+        return self._matrix
+
+    @staticmethod
+    def _unit(vector: np.ndarray) -> np.ndarray:
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
\ No newline at end of file
@@ -1,4 +1,5 @@
-from sqlalchemy import func, select, desc
+from sqlalchemy import func, select, desc, tuple_
+from sqlalchemy.dialects.postgresql import aggregate_order_by
 from sqlalchemy.orm import Session as _SessionType
 from datasketch import MinHash, MinHashLSH
 from typing import Callable, Any, List, Union, Tuple, Dict
@@ -7,15 +8,22 @@ from difflib import SequenceMatcher
 from hashlib import sha256
 import bcrypt, re
 from src.lib.utils.logger import log, err_log
+from src.lib.utils.events import LocalEventBus, PostgresEventBus, track_changes
+from src.lib.data.constants import EVENT_BACKEND, EVENT_CHANNEL
 from src.server.models.review_analyst import review_analyst, SentimentInt
 from src.lib.data.db import (
-    Session,
+    engine, Session,
     UserData, User, 
     ProductData, Product, 
     InteractionData, Interaction,
     Credentials, SecuredCredentials, UsernameTaken, WrongCredentials, NotOwner, NonExistent
 )
 
+# Every committed write of a user, product or interaction is published on this bus (creating it opens no connection;
+# the Postgres listener only starts on the first `subscribe`, so processes that only write never hold a LISTEN connection)
+change_bus = PostgresEventBus(engine, EVENT_CHANNEL) if EVENT_BACKEND == 'postgres' else LocalEventBus()
+track_changes(Session, change_bus)
+
 # Helpers
 def exc_handler(func: Callable[..., Any]) -> Callable[..., Any]:
     """Captures DB exceptions and returns their messages to be transmitted from the API server"""
@@ -141,10 +149,7 @@ def get_all_users(**filter_kwargs) -> List[UserData]:
 
 
 def _account_exists(cred: Credentials, *, session: _SessionType) -> Union[User, bool]:
-    users = _get_all_users(session=session)
-    for user in users:
-        if cred.username == user.username: return user
-    return False
+    return session.get(User, cred.username) or False  # Primary key lookup
 
 def account_exists(cred: Credentials) -> Union[UserData, bool]:
     """Checks if a user account was already created"""
@@ -155,6 +160,18 @@ def account_exists(cred: Credentials) -> Union[UserData, bool]:
     return result
 
 
+def _existing_usernames(usernames: List[str], *, session: _SessionType) -> List[str]:
+    existing = {username for username, in session.query(User.username).filter(User.username.in_(usernames))}
+    return [username for username in dict.fromkeys(usernames) if username in existing]
+
+def existing_usernames(usernames: List[str]) -> List[str]:
+    """Returns the given usernames that have an account using a single query (in order, without duplicates)"""
+    session = Session()
+    result = _existing_usernames(usernames, session=session)
+    end_session(session, commit=False)
+    return result
+
+
 
 def _log_in_account(cred: Credentials, *, session: _SessionType) -> User:
     account = _account_exists(cred, session=session)
@@ -247,6 +264,27 @@ def get_user_info(username: str) -> Dict[str, Union[str, List[ProductData]]]:
 
 
 
+def _get_users_info(usernames: List[str], *, session: _SessionType) -> List[Dict[str, Union[str, List[str]]]]:
+    owned_product_names = func.array_remove(func.array_agg(aggregate_order_by(Product.name, Product.product_id)), None)
+    rows = (
+        session.query(User.username, User.bio, owned_product_names)
+        .outerjoin(Product, Product.owner == User.username)
+        .filter(User.username.in_(usernames))
+        .group_by(User.username, User.bio)
+        .all()
+    )
+    infos = {username: {'username': username, 'bio': bio, 'owned_product_names': names} for username, bio, names in rows}
+    return [infos[username] for username in dict.fromkeys(usernames) if username in infos]
+
+def get_users_info(usernames: List[str]) -> List[Dict[str, Union[str, List[str]]]]:
+    """Returns the info & owned product names of many users using a single query (in the order of `usernames`, skipping non-existent users)"""
+    session = Session()
+    result = _get_users_info(usernames, session=session)
+    end_session(session, commit=False)
+    return result
+
+
+
 def _search_users(search_query: str, similarity_threshold: int = 0.6, *, session: _SessionType) -> List[User]:
     similarity = lambda username: SequenceMatcher(None, username, search_query).ratio()  # Algorithm for computing similarity scores
 
@@ -284,12 +322,23 @@ def get_all_products(**filter_kwargs) -> List[ProductData]:
 
 
 
+def _get_products_by_ids(product_ids: List[int], *, session: _SessionType) -> List[Product]:
+    products = {p.product_id: p for p in session.query(Product).filter(Product.product_id.in_(set(product_ids))).all()} if product_ids else {}
+    return [products[product_id] for product_id in dict.fromkeys(product_ids) if product_id in products]
+
+def get_products_by_ids(product_ids: List[int]) -> List[ProductData]:
+    """Returns many products using a single query (in the order of `product_ids`, skipping non-existent products)"""
+    session = Session()
+    result = _get_products_by_ids(product_ids, session=session)
+    result = _list_detach(result)
+    end_session(session, commit=False)
+    return result
+
+
+
 def _get_product_using_id(product_id: int, *, session: _SessionType) -> Product:
-    products = _get_all_products(session=session)
-    for product in products:
-        if product_id == product.product_id:
-            return product
-    raise NonExistent('product', product_id)
+    if (product := session.get(Product, product_id)) is None: raise NonExistent('product', product_id)
+    return product
 
 def get_product_using_id(product_id: int) -> ProductData:
     """Returns a product using its ID if it exists"""
@@ -450,6 +499,19 @@ def get_all_interactions(**filter_kwargs) -> List[InteractionData]:
 
 
 
+def _get_interactions_by_keys(keys: List[Tuple[str, int]], *, session: _SessionType) -> List[Interaction]:
+    return session.query(Interaction).filter(tuple_(Interaction.username, Interaction.product_id).in_(set(keys))).all() if keys else []
+
+def get_interactions_by_keys(keys: List[Tuple[str, int]]) -> List[InteractionData]:
+    """Returns the interactions with the given (username, product ID) keys using a single query, skipping non-existent ones"""
+    session = Session()
+    result = _get_interactions_by_keys(keys, session=session)
+    result = _list_detach(result)
+    end_session(session, commit=False)
+    return result
+
+
+
 def _update_interaction(cred: Credentials, product_id: int, updater: Callable[[Interaction, Dict], None], *, session: _SessionType) -> bool:
     account = _log_in_account(cred, session=session)
     _get_product_using_id(product_id, session=session)
@@ -630,11 +692,9 @@ def get_raters_of_product(product_id: int) -> List[str]:
 
 def _get_most_rated_products(k: int = 3, *, session: _SessionType) -> List[Product]:
     stmt = select(Interaction).order_by(desc(Interaction.rating)).limit(k)
-    interactions = session.execute(stmt).scalars().all()
-    return [
-        session.query(Product).filter_by(product_id=interaction.product_id)[0]
-        for interaction in interactions
-    ]
+    product_ids = [interaction.product_id for interaction in session.execute(stmt).scalars().all()]
+    products = {p.product_id: p for p in _get_products_by_ids(product_ids, session=session)}
+    return [products[product_id] for product_id in product_ids if product_id in products]
 
 def get_most_rated_products(k: int = 3) -> List[ProductData]:
     """Returns the top `k` most rated products"""
@@ -645,15 +705,31 @@ def get_most_rated_products(k: int = 3) -> List[ProductData]:
     return result
 
 
+def _get_category_affinities(usernames: List[str], *, session: _SessionType) -> Dict[str, List[str]]:
+    stmt = (
+        select(Interaction.username, Product.category)
+        .join(Product, Product.product_id == Interaction.product_id)
+        .where(Interaction.username.in_(usernames))
+        .group_by(Interaction.username, Product.category)
+        .order_by(Interaction.username, desc(func.count()), Product.category)
+    )
+    affinities = {username: [] for username in usernames}
+    for username, category in session.execute(stmt): affinities[username].append(category)
+    return affinities
+
+def get_category_affinities(usernames: List[str]) -> Dict[str, List[str]]:
+    """Returns the categories each user interacted with, most interacted first, using a single grouped query"""
+    session = Session()
+    result = _get_category_affinities(list(dict.fromkeys(usernames)), session=session)
+    end_session(session, commit=False)
+    return result
+
+
 
 def _get_cart(cred: Credentials, *, session: _SessionType) -> List[Product]:
-    if log_in_account(cred):
-        interactions = _get_all_interactions(username=cred.username, session=session)
-        return [
-            _get_product_using_id(interaction.product_id, session=session) 
-            for interaction in interactions 
-            if interaction.in_cart
-        ]
+    if _log_in_account(cred, session=session):
+        interactions = _get_all_interactions(username=cred.username, in_cart=True, session=session)
+        return _get_products_by_ids([interaction.product_id for interaction in interactions], session=session)
 
 def get_cart(cred: Credentials) -> List[ProductData]:
     """Returns the user's cart"""
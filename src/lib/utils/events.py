@@ -0,0 +1,146 @@
+from sqlalchemy import event, inspect, text
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session as _SessionType, sessionmaker
+from threading import Condition, Lock, Thread
+from time import monotonic, sleep
+from typing import Any, Callable, Dict, List, NamedTuple, Optional
+import json, select
+from src.lib.utils.logger import err_log
+
+class ChangeEvent(NamedTuple):
+    """A committed insert, update or delete of one row"""
+    table: str
+    op: str  # "insert", "update" or "delete"
+    keys: Dict[str, Any]  # Primary key of the row
+
+    def to_json(self) -> str:
+        return json.dumps(self._asdict())
+
+    @staticmethod
+    def from_json(payload: str) -> 'ChangeEvent':
+        return ChangeEvent(**json.loads(payload))
+
+
+class LocalEventBus:
+    """In-process event bus: events of a session are delivered to the subscribers once it commits"""
+    def __init__(self) -> None:
+        self._subscribers: List[Callable[[ChangeEvent], None]] = []
+        self._lock = Lock()
+
+    def subscribe(self, callback: Callable[[ChangeEvent], None]) -> None:
+        with self._lock: self._subscribers.append(callback)
+
+    def publish(self, events: List[ChangeEvent], session: _SessionType) -> None:
+        """Called after a flush (inside the session's transaction)"""
+        session.info.setdefault('change_events', []).extend(events)
+
+    def on_commit(self, session: _SessionType) -> None:
+        self._dispatch(session.info.pop('change_events', []))
+
+    def on_rollback(self, session: _SessionType) -> None:
+        session.info.pop('change_events', None)
+
+    def _dispatch(self, events: List[ChangeEvent]) -> None:
+        with self._lock: subscribers = list(self._subscribers)
+        for change in events:
+            for callback in subscribers:
+                try:
+                    callback(change)
+                except Exception as e:
+                    err_log('LocalEventBus._dispatch', e, 'db')
+
+
+class PostgresEventBus(LocalEventBus):
+    """
+    Cross-process event bus over Postgres `LISTEN/NOTIFY`. Notifications are sent within the writing transaction, so
+    Postgres only delivers them if it commits; subscribing starts a listener thread that dispatches them in this process.
+    """
+    def __init__(self, engine: Engine, channel: str) -> None:
+        super().__init__()
+        self.engine, self.channel = engine, channel
+        self._listener: Optional[Thread] = None
+
+    def subscribe(self, callback: Callable[[ChangeEvent], None]) -> None:
+        super().subscribe(callback)
+        with self._lock:
+            if self._listener is None:
+                self._listener = Thread(target=self._listen, daemon=True)
+                self._listener.start()
+
+    def publish(self, events: List[ChangeEvent], session: _SessionType) -> None:
+        for change in events:
+            session.connection().execute(text('SELECT pg_notify(:channel, :payload)'), {'channel': self.channel, 'payload': change.to_json()})
+
+    def on_commit(self, session: _SessionType) -> None:
+        pass  # Delivered by Postgres
+
+    def _listen(self) -> None:
+        while True:
+            try:
+                raw_connection = self.engine.raw_connection()
+                raw_connection.detach()  # Closed for good instead of returned to the pool while still listening
+                try:
+                    connection = raw_connection.driver_connection
+                    connection.autocommit = True
+                    connection.cursor().execute(f'LISTEN "{self.channel}"')
+                    while True:
+                        if select.select([connection], [], [], 5) == ([], [], []): continue
+                        connection.poll()
+                        events = [ChangeEvent.from_json(notify.payload) for notify in connection.notifies]
+                        connection.notifies.clear()
+                        self._dispatch(events)
+                finally:
+                    raw_connection.close()
+            except Exception as e:
+                err_log('PostgresEventBus._listen', e, 'db')
+                sleep(1)  # Reconnect after a pause
+
+
+def track_changes(session_factory: sessionmaker, bus: LocalEventBus) -> None:
+    """Publishes a `ChangeEvent` for every row that sessions of the factory insert, update or delete"""
+    def _after_flush(session: _SessionType, _) -> None:
+        events = []
+        for op, objs in (('insert', session.new), ('update', session.dirty), ('delete', session.deleted)):
+            for obj in objs:
+                if op == 'update' and not session.is_modified(obj): continue
+                mapper = inspect(obj).mapper
+                keys = {col.key: getattr(obj, mapper.get_property_by_column(col).key) for col in mapper.primary_key}
+                events.append(ChangeEvent(mapper.local_table.name, op, keys))
+        if events: bus.publish(events, session)
+
+    event.listen(session_factory, 'after_flush', _after_flush)
+    event.listen(session_factory, 'after_commit', bus.on_commit)
+    event.listen(session_factory, 'after_soft_rollback', lambda session, _: bus.on_rollback(session))
+
+
+class Debouncer:
+    """
+    Coalesces bursts of events into one run: `wait` returns once events stopped arriving for `quiet` seconds, events
+    have been pending for `max_delay` seconds, or `max_staleness` seconds passed since the last run (a safety net
+    for missed events).
+    """
+    def __init__(self, quiet: float, max_delay: float, max_staleness: float) -> None:
+        self.quiet, self.max_delay, self.max_staleness = quiet, max_delay, max_staleness
+        self._cond = Condition()
+        self._first: Optional[float] = None  # Arrival of the oldest pending event
+        self._last: Optional[float] = None  # Arrival of the latest pending event
+        self.n_pending = 0
+
+    def notify(self, *_) -> None:
+        with self._cond:
+            now = monotonic()
+            self._first, self._last = self._first or now, now
+            self.n_pending += 1
+            self._cond.notify_all()
+
+    def wait(self) -> int:
+        """Blocks until the next run is due & returns the number of events it covers"""
+        deadline = monotonic() + self.max_staleness
+        with self._cond:
+            while True:
+                now = monotonic()
+                due = deadline if self._first is None else min(deadline, self._last + self.quiet, self._first + self.max_delay)
+                if now >= due: break
+                self._cond.wait(due - now)
+            n_events, self.n_pending, self._first, self._last = self.n_pending, 0, None, None
+            return n_events
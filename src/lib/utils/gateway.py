@@ -0,0 +1,229 @@
+from concurrent.futures import Future
+from contextlib import contextmanager
+from enum import IntEnum
+from heapq import heappush, heappop
+from itertools import count
+from langchain_core.embeddings import Embeddings
+from threading import Condition, Event, Lock, Thread
+from time import perf_counter
+from typing import Any, Callable, Dict, Hashable, Iterator, List, Optional, Tuple
+
+class Priority(IntEnum):
+    """Queueing priority of LLM calls (lower runs first)"""
+    INTERACTIVE = 0  # A user is waiting for the result (e.g., chat)
+    DEFAULT = 1
+    BACKGROUND = 2  # Nobody is actively waiting (e.g., review sentiment, data generation)
+
+
+class _Lane:
+    """Priority semaphore limiting the in-flight requests of one lane, along with its queue & latency metrics"""
+    def __init__(self, limit: int) -> None:
+        self.limit = limit
+        self._cond = Condition()
+        self._waiting: List[Tuple[int, int]] = []  # Heap of (priority, arrival) tickets
+        self._arrivals = count()
+        self.in_flight = self.completed = self.coalesced = self.max_queued = 0
+        self.total_wait = self.total_latency = 0.
+
+    @contextmanager
+    def slot(self, priority: int) -> Iterator[None]:
+        """Blocks until it's the caller's turn (by priority, then arrival) & a slot is free"""
+        enqueued = perf_counter()
+        with self._cond:
+            ticket = (int(priority), next(self._arrivals))
+            heappush(self._waiting, ticket)
+            self.max_queued = max(self.max_queued, len(self._waiting))
+            self._cond.notify_all()  # For `wait_queued`
+            while self._waiting[0] != ticket or self.in_flight >= self.limit:
+                self._cond.wait()
+            heappop(self._waiting)
+            self.in_flight += 1
+            self.total_wait += perf_counter() - enqueued
+            self._cond.notify_all()  # The next ticket may also fit in a free slot
+        started = perf_counter()
+        try:
+            yield
+        finally:
+            with self._cond:
+                self.in_flight -= 1
+                self.completed += 1
+                self.total_latency += perf_counter() - started
+                self._cond.notify_all()
+
+    def wait_queued(self, n: int, timeout: Optional[float] = None) -> bool:
+        """Blocks until at least `n` callers are queued (e.g., to observe the queue), returning False on timeout"""
+        with self._cond:
+            return self._cond.wait_for(lambda: len(self._waiting) >= n, timeout)
+
+    def add_coalesced(self, n: int = 1) -> None:
+        with self._cond:
+            self.coalesced += n
+
+    def metrics(self) -> Dict[str, float]:
+        with self._cond:
+            done = max(self.completed, 1)
+            return {
+                'limit': self.limit,
+                'queued': len(self._waiting),
+                'max_queued': self.max_queued,
+                'in_flight': self.in_flight,
+                'completed': self.completed,
+                'coalesced': self.coalesced,
+                'avg_wait': self.total_wait / done,
+                'avg_latency': self.total_latency / done
+            }
+
+
+class _MicroBatcher:
+    """
+    Collects single texts for up to `window` seconds (or until `max_size` are pending) & embeds them with one call
+    on one of `n_workers` background threads. Identical texts that are pending or being embedded share one result.
+    """
+    def __init__(self, run_batch: Callable[[List[str]], List[List[float]]], window: float, max_size: int, n_workers: int = 1) -> None:
+        self.run_batch, self.window, self.max_size = run_batch, window, max_size
+        self.n_batches = 0
+        self._pending: Dict[str, Future] = {}
+        self._in_flight: Dict[str, Future] = {}
+        self._lock, self._has_items, self._full = Lock(), Event(), Event()
+        for _ in range(n_workers): Thread(target=self._work, daemon=True).start()
+
+    def submit(self, text: str) -> Tuple[Future, bool]:
+        """Returns the future embedding of the text & whether it was coalesced with an identical request"""
+        with self._lock:
+            if (future := self._pending.get(text) or self._in_flight.get(text)) is not None: return future, True
+            future = self._pending[text] = Future()
+            if len(self._pending) >= self.max_size: self._full.set()
+            self._has_items.set()
+            return future, False
+
+    def _work(self) -> None:
+        while True:
+            self._has_items.wait()
+            self._full.wait(self.window)
+            with self._lock:
+                texts = list(self._pending)[:self.max_size]
+                batch = {text: self._pending.pop(text) for text in texts}
+                self._in_flight.update(batch)
+                if len(self._pending) < self.max_size: self._full.clear()
+                if not self._pending: self._has_items.clear()
+                if not texts: continue  # Another worker took them
+                self.n_batches += 1
+            try:
+                for future, vector in zip(batch.values(), self.run_batch(texts)): future.set_result(vector)
+            except Exception as e:
+                for future in batch.values(): future.set_exception(e)
+            finally:
+                with self._lock:
+                    for text in texts: self._in_flight.pop(text, None)
+
+
+class GatewayLLM:
+    """
+    Proxy of an LLM client whose calls are queued, limited & coalesced in the lane `name` of the gateway; other attributes
+    pass through. Streams hold a slot for the whole generation, so they use a separate `<name>/stream` lane.
+    """
+    def __init__(self, gateway: 'LLMGateway', client: Any, name: str, priority: Priority) -> None:
+        self.client, self.name, self.priority, self._gateway = client, name, priority, gateway
+
+    def __getattr__(self, attr: str) -> Any:
+        if attr.startswith('_') or attr == 'client': raise AttributeError(attr)
+        return getattr(self.client, attr)
+
+    def with_priority(self, priority: Priority) -> 'GatewayLLM':
+        """Returns a proxy of the same client (sharing its lane) that queues with another priority"""
+        return GatewayLLM(self._gateway, self.client, self.name, priority)
+
+    def invoke(self, input: Any, **kwargs) -> Any:
+        key = ('invoke', repr(input), repr(sorted(kwargs.items())))
+        return self._gateway.run(self.name, key, lambda: self.client.invoke(input, **kwargs), self.priority)
+
+    def stream(self, input: Any, **kwargs) -> Iterator[Any]:
+        """Streams the output while holding a slot of the stream lane until the stream is exhausted or closed"""
+        with self._gateway.lane(f'{self.name}/stream').slot(self.priority):
+            yield from self.client.stream(input, **kwargs)
+
+
+class GatewayEmbeddings(Embeddings):
+    """Embedding model proxy whose requests are micro-batched per kind (query/document) & limited by the gateway"""
+    def __init__(self, gateway: 'LLMGateway', client: Embeddings, name: str, priority: Priority, window: float, max_batch: int) -> None:
+        self.client, self.name, self.priority, self._gateway = client, name, priority, gateway
+        n_workers = gateway.lane(name).limit
+        self._queries = _MicroBatcher(self._batch_runner(lambda texts: [client.embed_query(t) for t in texts]), window, max_batch, n_workers)
+        self._documents = _MicroBatcher(self._batch_runner(client.embed_documents), window, max_batch, n_workers)
+
+    def __getattr__(self, attr: str) -> Any:
+        if attr.startswith('_') or attr == 'client': raise AttributeError(attr)
+        return getattr(self.client, attr)
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._gather(self._queries, [text])[0]
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self._gather(self._documents, texts)
+
+    def _batch_runner(self, embed: Callable[[List[str]], List[List[float]]]) -> Callable[[List[str]], List[List[float]]]:
+        def run(texts: List[str]) -> List[List[float]]:
+            with self._gateway.lane(self.name).slot(self.priority):
+                return embed(texts)
+        return run
+
+    def _gather(self, batcher: _MicroBatcher, texts: List[str]) -> List[List[float]]:
+        submitted = [batcher.submit(text) for text in texts]
+        self._gateway.lane(self.name).add_coalesced(sum(coalesced for _, coalesced in submitted))
+        return [future.result() for future, _ in submitted]
+
+
+class LLMGateway:
+    """
+    Single entry point to the LLM backends. Each role/client (e.g., chat, condition checks, embeddings) has its own
+    lane, named when routing it, with a concurrency limit (`limits`, else `default_limit`) & a priority queue, so
+    interactive requests overtake background ones, one role can't starve another even when they share a model, &
+    identical in-flight requests are coalesced (single-flight).
+    """
+    def __init__(self, default_limit: int, limits: Optional[Dict[str, int]] = None) -> None:
+        self.default_limit, self.limits = default_limit, limits or {}
+        self._lanes: Dict[str, _Lane] = {}
+        self._in_flight: Dict[Tuple[str, Hashable], Future] = {}
+        self._lock = Lock()
+
+    def llm(self, client: Any, name: str, priority: Priority = Priority.DEFAULT) -> GatewayLLM:
+        """Routes an LLM/chat model client through the gateway in the lane `name`"""
+        return GatewayLLM(self, client, name, priority)
+
+    def embeddings(self, client: Embeddings, name: str, priority: Priority = Priority.INTERACTIVE, window: float = .01, max_batch: int = 32) -> GatewayEmbeddings:
+        """Routes an embedding model through the gateway in the lane `name`, with micro-batching"""
+        return GatewayEmbeddings(self, client, name, priority, window, max_batch)
+
+    def lane(self, name: str) -> _Lane:
+        with self._lock:
+            if name not in self._lanes: self._lanes[name] = _Lane(self.limits.get(name, self.default_limit))
+            return self._lanes[name]
+
+    def run(self, name: str, key: Hashable, call: Callable[[], Any], priority: Priority = Priority.DEFAULT) -> Any:
+        """Runs the call in the lane `name` unless an identical call (same `key`) is already in flight, whose result is then shared"""
+        lane = self.lane(name)
+        with self._lock:
+            future = self._in_flight.get((name, key))
+            is_leader = future is None
+            if is_leader: future = self._in_flight[(name, key)] = Future()
+
+        if not is_leader:
+            lane.add_coalesced()
+            return future.result()
+
+        try:
+            with lane.slot(priority):
+                result = call()
+            future.set_result(result)
+            return result
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                del self._in_flight[(name, key)]
+
+    def metrics(self) -> Dict[str, Dict[str, float]]:
+        """Returns the queue & latency metrics of each lane"""
+        with self._lock: lanes = dict(self._lanes)
+        return {name: lane.metrics() for name, lane in lanes.items()}
\ No newline at end of file
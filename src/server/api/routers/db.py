@@ -11,9 +11,11 @@ from src.lib.utils.db import (
     delete_account,
     edit_bio,
     get_user_info,
+    get_users_info,
     search_users,
     get_all_products,
     get_product_using_id,
+    get_products_by_ids,
     create_product,
     delete_product,
     update_product,
@@ -75,6 +77,12 @@ async def get_user_info_(username: str = Query()):
     return get_user_info(username.replace('%20', ' ').replace('%27', '\'').replace('[amps]', '&'))
 
 
+@account_r.get('/get_users_info')
+@exc_handler
+async def get_users_info_(usernames: List[str] = Query()) -> Union[List[Dict], str]:
+    return get_users_info([u.replace('%20', ' ').replace('%27', '\'').replace('[amps]', '&') for u in usernames])
+
+
 @account_r.get('/search_users')
 @exc_handler
 async def search_users_(search_query: str = Query(), similarity_threshold: float = Query(0.6)) -> Union[List[Dict], str]:
@@ -95,6 +103,12 @@ async def get_product_using_id_(product_id: int = Query()) -> Union[Dict, str]:
     return todict(get_product_using_id(product_id))
 
 
+@product_r.get('/get_products_by_ids')
+@exc_handler
+async def get_products_by_ids_(product_ids: List[int] = Query()) -> Union[List[Dict], str]:
+    return [todict(p) for p in get_products_by_ids(product_ids)]
+
+
 @product_r.post('/create_product')
 @exc_handler
 async def create_product_(cred: Credentials, product_info: str = '{}') -> Union[bool, str]:
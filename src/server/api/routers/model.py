@@ -1,17 +1,46 @@
-from fastapi import APIRouter
-from typing import Dict, List, Union, Any
-from src.lib.data.models import ReviewAnalystInput, ChatbotInput
+from fastapi import APIRouter, Query, Request
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse
+from typing import Dict, List, Union, Any, Iterator, AsyncIterator
+from threading import Event
+import asyncio, json
+from src.lib.data.models import ReviewAnalystInput, ChatbotInput, RecommenderBatchInput
+from src.lib.data.constants import GATEWAY, NEIGHBORS_K, TOP_K_RECOMMENDED
 from src.lib.data.db import Credentials, NonExistent
-from src.lib.utils.db import todict, account_exists
+from src.lib.utils.db import todict, account_exists, existing_usernames, change_bus
 from src.lib.utils.logger import err_log
 from src.server.models.chatbot import Chatbot
 from src.server.models.review_analyst import review_analyst, SentimentInt
-from src.server.models.recommender import recommend_products
+from src.server.models.recommender import recommender, recommend_products, recommend_products_batch, similar_products
 
 # Init & Router
 chatbot = Chatbot()
+change_bus.subscribe(recommender.on_change)  # Fold ratings, carts & reviews into the served profiles between pipeline runs
 model_r = APIRouter()
 
+# Helpers
+async def _drain_in_thread(tokens: Iterator[str], cancel: Event) -> AsyncIterator[str]:
+    """Consumes a blocking token iterator in a worker thread, closing it (and the LLM stream) as soon as `cancel` is set"""
+    loop, queue = asyncio.get_running_loop(), asyncio.Queue()
+
+    def produce() -> None:
+        try:
+            for token in tokens:
+                if cancel.is_set(): break
+                loop.call_soon_threadsafe(queue.put_nowait, token)
+        finally:
+            tokens.close()
+            loop.call_soon_threadsafe(queue.put_nowait, None)
+
+    loop.run_in_executor(None, produce)
+    while (token := await queue.get()) is not None:
+        yield token
+
+
+def _sse(data: Dict[str, str], event: str = 'message') -> str:
+    """Formats a Server-Sent Event"""
+    return f'event: {event}\ndata: {json.dumps(data)}\n\n'
+
 # Endpoints
 @model_r.post('/review_analyst')
 async def review_analyst_inference(data: ReviewAnalystInput) -> SentimentInt:
@@ -21,14 +50,55 @@ async def review_analyst_inference(data: ReviewAnalystInput) -> SentimentInt:
 async def chatbot_response(data: ChatbotInput) -> Dict[str, str]:
     return {
         'sender': 'chatbot',
-        'content': chatbot(data.content, data.sender, data.conversation)
+        'content': await run_in_threadpool(chatbot, data.content, data.sender, data.conversation)
     }
 
+@model_r.post('/chatbot/stream')
+async def chatbot_stream_response(data: ChatbotInput, request: Request) -> StreamingResponse:
+    """Streams the chatbot's response as Server-Sent Events; the generation stops when the client disconnects"""
+    cancel = Event()
+    tokens = chatbot.stream(data.content, data.sender, data.conversation)
+
+    async def events() -> AsyncIterator[str]:
+        try:
+            async for token in _drain_in_thread(tokens, cancel):
+                if await request.is_disconnected(): return
+                yield _sse({'sender': 'chatbot', 'content': token})
+            yield _sse({'sender': 'chatbot', 'content': ''}, event='end')
+        finally:
+            cancel.set()
+
+    return StreamingResponse(events(), media_type='text/event-stream')
+
+@model_r.get('/llm_metrics')
+async def llm_metrics() -> Dict[str, Dict[str, float]]:
+    """Returns the queue & latency metrics of the LLM gateway per model"""
+    return GATEWAY.metrics()
+
 @model_r.get('/recommender')
-async def recommend(username: str) -> Union[List[Dict], str]:
+async def recommend(username: str, top_k: int = Query(TOP_K_RECOMMENDED, gt=0)) -> Union[List[Dict], str]:
     if account_exists(Credentials(username=username, password='')):
-        return [todict(product) for product in recommend_products(username)]
+        return [todict(product) for product in recommend_products(username, top_k)]
     else:
         msg = f'Account with username "{username}" does not exist.'
         err_log('recommend', NonExistent('user', username), 'api')
-        return msg
\ No newline at end of file
+        return msg
+
+@model_r.post('/recommender/batch')
+async def recommend_batch(data: RecommenderBatchInput) -> Dict[str, List[Dict]]:
+    """
+    Recommends products for many users at once (users without interaction data get popular & trending products),
+    omitting the usernames without an account.
+    With `top_k` <= `TOP_K_RECOMMENDED`, users are served from the precomputed lookup table (~10 ms for 10k users).
+    Larger `top_k` (or users missing from the table) are scored on demand, bound by the matrix product: ~0.2 ms per user
+    per 1k products on one core (e.g., ~36 s for 10k users over 20k products), dividing with the cores available.
+    """
+    usernames = await run_in_threadpool(existing_usernames, data.usernames)
+    for username in set(data.usernames).difference(usernames): err_log('recommend_batch', NonExistent('user', username), 'api')
+    recommendations = await run_in_threadpool(recommend_products_batch, usernames, data.top_k)
+    return {username: [todict(product) for product in products] for username, products in recommendations.items()}
+
+@model_r.get('/similar_products')
+async def get_similar_products(product_id: int, top_k: int = Query(NEIGHBORS_K, gt=0)) -> List[Dict]:
+    """Returns the products most similar to a given one (by name, description, category & price)"""
+    return [todict(product) for product in await run_in_threadpool(similar_products, product_id, top_k)]
@@ -1,10 +1,17 @@
-from langchain_chroma import Chroma
-from langchain.schema import HumanMessage, SystemMessage, AIMessage
-from typing import List, Dict, TypeAlias
-import random, textwrap
-from src.lib.data.constants import CHAT_LLM, CONDITIONAL_LLM, VECSTORE_PERSIST_DIR, TOP_K, EMBEDDER, BASE_SYS_MSG, ERR_RESPONSE
-from src.lib.utils.logger import err_log
-from src.lib.utils.db import search_products, get_all_products, search_users, get_all_users, get_user_info
+from langchain.schema import HumanMessage, SystemMessage, AIMessage, BaseMessage
+from langchain_core.language_models.chat_models import BaseChatModel
+from typing import List, Dict, Callable, Iterator, Optional, TypeAlias
+from time import perf_counter
+import json, random, textwrap
+from src.lib.data.constants import (
+    CHAT_LLM, CONDITIONAL_LLM, SUMMARY_LLM, TOP_K, EMBEDDER, BASE_SYS_MSG, ERR_RESPONSE,
+    FAQ_PATH, SEMANTIC_CACHE_THRESHOLD, SEMANTIC_CACHE_TTL, SEMANTIC_CACHE_SIZE
+)
+from src.lib.utils.cache import SemanticCache
+from src.server.models.prompt_builder import PromptBuilder
+from src.server.models.retriever import HybridRetriever
+from src.lib.utils.logger import log, err_log
+from src.lib.utils.db import search_products, get_all_products, search_users, get_all_users, get_user_info, get_users_info
 
 ## Private utils
 _Conversation: TypeAlias = List[Dict[str, str]]
@@ -26,13 +33,29 @@ def _condition(question: str) -> bool:
     return 'yes' in response.lower()
 
 
+class _ChatContext:
+    """Request-local state of a single chatbot turn; never shared between requests"""
+    def __init__(self, prompt: str, sender: str = '') -> None:
+        self.prompt, self.sender = prompt, sender
+        self.conversation: List[BaseMessage] = []
+        self.pinned: List[str] = []  # Context that must be kept (e.g., the customer's info)
+        self.entities: List[str] = []  # Product & user blocks
+        self.chunks: List[str] = []  # Retrieved documents
+        self.history: List[BaseMessage] = [BASE_SYS_MSG]  # Final prompt, assembled within the token budget
+
+
 ## Main class
 class Chatbot:
-    """Chatbot assistant that answers end users' questions about products and information through RAG"""
-    def __init__(self) -> None:
-        self._reset_history()
-        self._add_sys_msg = lambda msg: self.history.append(SystemMessage(_prompt(msg)))
-        self.llm = CHAT_LLM
+    """
+    Chatbot assistant that answers end users' questions about products and information through RAG.
+    Instances only hold immutable, shared parts (LLM client, retriever & prompt template) plus thread-safe caches;
+    all per-turn state lives in a `_ChatContext`, so a single instance can safely serve many concurrent conversations.
+    """
+    def __init__(self, llm: BaseChatModel = CHAT_LLM) -> None:
+        self.llm = llm
+        self.retriever = self._build_retriever()
+        self.cache = self._build_cache()
+        self.prompt_builder = PromptBuilder(self._summarize)
         self.template = _prompt('''
             Context: """{docs}"""\n\n
             You are a friendly EcomGo customer support employee!
@@ -40,103 +63,212 @@ class Chatbot:
             You must NOT synthesize information; ONLY if the context is relevant, you MUST use the context or previous messages to answer the question.
             Otherwise, answer the question directly. Here is the question/message: "{question}"'
         ''')
+        self._frozen = True
+
+    def __setattr__(self, name: str, value: object) -> None:
+        if getattr(self, '_frozen', False):
+            raise AttributeError(f'Chatbot is immutable; cannot set "{name}" (keep per-turn state in a `_ChatContext`)')
+        super().__setattr__(name, value)
 
-    def __call__(self, prompt: str, sender: str = '', conv: _Conversation = []) -> str:
-        self._parse_conversation(conv)
-        return self.chat(prompt, sender)
+    def __call__(self, prompt: str, sender: str = '', conv: Optional[_Conversation] = None) -> str:
+        return self.chat(prompt, sender, conv)
 
 
-    def chat(self, prompt: str, sender: str = '') -> str:
-        """Returns the LLM's response to the given prompt"""
+    def chat(self, prompt: str, sender: str = '', conv: Optional[_Conversation] = None) -> str:
+        """Returns the LLM's response to the given prompt, skipping generation for (near-)duplicate questions"""
         try:
-            # Using tools
-            self._search_products(prompt)
-            self._search_users(prompt)
-            self._get_sender_info(sender)
-
-            # Prompting the LLM
-            self.history.append(HumanMessage(self.template.format(docs=self._retrieve_docs(prompt), question=prompt)))
-            response = self.llm.invoke(self.history).content
-            self._reset_history()
-            return response
+            if (answer := self._cached_answer(prompt, sender, conv)) is not None: return answer
+            ctx = self._build_context(prompt, sender, conv)
+            answer = self._generate(ctx)
+            self._cache_answer(prompt, sender, conv, answer)
+            return answer
         except Exception as e:
             err_log('Chatbot.chat', e, 'model')
             return ERR_RESPONSE
 
 
-    def _reset_history(self) -> None:
-        """Resets the chatbot's conversation memory"""
-        self.history = [BASE_SYS_MSG]
+    def stream(self, prompt: str, sender: str = '', conv: Optional[_Conversation] = None) -> Iterator[str]:
+        """Yields the LLM's response to the given prompt token by token; closing the iterator cancels the generation"""
+        start = perf_counter()
+        if (answer := self._cached_answer(prompt, sender, conv)) is not None:
+            yield answer
+            return
+        try:
+            ctx = self._build_context(prompt, sender, conv)
+        except Exception as e:
+            err_log('Chatbot.stream', e, 'model')
+            yield ERR_RESPONSE
+            return
+        yield from self._stream(ctx, start, on_complete=lambda answer: self._cache_answer(prompt, sender, conv, answer))
+
+
+    def _cached_answer(self, prompt: str, sender: str = '', conv: Optional[_Conversation] = None) -> Optional[str]:
+        """
+        Returns a cached answer to a (near-)duplicate question that doesn't depend on an ongoing conversation.
+        Known senders may only get canonical (FAQ) answers since learned ones were generated without their info.
+        """
+        if conv: return None
+        try:
+            answer = self.cache.lookup(prompt, pinned_only=bool(sender))
+            if answer is not None: log(f'[Chatbot._cached_answer] Cache hit for "{prompt}"', 'model')
+            return answer
+        except Exception as e:
+            err_log('Chatbot._cached_answer', e, 'model')
+
+
+    def _cache_answer(self, prompt: str, sender: str, conv: Optional[_Conversation], answer: str) -> None:
+        """Shares an answer with future askers only if it depends on nothing but the question itself"""
+        if sender or conv or not answer or answer == ERR_RESPONSE: return
+        try:
+            self.cache.store(prompt, answer)
+        except Exception as e:
+            err_log('Chatbot._cache_answer', e, 'model')
+
+
+    def _build_context(self, prompt: str, sender: str = '', conv: Optional[_Conversation] = None) -> _ChatContext:
+        """Creates a fresh turn context holding the conversation, tool results & the final question"""
+        ctx = _ChatContext(prompt, sender)
+        self._parse_conversation(ctx, conv or [])
+
+        # Using tools
+        self._search_products(ctx)
+        self._search_users(ctx)
+        self._get_sender_info(ctx)
+        ctx.chunks = self._retrieve_docs(prompt)
+
+        self._assemble(ctx)
+        return ctx
+
 
+    def _assemble(self, ctx: _ChatContext) -> None:
+        """Builds the turn's final prompt within the token budget"""
+        ctx.history, n_tokens = self.prompt_builder.build(
+            BASE_SYS_MSG, ctx.prompt, self.template, ctx.conversation, ctx.pinned, ctx.entities, ctx.chunks
+        )
+        log(f'[Chatbot._assemble] Prompt tokens: {n_tokens}', 'model')
 
-    def _parse_conversation(self, conv: _Conversation) -> None:
+
+    def _summarize(self, previous_summary: str, new_turns: str) -> str:
+        """Extends a conversation summary with newly aged-out turns"""
+        return SUMMARY_LLM.invoke(_prompt(f'''
+            Update the summary of a conversation between a customer & an assistant with its new messages.
+            Keep names, products, preferences & open questions; respond ONLY with the updated summary in at most 5 sentences.
+            Current summary: {previous_summary or "(empty)"}
+            New messages:
+            {new_turns}
+        ''')).strip()
+
+
+    def _generate(self, ctx: _ChatContext) -> str:
+        """Prompts the LLM with the turn's memory"""
+        return self.llm.invoke(ctx.history).content
+
+
+    def _stream(self, ctx: _ChatContext, start: Optional[float] = None, on_complete: Optional[Callable[[str], None]] = None) -> Iterator[str]:
+        """
+        Streams the LLM's tokens for the turn's memory & logs the time-to-first-token (TTFT), measured from `start`.
+        `on_complete` receives the full answer only if the generation finished without errors or cancellation.
+        """
+        start, ttft, tokens = start or perf_counter(), None, []
+        stream = self.llm.stream(ctx.history)
+        try:
+            for chunk in stream:
+                if ttft is None: ttft = perf_counter() - start
+                tokens.append(chunk.content)
+                yield chunk.content
+        except Exception as e:
+            err_log('Chatbot._stream', e, 'model')
+            if not tokens: yield ERR_RESPONSE
+        else:
+            if on_complete is not None: on_complete(''.join(tokens))
+        finally:
+            stream.close()
+            ttft_msg = f'{ttft:.3f}s' if ttft is not None else 'n/a'
+            log(f'[Chatbot._stream] TTFT: {ttft_msg}, total: {perf_counter() - start:.3f}s, tokens: {len(tokens)}', 'model')
+
+
+    def _parse_conversation(self, ctx: _ChatContext, conv: _Conversation) -> None:
         """Loads the given conversation history from strings to chat schemas"""
         try:
             for msg in conv:
                 sender, content = msg['sender'], msg['content']
                 match sender:
-                    case 'chatbot': self.history.append(AIMessage(content))
-                    case 'system': self.history.append(SystemMessage(content))
-                    case _: self.history.append(HumanMessage(content))
+                    case 'chatbot': ctx.conversation.append(AIMessage(content))
+                    case 'system': ctx.conversation.append(SystemMessage(content))
+                    case _: ctx.conversation.append(HumanMessage(content))
         except Exception as e:
             err_log('Chatbot._parse_conversation', e, 'model')
 
 
-    def _retrieve_docs(self, search_input: str, k: int = TOP_K) -> str:
+    def _build_retriever(self, k: int = TOP_K) -> Optional[HybridRetriever]:
+        """Opens the persisted vectorstore & chunk store once as a hybrid (BM25 + dense) retriever of the top `k` documents"""
+        try:
+            return HybridRetriever(k)
+        except Exception as e:
+            err_log('Chatbot._build_retriever', e, 'model')
+
+
+    def _build_cache(self) -> SemanticCache:
+        """Creates the answer cache, pre-seeded with the canonical FAQ answers"""
+        cache = SemanticCache(EMBEDDER, SEMANTIC_CACHE_THRESHOLD, SEMANTIC_CACHE_SIZE, SEMANTIC_CACHE_TTL)
+        try:
+            with open(FAQ_PATH) as file:
+                cache.seed((faq['question'], faq['answer']) for faq in json.load(file))
+        except Exception as e:
+            err_log('Chatbot._build_cache', e, 'model')
+        return cache
+
+
+    def _retrieve_docs(self, search_input: str) -> List[str]:
         """Retrieves the top `k` relevant documents with respect to `search_input`"""
         try:
-            vectorstore = Chroma(persist_directory=VECSTORE_PERSIST_DIR, embedding_function=EMBEDDER)
-            retriever = vectorstore.as_retriever(search_kwargs={'k': k})
-            docs = ''
-            for doc in retriever.invoke(search_input):
-                docs += doc.page_content + '\n'
-            return docs
+            return [doc.page_content for doc in self.retriever.invoke(search_input)]
         except Exception as e:
             err_log('Chatbot._retrieve_docs', e, 'model')
+            return []
 
 
-    def _search_products(self, prompt: str) -> None:
-        """Retrieves product(s) info & adds it to the chatbot's memory"""
+    def _search_products(self, ctx: _ChatContext) -> None:
+        """Retrieves product(s) info & adds it to the turn's memory"""
         products = []
-        if _condition(f'Does the message "{prompt}" explicitly/implicitly care about a specific product(s)?'):
-            products = search_products(prompt)
+        if _condition(f'Does the message "{ctx.prompt}" explicitly/implicitly care about a specific product(s)?'):
+            products = search_products(ctx.prompt)
         else:
             products = random.sample(get_all_products(), 4)
 
         for p in products:
-            self._add_sys_msg(f'''
+            ctx.entities.append(_prompt(f'''
                 PRODUCT NAME: {p.name}
                 - MANUFACTURER: {p.owner}
                 - PRICE: {p.price}
                 - DISCOUNT: {p.discount}
                 - DISCOUNTED PRICE: {p.price - (p.discount * p.price):.2f}\n\n
-            ''')
+            '''))
 
 
-    def _search_users(self, prompt: str) -> None:
-        """Retrieves user(s) info & adds it to the chatbot's memory"""
+    def _search_users(self, ctx: _ChatContext) -> None:
+        """Retrieves user(s) info & adds it to the turn's memory"""
         users = []
-        if _condition(f'Does the message "{prompt}" explicitly/implicitly care about a specific user(s)?'):
-            users = search_users(prompt)
+        if _condition(f'Does the message "{ctx.prompt}" explicitly/implicitly care about a specific user(s)?'):
+            users = search_users(ctx.prompt)
         else:
             users = random.sample(get_all_users(), 4)
 
-        for u in users:
-            info = get_user_info(u.username)
-            owned_product_names = ', '.join([p.name for p in info['owned_products']])
-            self._add_sys_msg(f"""
+        for info in get_users_info([u.username for u in users]):
+            owned_product_names = ', '.join(info['owned_product_names'])
+            ctx.entities.append(_prompt(f"""
                 USER/MANUFACTURER NAME: {info['username']}
                 - BIO: {info['bio']}
                 - OWNED PRODUCTS: {owned_product_names}\n\n
-            """)
+            """))
 
 
-    def _get_sender_info(self, sender: str) -> None:
-        """Retrieves more info about the customer & adds it to the chatbot's memory"""
-        if len(sender) == 0: return ''
-        info = get_user_info(sender)
-        self._add_sys_msg(f"""
+    def _get_sender_info(self, ctx: _ChatContext) -> None:
+        """Retrieves more info about the customer & adds it to the turn's memory"""
+        if len(ctx.sender) == 0: return
+        info = get_user_info(ctx.sender)
+        ctx.pinned.append(_prompt(f"""
             INFO OF THE CUSTOMER YOU'RE ANSWERING:
             - USERNAME: {info['username']}
             - BIO: {info['bio']}
-        """)
\ No newline at end of file
+        """))
\ No newline at end of file
@@ -0,0 +1,41 @@
+from sklearn.decomposition import PCA
+from sklearn.random_projection import GaussianRandomProjection
+from typing import List, Optional, Sequence, Union
+import numpy as np
+from src.server.models.similarity import normalize_rows
+
+Reducer = Union[PCA, GaussianRandomProjection]
+
+def fit_reducer(vectors: np.ndarray, method: str, dim: int, seed: int = 0) -> Reducer:
+    """Fits a PCA (`method="pca"`) or a Gaussian random projection (`method="random"`) to `dim` dimensions"""
+    match method:
+        case 'pca': reducer = PCA(n_components=min(dim, *np.shape(vectors)), svd_solver='randomized', random_state=seed)
+        case 'random': reducer = GaussianRandomProjection(n_components=dim, random_state=seed)
+        case _: raise ValueError(f'Unknown compression method: {method}')
+    return reducer.fit(vectors)
+
+
+def quantize(unit_vectors: np.ndarray, quantization: str) -> np.ndarray:
+    """
+    Stores L2-normalized rows as "float32", "float16" or "int8" (scaled so the largest absolute value becomes 127).
+    Cosine rankings are unaffected by the uniform int8 scale, since `SimilarityEngine` renormalizes queries & only
+    compares scores.
+    """
+    match quantization:
+        case 'float32' | 'float16': return np.asarray(unit_vectors, dtype=quantization)
+        case 'int8':
+            unit_vectors = np.asarray(unit_vectors, dtype=np.float32)
+            scale = 127 / max(float(np.abs(unit_vectors).max(initial=0)), 1e-12)
+            return np.round(unit_vectors * scale).astype(np.int8)
+        case _: raise ValueError(f'Unknown quantization: {quantization}')
+
+
+def compress(vectors: np.ndarray, reducer: Optional[Reducer], quantization: str) -> np.ndarray:
+    """Projects the rows with `reducer` (if any), renormalizes & quantizes them"""
+    return quantize(normalize_rows(reducer.transform(vectors)) if reducer is not None else normalize_rows(vectors), quantization)
+
+
+def recall_at_k(expected: Sequence[List[int]], actual: Sequence[List[int]], k: int) -> float:
+    """Mean share of the top-`k` expected (e.g., full-precision) results found in the top `k` actual ones"""
+    hits = [len(set(e[:k]) & set(a[:k])) / min(k, len(e)) for e, a in zip(expected, actual) if e]
+    return float(np.mean(hits)) if hits else 1.
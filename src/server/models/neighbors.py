@@ -0,0 +1,145 @@
+from threading import Lock
+from typing import Dict, List, NamedTuple, Optional, Sequence, Tuple
+import os, numpy as np
+from src.lib.data.constants import ARTIFACTS_DIR, ARTIFACT_VERSION, NEIGHBORS_K, SIMILARITY_BLOCK_SIZE
+from src.lib.utils.artifacts import CURRENT_FILE, load_neighbors
+from src.lib.utils.logger import err_log
+from src.server.models.similarity import normalize_rows
+
+class NeighborIndex:
+    """
+    Nearest neighbor products of every product (by cosine similarity of their content vectors), kept by the pipeline
+    so that created, updated & deleted products refresh the table incrementally: an upsert costs one pass over the
+    catalog, and only the lists that pointed to a deleted product are recomputed.
+    """
+    def __init__(self, product_ids: Sequence[int], vectors: np.ndarray, k: int = NEIGHBORS_K, block_size: int = SIMILARITY_BLOCK_SIZE) -> None:
+        self.k, self.block_size = k, block_size
+        self.product_ids = np.asarray(product_ids, dtype=np.int64)
+        self.vectors = normalize_rows(vectors)
+        self.neighbors = np.full((len(self.product_ids), k), -1, dtype=np.int64)  # Rows of the neighbors (-1 pads)
+        self.scores = np.full((len(self.product_ids), k), -np.inf, dtype=np.float32)
+        self._refill(np.arange(len(self.product_ids)))
+
+
+    def upsert(self, product_id: int, vector: np.ndarray) -> None:
+        """Adds or replaces a product, updating its neighbors & inserting it into the lists it now belongs to"""
+        self.upsert_many([product_id], np.asarray(vector)[None])
+
+
+    def upsert_many(self, product_ids: Sequence[int], vectors: np.ndarray) -> None:
+        """
+        Adds or replaces many (distinct) products at once: the arrays grow once, the lists of the upserted products (&
+        of those that pointed to a replaced one, whose similarity may have dropped) are recomputed with one blocked
+        product, & the upserted products are merged into every other list where they beat the weakest neighbor.
+        """
+        product_ids, vectors = np.asarray(product_ids, dtype=np.int64), normalize_rows(vectors)
+        if not len(product_ids): return
+        known = dict(zip(self.product_ids.tolist(), range(len(self.product_ids))))
+        rows = np.array([known.get(product_id, -1) for product_id in product_ids.tolist()], dtype=np.int64)
+        replaced, created = rows[rows >= 0], rows < 0
+        rows[created] = np.arange(len(self.product_ids), len(self.product_ids) + created.sum())
+
+        self.product_ids = np.concatenate([self.product_ids, product_ids[created]])
+        self.vectors = np.vstack([self.vectors, np.zeros((created.sum(), self.vectors.shape[1]), dtype=np.float32)])
+        self.vectors[rows] = vectors
+        self.neighbors = np.vstack([self.neighbors, np.full((created.sum(), self.k), -1, dtype=np.int64)])
+        self.scores = np.vstack([self.scores, np.full((created.sum(), self.k), -np.inf, dtype=np.float32)])
+
+        refilled = np.union1d(rows, np.flatnonzero(np.isin(self.neighbors, replaced).any(axis=1)))
+        self._refill(refilled)
+        self._merge(np.setdiff1d(np.arange(len(self.product_ids)), refilled), rows)
+
+
+    def remove(self, product_id: int) -> None:
+        """Deletes a product, recomputing the lists it was part of"""
+        if (row := self._row(product_id)) is None: return
+        stale = np.flatnonzero((self.neighbors == row).any(axis=1))
+        keep = np.arange(len(self.product_ids)) != row
+        self.product_ids, self.vectors, self.scores = self.product_ids[keep], self.vectors[keep], self.scores[keep]
+        self.neighbors = self.neighbors[keep]
+        self.neighbors[self.neighbors > row] -= 1  # Rows after the removed one shift up
+        self._refill(stale - (stale > row))
+
+
+    def table(self) -> Tuple[np.ndarray, np.ndarray]:
+        """Returns the product IDs & the (-1 padded) product IDs of their neighbors, most similar first (as published by `publish_feature_store`)"""
+        neighbor_ids = np.where(self.neighbors >= 0, self.product_ids[np.maximum(self.neighbors, 0)], -1)
+        return self.product_ids.copy(), neighbor_ids
+
+
+    def _row(self, product_id: int) -> Optional[int]:
+        rows = np.flatnonzero(self.product_ids == product_id)
+        return int(rows[0]) if len(rows) else None
+
+
+    def _refill(self, rows: np.ndarray) -> None:
+        """Recomputes the neighbors of the given rows with blocked matrix products"""
+        n = len(self.product_ids)
+        k, step = min(self.k, n - 1), max(self.block_size // max(n, 1), 1)
+        self.neighbors[rows], self.scores[rows] = -1, -np.inf
+        if k <= 0: return
+        for start in range(0, len(rows), step):
+            block = rows[start:start + step]
+            scores = self.vectors[block] @ self.vectors.T
+            scores[np.arange(len(block)), block] = -np.inf
+            top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+            top_scores = np.take_along_axis(scores, top, axis=1)
+            ranking = np.argsort(-top_scores, axis=1, kind='stable')
+            self.neighbors[block, :k] = np.take_along_axis(top, ranking, axis=1)
+            self.scores[block, :k] = np.take_along_axis(top_scores, ranking, axis=1)
+
+
+    def _merge(self, others: np.ndarray, rows: np.ndarray) -> None:
+        """Merges the given rows into the neighbors of the `others` (which must not contain them yet) with blocked matrix products"""
+        step = max(self.block_size // max(len(rows), 1), 1)
+        for start in range(0, len(others), step):
+            block = others[start:start + step]
+            candidates = np.hstack([self.neighbors[block], np.broadcast_to(rows, (len(block), len(rows)))])
+            scores = np.hstack([self.scores[block], self.vectors[block] @ self.vectors[rows].T])
+            top = np.argsort(-scores, axis=1, kind='stable')[:, :self.k]  # Current neighbors win ties
+            self.neighbors[block], self.scores[block] = np.take_along_axis(candidates, top, axis=1), np.take_along_axis(scores, top, axis=1)
+
+
+class _Table(NamedTuple):
+    pointer: Tuple[int, int]  # (mtime in ns, size) of the `current` pointer when loaded
+    rows: Dict[int, int]  # product ID -> row
+    neighbors: np.ndarray
+
+
+class SimilarProductsService:
+    """
+    Serves the neighbor table published in the artifact bundles in O(1) per product. Like `RecommenderService`, it
+    follows the `current` version (hot-reloading the table whenever the pointer is replaced, e.g., rolled back) unless
+    a `version` is pinned.
+    """
+    def __init__(self, root: str = ARTIFACTS_DIR, version: Optional[str] = ARTIFACT_VERSION or None) -> None:
+        self.root, self.pinned_version = root, version
+        self._table: Optional[_Table] = None
+        self._lock = Lock()
+
+
+    def similar(self, product_id: int, top_k: int = NEIGHBORS_K) -> Optional[List[int]]:
+        """Returns the IDs of the products most similar to the given one (`None` if no table was published yet)"""
+        if (table := self._get_table()) is None: return None
+        if (row := table.rows.get(product_id)) is None: return []
+        neighbors = table.neighbors[row, :top_k]
+        return neighbors[neighbors >= 0].tolist()
+
+
+    def _get_table(self) -> Optional[_Table]:
+        if self.pinned_version is not None and self._table is not None: return self._table
+        try:
+            stat = os.stat(os.path.join(self.root, CURRENT_FILE))
+        except FileNotFoundError:
+            return self._table
+        pointer = (stat.st_mtime_ns, stat.st_size)
+        if self._table is None or self._table.pointer != pointer:
+            with self._lock:
+                if self._table is None or self._table.pointer != pointer:
+                    try:
+                        if (table := load_neighbors(self.root, self.pinned_version)) is not None:
+                            product_ids, neighbors = table
+                            self._table = _Table(pointer, {int(p): row for row, p in enumerate(product_ids)}, neighbors)
+                    except Exception as e:
+                        err_log('SimilarProductsService._get_table', e, 'model')  # Keep serving the previous table
+        return self._table
@@ -0,0 +1,42 @@
+from scipy import sparse
+from typing import Dict, Iterable, List, Mapping, Optional, Sequence, Tuple
+import pandas as pd, numpy as np
+from src.lib.data.constants import PROFILE_RATING_WEIGHT, PROFILE_CART_WEIGHT, PROFILE_SENTIMENT_WEIGHT
+from src.server.models.similarity import normalize_rows
+
+_MIN_WEIGHT = .1  # Every interaction keeps some weight, so no profile is empty
+
+def signal_weight(rating: float, in_cart: bool, sentiment: float) -> float:
+    """Weight of an interaction in its user's profile: a base of 1 raised by ratings, carting & positive reviews (lowered by negative ones)"""
+    return max(1 + PROFILE_RATING_WEIGHT * rating + PROFILE_CART_WEIGHT * in_cart + PROFILE_SENTIMENT_WEIGHT * sentiment, _MIN_WEIGHT)
+
+
+def signal_weights(ratings: Iterable[float], in_cart: Iterable[bool], sentiments: Iterable[float]) -> np.ndarray:
+    """Vectorized `signal_weight`"""
+    ratings, in_cart, sentiments = (np.asarray(list(values), dtype=np.float32) for values in (ratings, in_cart, sentiments))
+    return np.maximum(1 + PROFILE_RATING_WEIGHT * ratings + PROFILE_CART_WEIGHT * in_cart + PROFILE_SENTIMENT_WEIGHT * sentiments, _MIN_WEIGHT)
+
+
+def aggregate_rows(vectors: np.ndarray, keys: Sequence, weights: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Sums the rows sharing a key (weighted, e.g., by `signal_weights`) with one sparse matrix product, streaming through
+    memory-mapped `vectors` once. Returns the unique keys & their L2-normalized float32 vectors.
+    """
+    codes, unique_keys = pd.factorize(pd.Series(keys), sort=True)
+    weights = np.ones(len(codes), dtype=np.float32) if weights is None else np.asarray(weights, dtype=np.float32)
+    groups = sparse.csr_matrix((weights, (codes, np.arange(len(codes)))), shape=(len(unique_keys), len(codes)))
+    return np.asarray(unique_keys), normalize_rows(groups @ vectors)
+
+
+def rank_popular(product_ids: Sequence[int], weights: np.ndarray, categories: Mapping[int, str], top_n: int) -> Tuple[List[int], Dict[str, List[int]]]:
+    """
+    Ranks products by the summed signal weights of their interactions. Returns the `top_n` most popular product IDs
+    overall & per category (of `categories`, mapping product IDs to their category). Interactions carry no timestamps,
+    so "trending" products are the all-time most popular ones per category, not the ones gaining popularity lately.
+    """
+    scores = pd.Series(np.asarray(weights, dtype=np.float64), index=pd.Index(product_ids, name='product_id')).groupby(level=0).sum()
+    scores = scores.round(6)  # Ties don't depend on the order of summation (e.g., when scores are updated incrementally)
+    scores = scores.sort_values(ascending=False, kind='stable')
+    ranked = pd.DataFrame({'score': scores, 'category': scores.index.map(categories)}).dropna(subset='category')
+    trending = {str(category): group.index[:top_n].astype(int).tolist() for category, group in ranked.groupby('category', sort=False)}
+    return scores.index[:top_n].astype(int).tolist(), trending
@@ -0,0 +1,159 @@
+from langchain.schema import AIMessage, BaseMessage, HumanMessage, SystemMessage
+from hashlib import sha256
+from math import ceil
+from typing import Callable, Dict, List, Set, Tuple
+import re
+from src.lib.data.constants import PROMPT_TOKEN_BUDGET, RECENT_TURNS, CHARS_PER_TOKEN, SUMMARY_CACHE_SIZE
+from src.lib.utils.cache import LRUCache
+
+## Private utils
+_WORD = re.compile(r'\w+')
+_ROLES = {HumanMessage: 'Customer', AIMessage: 'Assistant', SystemMessage: 'System'}
+
+def count_tokens(text: str) -> int:
+    """Cheaply estimates the number of LLM tokens in a text"""
+    return ceil(len(text) / CHARS_PER_TOKEN)
+
+def _truncate(text: str, max_tokens: int) -> str:
+    """Cuts a text down to roughly `max_tokens` tokens"""
+    return text if count_tokens(text) <= max_tokens else text[:max(max_tokens, 0) * CHARS_PER_TOKEN].rstrip() + '...'
+
+def _words(text: str) -> Set[str]:
+    return set(_WORD.findall(text.lower()))
+
+def _shingles(text: str, n: int = 3) -> Set[Tuple[str, ...]]:
+    words = _WORD.findall(text.lower())
+    return {tuple(words[i:i+n]) for i in range(max(len(words) - n + 1, 1))}
+
+def _to_line(msg: BaseMessage) -> str:
+    return f'{_ROLES.get(type(msg), "Customer")}: {msg.content}'
+
+
+## Main class
+class PromptBuilder:
+    """
+    Assembles the chatbot's prompt within a token budget. Overlapping context is deduplicated, entity blocks & retrieved
+    chunks are ranked by relevance to the question & trimmed to fit, and conversation turns older than the latest
+    `recent_turns` are compressed into a rolling summary that is extended (not recomputed) as the conversation grows.
+    """
+    def __init__(
+            self,
+            summarize: Callable[[str, str], str],
+            budget: int = PROMPT_TOKEN_BUDGET,
+            recent_turns: int = RECENT_TURNS,
+            conversation_share: float = .35,
+            entity_share: float = .25,
+            overlap_threshold: float = .8
+        ) -> None:
+        """
+        :param summarize: Returns an updated summary given the previous summary & the newly aged-out turns.
+        :param budget: Max. number of prompt tokens.
+        :param recent_turns: Number of latest conversation messages kept verbatim.
+        :param conversation_share: Max. share of the budget for the conversation (summary included).
+        :param entity_share: Max. share of the budget for product/user blocks.
+        :param overlap_threshold: Context whose 3-word shingles are already covered by this ratio is dropped as a duplicate.
+        """
+        self.summarize, self.budget, self.recent_turns = summarize, budget, recent_turns
+        self.conversation_share, self.entity_share, self.overlap_threshold = conversation_share, entity_share, overlap_threshold
+        self._summaries = LRUCache(SUMMARY_CACHE_SIZE)
+
+
+    def build(
+            self,
+            base: SystemMessage,
+            question: str,
+            template: str,
+            conversation: List[BaseMessage],
+            pinned: List[str],
+            entities: List[str],
+            chunks: List[str]
+        ) -> Tuple[List[BaseMessage], Dict[str, int]]:
+        """
+        Returns the prompt's messages along with its token counts per section.
+        `pinned` blocks (e.g., the customer's info) are always kept, whereas `entities` & `chunks` are optional context.
+        """
+        query_words = _words(question)
+        remaining = self.budget - count_tokens(base.content) - count_tokens(template.format(docs='', question=question)) - sum(map(count_tokens, pinned))
+
+        # Conversation
+        summary, recent = self._fit_conversation(conversation, max(int(self.budget * self.conversation_share), 0))
+        conversation_tokens = count_tokens(summary) + sum(count_tokens(msg.content) for msg in recent)
+        remaining -= conversation_tokens
+
+        # Optional context
+        seen = set().union(*(_shingles(text) for text in pinned)) if pinned else set()
+        entities = self._select(self._rank(entities, query_words), min(int(self.budget * self.entity_share), remaining), seen)
+        remaining -= sum(map(count_tokens, entities))
+        chunks = self._select(self._rank(chunks, query_words), remaining, seen)
+
+        messages = [base]
+        if summary: messages.append(SystemMessage(summary))
+        messages += recent
+        messages += [SystemMessage(block) for block in pinned + entities]
+        messages.append(HumanMessage(template.format(docs='\n'.join(chunks), question=question)))
+        return messages, {
+            'total': sum(count_tokens(msg.content) for msg in messages),
+            'conversation': conversation_tokens,
+            'entities': sum(map(count_tokens, pinned + entities)),
+            'docs': sum(map(count_tokens, chunks))
+        }
+
+
+    def _fit_conversation(self, conversation: List[BaseMessage], budget: int) -> Tuple[str, List[BaseMessage]]:
+        """Splits the conversation into a summary of older turns & the recent turns that fit in the budget"""
+        split = max(len(conversation) - self.recent_turns, 0)
+        recent_budget = budget - (budget // 3 if split else 0)  # Reserve a third for the summary
+
+        # Age out more turns if the recent ones are too long, but always keep the latest message
+        while split < len(conversation) - 1 and sum(count_tokens(msg.content) for msg in conversation[split:]) > recent_budget:
+            split += 1
+        recent = conversation[split:]
+        if recent and count_tokens(recent[-1].content) > recent_budget:
+            recent[-1] = type(recent[-1])(_truncate(recent[-1].content, recent_budget))
+
+        summary = ''
+        if split:
+            summary_budget = budget - sum(count_tokens(msg.content) for msg in recent)
+            summary = _truncate(f'Summary of the earlier conversation: {self._rolling_summary(conversation[:split])}', summary_budget)
+        return summary, recent
+
+
+    def _rolling_summary(self, turns: List[BaseMessage]) -> str:
+        """Summarizes the given turns by extending the summary of their longest already-summarized prefix"""
+        lines, prefix_keys, digest = [_to_line(msg) for msg in turns], [], sha256()
+        for line in lines:
+            digest.update(line.encode() + b'\0')
+            prefix_keys.append(digest.hexdigest())
+
+        start, previous = 0, ''
+        for i in range(len(prefix_keys), 0, -1):
+            if (cached := self._summaries.get(prefix_keys[i - 1])) is not None:
+                start, previous = i, cached
+                break
+        if start == len(lines): return previous
+
+        try:
+            summary = self.summarize(previous, '\n'.join(lines[start:]))
+        except Exception:
+            summary = ' '.join([previous] + [_truncate(line, 30) for line in lines[start:]]).strip()  # Extractive fallback
+        self._summaries.set(prefix_keys[-1], summary)
+        return summary
+
+
+    def _rank(self, texts: List[str], query_words: Set[str]) -> List[str]:
+        """Sorts texts by their word overlap with the question, keeping the original (e.g., retrieval) order on ties"""
+        scores = [len(_words(text) & query_words) for text in texts]
+        return [text for _, _, text in sorted(zip(scores, range(len(texts), 0, -1), texts), reverse=True)]
+
+
+    def _select(self, texts: List[str], budget: int, seen: Set[Tuple[str, ...]]) -> List[str]:
+        """Greedily picks non-duplicate texts in order until the budget is exhausted (updating `seen` shingles)"""
+        selected = []
+        for text in texts:
+            shingles = _shingles(text)
+            if len(shingles & seen) >= self.overlap_threshold * len(shingles): continue
+            if (tokens := count_tokens(text)) > budget: continue
+            selected.append(text)
+            seen |= shingles
+            budget -= tokens
+        return selected
\ No newline at end of file
@@ -1,74 +1,264 @@
-from sklearn.preprocessing import LabelEncoder
-from sklearn.metrics.pairwise import cosine_similarity
-from typing import Dict, List, Optional
+from threading import Lock
+from time import time_ns
+from itertools import chain, islice, zip_longest
+from typing import Callable, Dict, List, NamedTuple, Optional, Sequence, Tuple, Union
 import os, pandas as pd, numpy as np
-from src.lib.data.constants import TRANSFORMED_DATA_PATH, TOP_K_RECOMMENDED
+from src.lib.data.constants import ARTIFACTS_DIR, ARTIFACT_VERSION, TOP_K_RECOMMENDED, NEIGHBORS_K
 from src.lib.data.db import engine, ProductData
-from src.lib.utils.db import get_all_products
+from src.lib.utils.db import get_products_by_ids, get_category_affinities, get_interactions_by_keys
+from src.lib.utils.artifacts import CURRENT_FILE, load_feature_store
+from src.lib.utils.events import ChangeEvent
+from src.server.models.similarity import SimilarityEngine, normalize_rows
+from src.server.models.profiles import signal_weight
+from src.server.models.neighbors import SimilarProductsService
 from src.lib.utils.logger import err_log
 
 _retrieve = lambda query: pd.DataFrame(pd.read_sql(query, engine))
 
-def _load_transformed_data() -> Optional[pd.DataFrame]:
-    """Loads the transformed data for recommendations"""
-    return pd.read_csv(TRANSFORMED_DATA_PATH).fillna(0) if os.path.exists(TRANSFORMED_DATA_PATH) else None
-
-
-def _load_label_encoders() -> Dict[str, LabelEncoder]:
-    """Loads label encoders for consistent transformations"""
-    users_df = _retrieve("SELECT username FROM users")
-    products_df = _retrieve("SELECT category, owner FROM products")
-    return {
-        'username': LabelEncoder().fit(users_df['username'].fillna("Unknown")),
-        'category': LabelEncoder().fit(products_df['category'].fillna("Unknown")),
-        'owner': LabelEncoder().fit(products_df['owner'].fillna("Unknown"))
-    }
-
-
-def _recommend_similar_items(df: pd.DataFrame, target_index: int, top_k: int = TOP_K_RECOMMENDED) -> List[int]:
-    """Generates recommendations based on cosine similarity"""
-    target_vector = df.iloc[target_index].values.reshape(1, -1)
-    all_vectors = df.values
-    similarities = cosine_similarity(target_vector, all_vectors)[0]
-
-    # Filter unique product IDs
-    seen_product_ids = set()
-    recommendations = []
-    similar_indices = np.argsort(similarities)[::-1][1:]
-    
-    for index in similar_indices:
-        product_id = df.loc[index, 'product_id']
-        if product_id not in seen_product_ids:
-            recommendations.append(product_id)
-            seen_product_ids.add(product_id)
-        if len(recommendations) >= top_k:
-            break
-    return recommendations
-
-
-def _recommend_for_username(df: pd.DataFrame, username: str, label_encoders: Dict[str, LabelEncoder], top_k: int = TOP_K_RECOMMENDED) -> List[int]:
-    """Recommends unique product IDs for a given username"""
-    encoded_username = label_encoders['username'].transform([username])[0]
-    target_index = df[df['username'] == encoded_username].index[0]
-    recommendations = _recommend_similar_items(df, target_index, top_k)
-    return recommendations
+class _OnlineProfiles:
+    """Profiles of one snapshot with the interaction changes committed since it was published folded in"""
+    def __init__(self) -> None:
+        self.vectors: Dict[str, np.ndarray] = {}  # username -> unnormalized profile (total signal weight x profile + folded signals), replaced rather than updated in place
+        self.applied: Dict[Tuple[str, int], float] = {}  # Signal weight folded in per interaction
+        self.folded: Dict[Tuple[str, int], int] = {}  # Time of the last change folded in per interaction
 
 
+class _Snapshot(NamedTuple):
+    """Immutable view of one published artifact version"""
+    pointer: Tuple[int, int]  # (mtime in ns, size) of the `current` pointer when loaded
+    version: str
+    engine: SimilarityEngine  # Over the memory-mapped item vectors, shared with other workers through the page cache
+    user_rows: Dict[str, int]  # username -> index of its profile
+    user_vectors: np.ndarray  # Memory-mapped user profiles
+    user_weights: np.ndarray  # Total signal weight of each profile
+    interaction_keys: np.ndarray  # Memory-mapped, sorted `user row * len(item_rows) + item row` of each interaction
+    interaction_weights: np.ndarray  # Memory-mapped signal weight of each interaction summed into the profiles
+    item_rows: Dict[int, int]  # product ID -> index of its item vector
+    recommendations: Dict[str, List[int]]  # Lookup table precomputed by the pipeline
+    recommendations_k: int
+    popular: List[int]  # Fallback for cold-start users
+    trending: Dict[str, List[int]]  # Fallback per category
+    online: _OnlineProfiles
+
+
+class RecommenderService:
+    """
+    Serves recommendations from the lookup table precomputed by the pipeline, falling back to comparing the user's
+    profile against the item vectors of the memory-mapped feature store on demand. Cold-start users (without a profile)
+    get the precomputed popular products, blended with the trending (all-time most popular) ones of the categories they
+    interacted with. Ratings, carts & reviews committed after the pipeline read the served version (see `on_change`) are
+    folded into the profiles in memory on the user's next request, moving them along the item vectors of the products.
+    Whenever the pipeline publishes a new version, the next request opens it & atomically swaps the snapshot, re-basing
+    the profiles, while in-flight requests keep using the old one; a pinned `version` is never swapped nor updated online.
+    """
+    def __init__(self, root: str = ARTIFACTS_DIR, version: Optional[str] = ARTIFACT_VERSION or None) -> None:
+        self.root, self.pinned_version = root, version
+        self._snapshot: Optional[_Snapshot] = None
+        self._lock = Lock()
+        self._changes: Dict[str, Dict[int, int]] = {}  # username -> product ID -> time of its last interaction change
+        self._online_lock = Lock()
+
+
+    def on_change(self, change: ChangeEvent) -> None:
+        """Change bus subscriber: remembers the changed interactions, to fold them into their users' profiles on demand"""
+        if change.table != 'interactions' or self.pinned_version is not None: return
+        with self._online_lock:
+            self._changes.setdefault(change.keys['username'], {})[int(change.keys['product_id'])] = time_ns()
+
+
+    def is_cold_start(self, username: str) -> bool:
+        """Whether the user has no profile in the served version (nor an online one)"""
+        if (snapshot := self._get_snapshot()) is None: return False
+        self._fold_changes(snapshot, [username])
+        return _is_cold_start(snapshot, username)
+
+
+    def recommend(self, username: str, top_k: int = TOP_K_RECOMMENDED, categories: Optional[Sequence[str]] = None) -> Optional[List[int]]:
+        """
+        Recommends unique product IDs for a given username (`None` if no data was published yet); `categories` (most
+        interacted first) are only used for cold-start users.
+        """
+        if (snapshot := self._get_snapshot()) is None: return None
+        self._fold_changes(snapshot, [username])
+        if (profile := snapshot.online.vectors.get(username)) is not None:
+            return snapshot.engine.top_products(profile, top_k)[0]
+        if top_k <= snapshot.recommendations_k and (product_ids := snapshot.recommendations.get(username)) is not None:
+            return product_ids[:top_k]
+
+        # On demand (e.g., for users missing from the lookup table)
+        if (row := snapshot.user_rows.get(username)) is None: return _cold_start(snapshot, top_k, categories)
+        return snapshot.engine.top_products(snapshot.user_vectors[row], top_k)[0]
+
+
+    def recommend_batch(
+            self,
+            usernames: List[str],
+            top_k: int = TOP_K_RECOMMENDED,
+            categories: Union[Dict[str, Sequence[str]], Callable[[List[str]], Dict[str, Sequence[str]]], None] = None
+        ) -> Optional[Dict[str, List[int]]]:
+        """
+        Recommends unique product IDs for many users, computing those missing from the lookup table in blocked matrix
+        products. The pending changes of the whole batch are folded in with a single query first, so `categories` may be
+        a function called once with the cold-start usernames (e.g., `get_category_affinities`).
+        """
+        if (snapshot := self._get_snapshot()) is None: return None
+        self._fold_changes(snapshot, usernames)
+        if callable(categories):
+            cold_start = [username for username in dict.fromkeys(usernames) if _is_cold_start(snapshot, username)]
+            categories = categories(cold_start) if cold_start else None
+        recommendations, on_demand = {}, {}
+        for username in dict.fromkeys(usernames):
+            if (profile := snapshot.online.vectors.get(username)) is not None:
+                on_demand[username] = profile
+            elif top_k <= snapshot.recommendations_k and (product_ids := snapshot.recommendations.get(username)) is not None:
+                recommendations[username] = product_ids[:top_k]
+            elif (row := snapshot.user_rows.get(username)) is not None:
+                on_demand[username] = snapshot.user_vectors[row]
+            else:
+                recommendations[username] = _cold_start(snapshot, top_k, (categories or {}).get(username))
+        if on_demand:
+            queries = np.vstack([np.asarray(vector, dtype=np.float32) for vector in on_demand.values()])
+            recommendations.update(zip(on_demand, snapshot.engine.top_products(queries, top_k)))
+        return recommendations
+
+
+    def _get_snapshot(self) -> Optional[_Snapshot]:
+        """Returns the latest snapshot, (re)loading it if the `current` pointer changed since it was loaded"""
+        if self.pinned_version is not None and self._snapshot is not None: return self._snapshot
+        try:
+            stat = os.stat(os.path.join(self.root, CURRENT_FILE))
+        except FileNotFoundError:
+            return self._snapshot
+        pointer = (stat.st_mtime_ns, stat.st_size)
+        if self._snapshot is None or self._snapshot.pointer != pointer:
+            with self._lock:
+                if self._snapshot is None or self._snapshot.pointer != pointer:
+                    try:
+                        self._snapshot = self._load(pointer) or self._snapshot
+                    except Exception as e:
+                        err_log('RecommenderService._get_snapshot', e, 'model')  # Keep serving the previous snapshot
+        return self._snapshot
+
+
+    def _fold_changes(self, snapshot: _Snapshot, usernames: Sequence[str]) -> None:
+        """
+        Folds the pending interaction changes of the given users into their online profiles, reading the changed
+        interactions with a single query: the change of each interaction's signal weight is added along its product's
+        item vector, on top of the published profile scaled by its total signal weight. The published weight of an
+        interaction is replaced rather than counted again, so folding a change the version already includes is a no-op.
+        """
+        with self._online_lock:
+            pending = {
+                (username, product_id): changed_at
+                for username in dict.fromkeys(usernames) for product_id, changed_at in self._changes.get(username, {}).items()
+                if snapshot.online.folded.get((username, product_id)) != changed_at
+            }
+        if not pending: return
+        interactions = {(i.username, i.product_id): i for i in get_interactions_by_keys(list(pending))}
+
+        with self._online_lock:
+            online = snapshot.online
+            for key, changed_at in pending.items():
+                if online.folded.get(key) == changed_at: continue  # Folded by a concurrent request
+                online.folded[key] = changed_at
+                if (item_row := snapshot.item_rows.get(key[1])) is None: continue  # Product without an item vector yet
+                i = interactions.get(key)
+                weight = signal_weight(i.rating or 0, bool(i.in_cart), sum(i.sentiments or [])) if i is not None else 0.  # 0 if deleted
+                if (profile := online.vectors.get(key[0])) is None:
+                    row = snapshot.user_rows.get(key[0])
+                    profile = snapshot.user_weights[row] * normalize_rows(snapshot.user_vectors[row]) if row is not None else np.zeros(snapshot.user_vectors.shape[1], dtype=np.float32)
+                # A new array is swapped in, as requests may be scoring the current one
+                online.vectors[key[0]] = profile + (weight - online.applied.get(key, _published_weight(snapshot, *key))) * normalize_rows(snapshot.engine.unit_vectors[item_row])
+                online.applied[key] = weight
+
+
+    def _load(self, pointer: Tuple[int, int]) -> Optional[_Snapshot]:
+        if (store := load_feature_store(self.root, self.pinned_version)) is None: return None
+        if store.version.isdigit():
+            with self._online_lock:  # Changes before the pipeline read the version's data (its version) are part of it
+                self._changes = {
+                    username: recent for username, changes in self._changes.items()
+                    if (recent := {p: t for p, t in changes.items() if t >= int(store.version)})
+                }
+        user_weights = np.asarray(store.user_weights, dtype=np.float32) if len(store.user_weights) else np.ones(len(store.usernames), dtype=np.float32)
+        return _Snapshot(
+            pointer, store.version, SimilarityEngine(store.item_vectors, store.product_ids),
+            {username: row for row, username in enumerate(store.usernames)}, store.user_vectors, user_weights,
+            store.interaction_keys, store.interaction_weights,
+            {int(product_id): row for row, product_id in enumerate(store.product_ids)},
+            store.recommendations, store.recommendations_k, store.popular, store.trending, _OnlineProfiles()
+        )
+
+
+def _is_cold_start(snapshot: _Snapshot, username: str) -> bool:
+    return username not in snapshot.user_rows and username not in snapshot.online.vectors
+
+
+def _published_weight(snapshot: _Snapshot, username: str, product_id: int) -> float:
+    """Signal weight of an interaction in the published profiles (0 if it was not part of them), by binary search"""
+    if (user_row := snapshot.user_rows.get(username)) is None or (item_row := snapshot.item_rows.get(product_id)) is None: return 0.
+    key = user_row * len(snapshot.item_rows) + item_row
+    i = int(np.searchsorted(snapshot.interaction_keys, key))
+    return float(snapshot.interaction_weights[i]) if i < len(snapshot.interaction_keys) and snapshot.interaction_keys[i] == key else 0.
+
+
+def _cold_start(snapshot: _Snapshot, top_k: int, categories: Optional[Sequence[str]] = None) -> List[int]:
+    """Interleaves the trending products of the given categories with the popular ones, skipping duplicates"""
+    sources = [snapshot.trending.get(category, []) for category in categories or []] + [snapshot.popular]
+    interleaved = (product_id for product_id in chain.from_iterable(zip_longest(*sources)) if product_id is not None)
+    return list(islice(dict.fromkeys(interleaved), top_k))
+
+
+def precompute_recommendations(similarity: SimilarityEngine, usernames: Sequence[str], user_vectors: np.ndarray, top_k: int = TOP_K_RECOMMENDED) -> Dict[str, List[int]]:
+    """Precomputes the top `top_k` product IDs of every user from their profile (as on demand)"""
+    return dict(zip(map(str, usernames), similarity.top_products(user_vectors, top_k)))
+
+
+recommender = RecommenderService()
+similar_products_service = SimilarProductsService()
+
 def recommend_products(username: str, top_k: int = TOP_K_RECOMMENDED) -> List[ProductData]:
     """Returns recommendations for a given username"""
     try:
-        transformed_df = _load_transformed_data()
+        categories = get_category_affinities([username])[username] if recommender.is_cold_start(username) else None
+        product_ids = recommender.recommend(username, top_k, categories)
 
-        if transformed_df is None:
+        if product_ids is None:
             print("Transformed data not available. Run the pipeline first.")
             return []
 
-        label_encoders = _load_label_encoders()
-        product_ids = _recommend_for_username(transformed_df, username, label_encoders, top_k)
-        return [
-            get_all_products(product_id=int(product_id))[0]
-            for product_id in product_ids
-        ]
+        return get_products_by_ids(product_ids)
     except Exception as e:
         err_log('recommend_products', e, 'model')
-        return []
\ No newline at end of file
+        return []
+
+
+def recommend_products_batch(usernames: List[str], top_k: int = TOP_K_RECOMMENDED) -> Dict[str, List[ProductData]]:
+    """Returns recommendations for many usernames, fetching all recommended products with a single query"""
+    try:
+        product_ids = recommender.recommend_batch(usernames, top_k, get_category_affinities)
+
+        if product_ids is None:
+            print("Transformed data not available. Run the pipeline first.")
+            return {username: [] for username in usernames}
+
+        products = {p.product_id: p for p in get_products_by_ids([pid for ids in product_ids.values() for pid in ids])}
+        return {username: [products[pid] for pid in ids if pid in products] for username, ids in product_ids.items()}
+    except Exception as e:
+        err_log('recommend_products_batch', e, 'model')
+        return {username: [] for username in usernames}
+
+
+def similar_products(product_id: int, top_k: int = NEIGHBORS_K) -> List[ProductData]:
+    """Returns the products most similar to a given one, from the precomputed neighbor table"""
+    try:
+        product_ids = similar_products_service.similar(product_id, top_k)
+
+        if product_ids is None:
+            print("Similar products not available. Run the pipeline first.")
+            return []
+
+        return get_products_by_ids(product_ids)
+    except Exception as e:
+        err_log('similar_products', e, 'model')
+        return []
@@ -0,0 +1,139 @@
+from langchain_chroma import Chroma
+from langchain.schema import Document
+from concurrent.futures import ThreadPoolExecutor
+from collections import Counter, defaultdict
+from hashlib import sha256
+from math import log as ln
+from threading import Lock
+from time import monotonic
+from typing import Dict, List, Literal, Optional, Tuple, TypeAlias
+import json, os, re
+from src.lib.data.constants import (
+    CHUNK_STORE_PATH, VECSTORE_PERSIST_DIR, EMBEDDER, TOP_K, RETRIEVAL_MODE, DENSE_TIMEOUT, DENSE_COOLDOWN, RRF_K
+)
+from src.lib.utils.logger import log, err_log
+
+## Chunk store
+Chunk: TypeAlias = Dict[str, str]  # {'id': ..., 'text': ..., 'source': ...}
+RetrievalMode: TypeAlias = Literal['hybrid', 'dense', 'lexical']
+
+def make_chunk(text: str, source: str) -> Chunk:
+    """Creates a chunk whose ID is the hash of its source & content"""
+    return {'id': sha256(f'{source}\0{text}'.encode()).hexdigest(), 'text': text, 'source': source}
+
+
+def save_chunks(chunks: List[Chunk], path: str = CHUNK_STORE_PATH) -> None:
+    """Atomically writes the chunk store shared by the dense (Chroma) & sparse (BM25) indexes"""
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w') as file: json.dump(chunks, file)
+    os.replace(tmp_path, path)
+
+
+def load_chunks(path: str = CHUNK_STORE_PATH) -> List[Chunk]:
+    """Reads the chunk store (empty if it was never built)"""
+    if not os.path.exists(path): return []
+    with open(path) as file: return json.load(file)
+
+
+## Sparse index
+_TOKEN = re.compile(r'\w+(?:[-.]\w+)*')
+
+def _tokenize(text: str) -> List[str]:
+    """Splits text into lowercase words, keeping compound terms (e.g., SKUs like "x-100") alongside their parts"""
+    tokens = []
+    for term in _TOKEN.findall(text.lower()):
+        tokens.append(term)
+        if '-' in term or '.' in term: tokens += re.split(r'[-.]', term)
+    return tokens
+
+
+class BM25Index:
+    """In-process Okapi BM25 index over a list of texts"""
+    def __init__(self, texts: List[str], k1: float = 1.5, b: float = .75) -> None:
+        self.k1, self.b = k1, b
+        self.doc_lengths = [len(_tokenize(text)) for text in texts]
+        self.avg_length = sum(self.doc_lengths) / max(len(texts), 1)
+        self.postings: Dict[str, List[Tuple[int, int]]] = defaultdict(list)  # term -> [(doc index, term frequency)]
+        for i, text in enumerate(texts):
+            for term, tf in Counter(_tokenize(text)).items():
+                self.postings[term].append((i, tf))
+        self.idf = {term: ln(1 + (len(texts) - len(docs) + .5) / (len(docs) + .5)) for term, docs in self.postings.items()}
+
+    def search(self, query: str, k: int) -> List[Tuple[int, float]]:
+        """Returns the indices & scores of the top `k` texts"""
+        scores: Dict[int, float] = defaultdict(float)
+        for term in set(_tokenize(query)):
+            for i, tf in self.postings.get(term, []):
+                norm = self.k1 * (1 - self.b + self.b * self.doc_lengths[i] / self.avg_length)
+                scores[i] += self.idf[term] * tf * (self.k1 + 1) / (tf + norm)
+        return sorted(scores.items(), key=lambda x: x[1], reverse=True)[:k]
+
+
+## Main class
+class HybridRetriever:
+    """
+    Retrieves company-doc chunks by fusing BM25 (sparse) & Chroma (dense) rankings with reciprocal rank fusion.
+    Both indexes share the chunk store written by `create_vectorstore.py`. The "lexical" mode skips the embedder
+    entirely, & hybrid retrieval falls back to it for `DENSE_COOLDOWN` seconds whenever the embedder fails or is slower
+    than `DENSE_TIMEOUT` seconds.
+    """
+    def __init__(self, k: int = TOP_K, mode: RetrievalMode = RETRIEVAL_MODE, chunk_store_path: str = CHUNK_STORE_PATH) -> None:
+        self.k, self.mode, self.chunk_store_path = k, mode, chunk_store_path
+        self.vectorstore = Chroma(persist_directory=VECSTORE_PERSIST_DIR, embedding_function=EMBEDDER) if mode != 'lexical' else None
+        self._executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix='dense-retrieval')
+        self._lock = Lock()
+        self._index: Tuple[Optional[float], List[Chunk], BM25Index, Dict[str, int]] = (None, [], BM25Index([]), {})
+        self._dense_disabled_until = 0.
+
+
+    def invoke(self, query: str) -> List[Document]:
+        """Returns the top `k` chunks for the query"""
+        _, chunks, bm25, positions = self._get_index()
+        rankings = []
+        if self.mode != 'dense':
+            rankings.append([i for i, _ in bm25.search(query, 2 * self.k)])
+        if self.mode != 'lexical' and (dense := self._dense_search(query, positions)) is not None:
+            rankings.append(dense)
+        elif self.mode == 'dense':
+            rankings.append([i for i, _ in bm25.search(query, 2 * self.k)])  # Dense retrieval is down
+
+        fused: Dict[int, float] = defaultdict(float)
+        for ranking in rankings:
+            for rank, i in enumerate(ranking):
+                fused[i] += 1 / (RRF_K + rank + 1)
+        top = sorted(fused, key=fused.get, reverse=True)[:self.k]
+        return [Document(page_content=chunks[i]['text'], metadata={'source': chunks[i]['source'], 'id': chunks[i]['id']}) for i in top]
+
+
+    def _dense_search(self, query: str, positions: Dict[str, int]) -> Optional[List[int]]:
+        """Returns the chunk indices ranked by the vectorstore, or `None` if the embedder is slow or down"""
+        with self._lock:
+            if monotonic() < self._dense_disabled_until: return None
+        try:
+            docs = self._executor.submit(self.vectorstore.similarity_search, query, 2 * self.k).result(timeout=DENSE_TIMEOUT)
+            return [positions[doc.page_content] for doc in docs if doc.page_content in positions]
+        except Exception as e:
+            with self._lock: self._dense_disabled_until = monotonic() + DENSE_COOLDOWN
+            err_log('HybridRetriever._dense_search', e, 'model')
+            log(f'[HybridRetriever] Falling back to lexical retrieval for {DENSE_COOLDOWN} seconds', 'model')
+
+
+    def _get_index(self) -> Tuple[Optional[float], List[Chunk], BM25Index, Dict[str, int]]:
+        """Returns the BM25 index, rebuilding it whenever the chunk store changes"""
+        mtime = os.path.getmtime(self.chunk_store_path) if os.path.exists(self.chunk_store_path) else None
+        with self._lock:
+            if self._index[0] != mtime or (mtime is None and not self._index[1]):
+                chunks = load_chunks(self.chunk_store_path) or self._chunks_from_vectorstore()
+                self._index = (mtime, chunks, BM25Index([c['text'] for c in chunks]), {c['text']: i for i, c in enumerate(chunks)})
+            return self._index
+
+
+    def _chunks_from_vectorstore(self) -> List[Chunk]:
+        """Recovers the chunks of a vectorstore built before the chunk store existed"""
+        if self.vectorstore is None: return []
+        try:
+            stored = self.vectorstore.get(include=['documents', 'metadatas'])
+            return [make_chunk(text, (meta or {}).get('source', '')) for text, meta in zip(stored['documents'], stored['metadatas'])]
+        except Exception as e:
+            err_log('HybridRetriever._chunks_from_vectorstore', e, 'model')
+            return []
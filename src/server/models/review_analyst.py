@@ -1,5 +1,6 @@
 from typing import TypeAlias, Literal
 from src.lib.data.constants import CHAT_LLM
+from src.lib.utils.gateway import Priority
 
 SentimentInt: TypeAlias = Literal[1, 0, -1]
 
@@ -18,8 +19,8 @@ class _ReviewAnalyst:
         Review: {review}
         '''
 
-        # Process the response
-        response = CHAT_LLM.invoke(prompt)
+        # Process the response (queued behind interactive chat requests)
+        response = CHAT_LLM.with_priority(Priority.BACKGROUND).invoke(prompt)
         sentiment = response.content.strip().lower()
 
         # Map the sentiment to the corresponding integer value
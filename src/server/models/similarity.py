@@ -0,0 +1,70 @@
+from typing import List, Optional
+import numpy as np
+from src.lib.data.constants import SIMILARITY_BLOCK_SIZE
+
+def normalize_rows(vectors: np.ndarray) -> np.ndarray:
+    """Returns the L2-normalized float32 rows (zero rows stay zero), so cosine similarity becomes a dot product"""
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return np.divide(vectors, norms, out=np.zeros_like(vectors), where=norms > 0)
+
+
+class SimilarityEngine:
+    """
+    Top-k product search over pre-normalized rows (e.g., a memory-mapped feature store), each labeled with a product ID.
+    Scores are reduced to the best one per product with a grouped max before an `argpartition` top-k, and many queries
+    are scored at once with a blocked matrix product that computes at most `block_size` scores per block. Quantized rows
+    (float16 or int8) are kept as stored (e.g., memory-mapped) & converted to float32 at most `block_size` values at a
+    time while scoring, since BLAS only multiplies floats.
+    """
+    def __init__(self, unit_vectors: np.ndarray, product_ids: np.ndarray, block_size: int = SIMILARITY_BLOCK_SIZE) -> None:
+        unit_vectors = np.asarray(unit_vectors)
+        self.unit_vectors = unit_vectors if unit_vectors.dtype in (np.float32, np.float16, np.int8) else unit_vectors.astype(np.float32)
+        self.block_size = block_size
+        self._order = np.argsort(product_ids, kind='stable')  # Groups the rows by product
+        self.products, self._starts = np.unique(np.asarray(product_ids)[self._order], return_index=True)
+        self._position = np.empty_like(self._order)  # Row -> column in product order
+        self._position[self._order] = np.arange(len(self._order))
+
+    def __len__(self) -> int:
+        return len(self.unit_vectors)
+
+
+    def top_products_for_rows(self, rows: np.ndarray, top_k: int) -> List[List[int]]:
+        """Returns the `top_k` products most similar to each of the given rows, ignoring the rows themselves"""
+        rows = np.asarray(rows, dtype=np.int64)
+        return self._search(lambda block: self.unit_vectors[rows[block]].astype(np.float32, copy=False), len(rows), top_k, exclude=rows)
+
+
+    def top_products(self, queries: np.ndarray, top_k: int) -> List[List[int]]:
+        """Returns the `top_k` products most similar to each of the given (not necessarily normalized) query vectors"""
+        queries = np.atleast_2d(queries)
+        return self._search(lambda block: normalize_rows(queries[block]), len(queries), top_k)
+
+
+    def _search(self, get_queries, n_queries: int, top_k: int, exclude: Optional[np.ndarray] = None) -> List[List[int]]:
+        k = min(top_k, len(self.products))
+        if k <= 0 or not len(self): return [[] for _ in range(n_queries)]
+        step, results = max(self.block_size // len(self), 1), []
+        for start in range(0, n_queries, step):
+            block = slice(start, min(start + step, n_queries))
+            scores = self._scores(get_queries(block))[:, self._order]
+            if exclude is not None:
+                scores[np.arange(scores.shape[0]), self._position[exclude[block]]] = -np.inf
+            best = np.maximum.reduceat(scores, self._starts, axis=1)  # Max. score per product
+            top = np.argpartition(-best, k - 1, axis=1)[:, :k]
+            top_scores = np.take_along_axis(best, top, axis=1)
+            ranking = np.argsort(-top_scores, axis=1, kind='stable')
+            top, top_scores = np.take_along_axis(top, ranking, axis=1), np.take_along_axis(top_scores, ranking, axis=1)
+            results += [self.products[idx[s > -np.inf]].astype(int).tolist() for idx, s in zip(top, top_scores)]
+        return results
+
+
+    def _scores(self, queries: np.ndarray) -> np.ndarray:
+        """Scores the queries against every row, upcasting quantized rows one block at a time"""
+        if self.unit_vectors.dtype == np.float32: return queries @ self.unit_vectors.T
+        scores = np.empty((len(queries), len(self)), dtype=np.float32)
+        step = max(self.block_size // max(self.unit_vectors.shape[1], 1), 1)
+        for start in range(0, len(self), step):
+            scores[:, start:start + step] = queries @ self.unit_vectors[start:start + step].astype(np.float32).T
+        return scores
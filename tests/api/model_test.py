@@ -1,4 +1,5 @@
-from src.lib.utils.tests import request, check_status
+import requests, json
+from src.lib.utils.tests import request, check_status, endpoint
 
 def test_chatbot_response():
     res = request('chatbot', 'post', content='hi', sender='', conversation=[])
@@ -6,8 +7,43 @@ def test_chatbot_response():
     check_status(res)
     assert (res_data['sender'] == 'chatbot') and (not 'sorry' in res_data['content'].lower()), 'Bad response'
 
+def test_chatbot_stream_response():
+    res = requests.post(endpoint('chatbot/stream'), data=json.dumps(dict(content='hi', sender='', conversation=[])), stream=True)
+    check_status(res)
+    events = [line for line in res.iter_lines(decode_unicode=True) if line.startswith('data: ')]
+    content = ''.join(json.loads(line[len('data: '):])['content'] for line in events)
+    assert len(events) > 1 and (not 'sorry' in content.lower()), 'Bad streamed response'
+
 def test_review_analyst_inference():
     res = request('review_analyst', 'post', review_text='I didn\'t like it')
     res_data = res.json()
     check_status(res)
-    assert type(res_data) is int and res_data == -1, 'Invalid response type'
\ No newline at end of file
+    assert type(res_data) is int and res_data == -1, 'Invalid response type'
+
+def test_recommender_batch():
+    res = request('recommender/batch', 'post', usernames=['RandomUser123'], top_k=3)
+    check_status(res)
+    assert res.json() == {}, 'Non-existent user got recommendations'
+
+def test_recommender_cold_start():
+    username, password = 'ColdStartUser', 'abc'
+    check_status(request('create_account', 'post', username=username, password=password))
+    try:
+        res = requests.get(endpoint('recommender'), params=dict(username=username))
+        batch = request('recommender/batch', 'post', usernames=[username, 'RandomUser123'], top_k=3).json()
+    finally:
+        request('delete_account', 'delete', username=username, password=password)
+    check_status(res)
+    products = res.json()
+    assert type(products) is list and len({p['product_id'] for p in products}) == len(products) > 0, 'Cold-start user did not get the popular products'
+    assert batch == {username: products[:3]}, 'Single & batch cold-start recommendations differ'
+
+def test_recommender_top_k():
+    assert request('recommender/batch', 'post', usernames=['RandomUser123'], top_k=-1).status_code == 422, 'Negative top_k was accepted'
+    assert requests.get(endpoint('recommender'), params=dict(username='RandomUser123', top_k=0)).status_code == 422, 'Zero top_k was accepted'
+    assert requests.get(endpoint('similar_products'), params=dict(product_id=1, top_k=-1)).status_code == 422, 'Negative top_k was accepted'
+
+def test_similar_products():
+    res = requests.get(endpoint('similar_products'), params=dict(product_id=-1))
+    check_status(res)
+    assert res.json() == [], 'Bad similar products'
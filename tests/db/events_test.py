@@ -0,0 +1,13 @@
+from threading import Timer
+from time import monotonic
+from src.lib.utils.events import Debouncer
+
+def test_debouncer():
+    debouncer = Debouncer(quiet=.2, max_delay=1, max_staleness=.3)
+    start = monotonic()
+    assert debouncer.wait() == 0 and monotonic() - start >= .3, 'Debouncer did not wait for the max. staleness'
+
+    for delay in (.05, .1, .15): Timer(delay, debouncer.notify).start()
+    debouncer.max_staleness = 10
+    start = monotonic()
+    assert debouncer.wait() == 3 and .3 <= monotonic() - start < 1, 'Debouncer did not coalesce the burst of events'
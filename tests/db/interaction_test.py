@@ -1,8 +1,12 @@
+from threading import Event
+from contextlib import contextmanager
+from sqlalchemy import event, select, desc
 from src.lib.utils.tests import DBTests, SAMPLE_CRED, SAMPLE_PRODUCT_ID
-from src.lib.data.db import InteractionData
+from src.lib.data.db import InteractionData, Interaction, Session, engine
 from src.lib.utils.db import (
     is_product_in_cart,
     get_all_interactions, 
+    get_interactions_by_keys,
     rate_product,
     unrate_product,
     get_reviews_of_product, 
@@ -11,9 +15,25 @@ from src.lib.utils.db import (
     update_product_review,
     add_product_to_cart,
     remove_product_from_cart,
-    get_most_rated_products
+    get_most_rated_products,
+    get_cart,
+    get_category_affinities,
+    get_product_using_id,
+    change_bus
 )
 
+@contextmanager
+def _count_queries():
+    """Counts the SQL statements sent to the database"""
+    queries = []
+    count = lambda *args: queries.append(args[2])
+    event.listen(engine, 'before_cursor_execute', count)
+    try:
+        yield queries
+    finally:
+        event.remove(engine, 'before_cursor_execute', count)
+
+
 class TestInteraction(DBTests):
     def test_get_all_interactions(self):
         interactions = get_all_interactions()
@@ -89,4 +109,49 @@ class TestInteraction(DBTests):
 
     def test_get_most_rated_products(self):
         products = get_most_rated_products()
-        assert type(products) is list and len(products) == 3, 'Failed to get most rated products'
\ No newline at end of file
+        assert type(products) is list and len(products) == 3, 'Failed to get most rated products'
+
+
+    def test_get_most_rated_products_in_one_query(self):
+        with Session() as session:  # Previous path: one product query per top interaction
+            stmt = select(Interaction).order_by(desc(Interaction.rating)).limit(3)
+            expected = [get_product_using_id(i.product_id).product_id for i in session.execute(stmt).scalars().all()]
+        with _count_queries() as queries:
+            products = get_most_rated_products()
+        assert [p.product_id for p in products] == expected and len(queries) == 2, 'Most rated products changed or were fetched one by one'
+
+
+    def test_get_cart(self):
+        product_ids = [SAMPLE_PRODUCT_ID, 1, 2]
+        add_product_to_cart(SAMPLE_CRED, product_ids[0])
+        with _count_queries() as queries: get_cart(SAMPLE_CRED)
+        n_queries = len(queries)
+        for product_id in product_ids[1:]: add_product_to_cart(SAMPLE_CRED, product_id)
+        rate_product(SAMPLE_CRED, 3)  # Not in the cart
+        expected = [  # Previous path: one product query per interaction in the cart
+            get_product_using_id(i.product_id).product_id
+            for i in get_all_interactions(username=SAMPLE_CRED.username) if i.in_cart
+        ]
+        with _count_queries() as queries:
+            cart = get_cart(SAMPLE_CRED)
+        assert [p.product_id for p in cart] == expected and sorted(expected) == sorted(product_ids), 'Failed to get the cart'
+        assert len(queries) == n_queries, 'Cart products were fetched one by one'
+
+
+    def test_get_category_affinities(self):
+        add_product_to_cart(SAMPLE_CRED, SAMPLE_PRODUCT_ID)
+        affinities = get_category_affinities([SAMPLE_CRED.username, 'Nobody'])
+        assert get_product_using_id(SAMPLE_PRODUCT_ID).category in affinities[SAMPLE_CRED.username] and affinities['Nobody'] == [], 'Failed to get category affinities'
+
+
+    def test_get_interactions_by_keys(self):
+        rate_product(SAMPLE_CRED, SAMPLE_PRODUCT_ID)
+        interactions = get_interactions_by_keys([(SAMPLE_CRED.username, SAMPLE_PRODUCT_ID), ('Nobody', SAMPLE_PRODUCT_ID)])
+        assert [(i.username, i.product_id, i.rating) for i in interactions] == [(SAMPLE_CRED.username, SAMPLE_PRODUCT_ID, 1)], 'Failed to get interactions by keys'
+
+
+    def test_change_events(self):
+        received = Event()
+        change_bus.subscribe(lambda change: received.set() if change.table == 'interactions' and change.keys['product_id'] == SAMPLE_PRODUCT_ID else None)
+        add_product_to_cart(SAMPLE_CRED, SAMPLE_PRODUCT_ID)
+        assert received.wait(5), 'Failed to publish a change event for the interaction'
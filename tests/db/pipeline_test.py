@@ -0,0 +1,121 @@
+import pandas as pd, numpy as np
+from src.lib.utils.cache import CachedEmbeddings
+from src.server.models.similarity import normalize_rows
+import src.db.scripts.recommendation_data_pipeline as pipeline
+
+class _WordEmbedder:
+    """Stub embedder that counts the words of a text, so texts sharing words are similar"""
+    def __init__(self) -> None:
+        self.vocabulary = {}
+
+    def embed_documents(self, texts):
+        vectors = np.zeros((len(texts), 32), dtype=np.float32)
+        for i, text in enumerate(texts):
+            for word in text.lower().split(): vectors[i, self.vocabulary.setdefault(word, len(self.vocabulary)) % 32] += 1
+        return list(vectors)
+
+    def embed_query(self, text):
+        return self.embed_documents([text])[0]
+
+
+def _tables(n_interactions: int):
+    rng = np.random.default_rng(0)
+    users_df = pd.DataFrame({'username': [f'user{i}' for i in range(20)], 'bio': [f'Bio {i % 7}' if i % 5 else None for i in range(20)]})
+    products_df = pd.DataFrame({
+        'product_id': np.arange(1, 11), 'name': [f'Product {i}' for i in range(10)], 'description': [f'Item of type {i % 3}' for i in range(10)],
+        'price': rng.uniform(1, 500, 10), 'category': rng.choice(['Books', 'Toys', None], 10), 'owner': rng.choice(users_df['username'], 10)
+    })
+    interactions_df = pd.DataFrame({
+        'username': rng.choice(users_df['username'], n_interactions), 'product_id': rng.integers(1, 12, n_interactions),  # 11 is unknown
+        'rating': rng.integers(0, 2, n_interactions), 'sentiments': [[int(s)] if s else None for s in rng.integers(-1, 2, n_interactions)],
+        'in_cart': rng.integers(0, 2, n_interactions).astype(bool)
+    }).drop_duplicates(['username', 'product_id'], ignore_index=True)
+    return interactions_df, users_df, products_df
+
+
+def test_streaming_transform(tmp_path, monkeypatch):
+    monkeypatch.setattr(pipeline, 'text_embedder', CachedEmbeddings(_WordEmbedder(), max_size=100))
+    monkeypatch.setattr(pipeline, '_worker', {})
+    interactions_df, users_df, products_df = _tables(150)
+    expected, expected_scalers, expected_encoders = pipeline.transform_data(interactions_df, users_df, products_df)
+
+    chunks = [interactions_df[i:i + 32] for i in range(0, len(interactions_df), 32)]
+    text_vectors, users, products = pipeline._embed_texts(users_df, products_df)
+    n_rows, scalers, encoders = pipeline.fit_streaming_transform(iter(chunks), users, products)
+    assert n_rows == len(interactions_df), 'Wrong number of streamed rows'
+    for col, scaler in scalers.items():
+        assert np.allclose([scaler.mean_, scaler.scale_], [expected_scalers[col].mean_, expected_scalers[col].scale_]), f'Wrong {col} scaler'
+    for col, encoder in encoders.items():
+        assert list(encoder.classes_) == list(expected_encoders[col].classes_), f'Wrong {col} encoder'
+
+    matrix_path = str(tmp_path / 'interactions.npy')
+    np.lib.format.open_memmap(matrix_path, mode='w+', dtype=np.float32, shape=(n_rows, expected.shape[1])).flush()
+    pipeline._init_worker({'users': users, 'products': products, 'text_vectors': text_vectors, 'scalers': scalers, 'encoders': encoders})
+    offset = 0
+    for chunk in chunks:
+        pipeline.transform_chunk(chunk, matrix_path, offset)
+        offset += len(chunk)
+    assert np.allclose(np.load(matrix_path), normalize_rows(expected.to_numpy(dtype=np.float32)), atol=1e-6), 'Streamed & in-memory rows differ'
+
+    usernames, product_ids, user_codes, item_codes = pd.Index(['user3', 'user0']), pd.Index([2, 1]), [], []  # Unsorted, missing values
+    for chunk in chunks:
+        usernames, codes = pipeline._encode(usernames, chunk['username'])
+        user_codes.append(codes)
+        product_ids, codes = pipeline._encode(product_ids, chunk['product_id'])
+        item_codes.append(codes)
+    assert np.concatenate(user_codes).dtype == np.int32 and usernames[np.concatenate(user_codes)].tolist() == interactions_df['username'].tolist(), 'Wrong user codes'
+    weights, categories = pipeline._interaction_weights(interactions_df), dict(zip(products_df['product_id'], products_df['category']))
+    streamed = pipeline._build_profiles(np.load(matrix_path), np.concatenate(user_codes), usernames, np.concatenate(item_codes), product_ids, weights, categories)
+    in_memory = pipeline.build_profiles(np.load(matrix_path), interactions_df['username'], interactions_df['product_id'], weights, categories)
+    order = np.argsort(streamed['usernames'])
+    assert streamed['usernames'][order].tolist() == in_memory['usernames'].tolist() and np.allclose(streamed['user_vectors'][order], in_memory['user_vectors']), 'Wrong streamed profiles'
+    assert streamed['recommendations'] == in_memory['recommendations'] and np.allclose(streamed['user_weights'][order], in_memory['user_weights']), 'Wrong streamed profiles'
+
+
+def test_profiles_follow_content(monkeypatch):
+    monkeypatch.setattr(pipeline, 'text_embedder', CachedEmbeddings(_WordEmbedder(), max_size=100))
+    pets = {100: 'cat', 101: 'dog', 102: 'cat', 103: 'dog', 104: 'dog', 3: 'cat'}  # IDs interleave so they can't separate the animals
+    products_df = pd.DataFrame({
+        'product_id': list(pets), 'name': [f'{pet} toy' for pet in pets.values()], 'description': [f'A toy your {pet} will love' for pet in pets.values()],
+        'price': [10., 12., 11., 9., 10., 11.], 'category': [f'{pet.title()}s' for pet in pets.values()], 'owner': ['zoe', 'amy', 'amy', 'zoe', 'amy', 'zoe']
+    })
+    users_df = pd.DataFrame({'username': ['amy', 'bob', 'zoe'], 'bio': ['I have pets'] * 3})
+    interactions_df = pd.DataFrame({
+        'username': ['amy', 'amy', 'bob', 'bob', 'zoe', 'zoe'], 'product_id': [100, 102, 101, 103, 104, 3],
+        'rating': [1] * 6, 'sentiments': [None] * 6, 'in_cart': [False] * 6
+    })
+    df, _, _ = pipeline.transform_data(interactions_df, users_df, products_df)
+    categories = dict(zip(products_df['product_id'], products_df['category']))
+    profiles = pipeline.build_profiles(normalize_rows(df.to_numpy(dtype=np.float32)), interactions_df['username'], interactions_df['product_id'], np.ones(6), categories)
+    recommendations = profiles['recommendations']
+    assert set(recommendations['amy'][:3]) == {100, 102, 3} and set(recommendations['bob'][:3]) == {101, 103, 104}, 'Recommendations do not follow the content'
+
+
+def test_neighbors_deletion_only(monkeypatch):
+    monkeypatch.setattr(pipeline, 'text_embedder', CachedEmbeddings(_WordEmbedder(), max_size=100))
+    products_df = _tables(0)[2]
+    neighbors = pipeline.refresh_neighbors(None, products_df)
+    assert pipeline.product_content_vectors(products_df[:0], neighbors[1])[0].shape == (0, 3 * 32 + 1), 'Wrong width of no products'
+
+    index, _ = pipeline.refresh_neighbors(neighbors, products_df[products_df['product_id'] != 4], (pd.Index([]), pd.Index([4])))
+    assert 4 not in index.table()[0] and 4 not in index.table()[1], 'Deleted product was kept'
+
+
+def test_refresh_recommendations(monkeypatch):
+    rng = np.random.default_rng(0)
+    users, products = np.array([f'user{i}' for i in range(200)]), np.arange(1, 301)
+    user_vectors, item_vectors = normalize_rows(rng.normal(size=(200, 16))), normalize_rows(rng.normal(size=(300, 16)))
+    previous = {
+        'usernames': users, 'user_vectors': user_vectors, 'product_ids': products, 'item_vectors': item_vectors,
+        'recommendations': pipeline.precompute_recommendations(pipeline.SimilarityEngine(item_vectors, products), users, user_vectors)
+    }
+    user_vectors, item_vectors = user_vectors.copy(), item_vectors.copy()
+    user_vectors[[3, 7]] = normalize_rows(rng.normal(size=(2, 16)))
+    item_vectors[[10, 20]] = user_vectors[[50, 60]]  # Enters the lists of users 50 & 60
+    keep = np.arange(300) != 30  # Deleted
+    similarity = pipeline.SimilarityEngine(item_vectors[keep], products[keep])
+    precompute, recomputed = pipeline.precompute_recommendations, []
+    monkeypatch.setattr(pipeline, 'precompute_recommendations', lambda *args: recomputed.extend(args[1]) or precompute(*args))
+    refreshed = pipeline._refresh_recommendations(similarity, users, user_vectors, previous, pd.Index(['user3', 'user7']), pd.Index([11, 21, 31]))
+    assert refreshed == precompute(similarity, users, user_vectors), 'Refreshed & recomputed recommendations differ'
+    assert {'user3', 'user7', 'user50', 'user60'} <= set(recomputed) and len(recomputed) < len(users) / 2, 'Wrong recomputed users'
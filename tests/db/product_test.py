@@ -2,7 +2,7 @@ import pytest
 from src.lib.utils.tests import DBTests, SAMPLE_CRED, SAMPLE_PRODUCT_ID
 from src.lib.data.db import NonExistent, NotOwner
 from src.lib.data.db import ProductData
-from src.lib.utils.db import get_all_products, get_product_using_id, is_owner_of_product, create_product, delete_product, update_product, search_products
+from src.lib.utils.db import get_all_products, get_product_using_id, get_products_by_ids, is_owner_of_product, create_product, delete_product, update_product, search_products
 
 class TestProduct(DBTests):
     def test_get_all_products(self):
@@ -15,6 +15,11 @@ class TestProduct(DBTests):
         assert type(product) is ProductData, 'Failed to get product by its ID'
     
 
+    def test_get_products_by_ids(self):
+        products = get_products_by_ids([SAMPLE_PRODUCT_ID, 100, 1, SAMPLE_PRODUCT_ID])
+        assert [p.product_id for p in products] == [SAMPLE_PRODUCT_ID, 1] and type(products[0]) is ProductData, 'Failed to get products by their IDs'
+
+
     def test_product_does_not_exist(self):
         with pytest.raises(NonExistent):
             get_product_using_id(100)
@@ -2,7 +2,7 @@ import pytest
 from src.lib.utils.tests import DBTests, SAMPLE_CRED
 from src.lib.data.db import Credentials, WrongCredentials
 from src.lib.data.db import UserData
-from src.lib.utils.db import get_all_users, account_exists, log_in_account, create_account, delete_account, edit_bio, get_user_info
+from src.lib.utils.db import get_all_users, account_exists, log_in_account, create_account, delete_account, edit_bio, get_user_info, get_users_info, existing_usernames
 
 class TestUser(DBTests):
     def test_get_all_users(self):
@@ -16,6 +16,10 @@ class TestUser(DBTests):
 
     def test_account_does_not_exists(self):
         assert account_exists(Credentials(username='RandomUser123', password='abc')) is False, 'Failed to determine non-existent account'
+
+
+    def test_existing_usernames(self):
+        assert existing_usernames(['RandomUser123', SAMPLE_CRED.username, SAMPLE_CRED.username]) == [SAMPLE_CRED.username], 'Failed to filter existing accounts'
     
 
     def test_correct_credentials(self):
@@ -48,4 +52,10 @@ class TestUser(DBTests):
     def test_get_user_info(self):
         username = SAMPLE_CRED.username
         user_info = get_user_info(username)
-        assert (user_info['username'] == username) and (user_info['bio'] is None) and (len(user_info['owned_products']) == 1), 'Failed to get user info'
\ No newline at end of file
+        assert (user_info['username'] == username) and (user_info['bio'] is None) and (len(user_info['owned_products']) == 1), 'Failed to get user info'
+    
+
+    def test_get_users_info(self):
+        username = SAMPLE_CRED.username
+        users_info = get_users_info([username, 'RandomUser123', username])
+        assert (len(users_info) == 1) and (users_info[0]['username'] == username) and (users_info[0]['owned_product_names'] == ['Test Product']), 'Failed to get users info'
\ No newline at end of file
@@ -1,31 +1,231 @@
-import pytest
-from src.server.models.chatbot import Chatbot
+import pytest, random, re, time
+from types import SimpleNamespace
+from concurrent.futures import ThreadPoolExecutor
+from langchain.schema import AIMessage, Document, HumanMessage, SystemMessage
+from langchain_core.messages import AIMessageChunk
+from src.server.models import chatbot as chatbot_module
+from src.server.models.chatbot import Chatbot, _ChatContext
+from src.lib.utils.cache import SemanticCache, CachedEmbeddings
+from src.server.models.prompt_builder import PromptBuilder, count_tokens
+from src.server.models.retriever import HybridRetriever, make_chunk, save_chunks, load_chunks
+from src.db.scripts import create_vectorstore
 
 # Fixtures
 @pytest.fixture
 def chatbot() -> Chatbot:
     return Chatbot()
 
+class _EchoLLM:
+    """Stub chat model that answers with every message it was prompted with"""
+    def invoke(self, messages):
+        time.sleep(random.random() / 100)  # Encourage thread interleaving
+        return AIMessage(' | '.join(msg.content for msg in messages))
+
+class _SlowStreamLLM:
+    """Stub chat model that streams a fixed number of tokens with a delay between each one"""
+    def __init__(self, n_tokens: int = 20, delay: float = .01) -> None:
+        self.n_tokens, self.delay, self.closed = n_tokens, delay, False
+
+    def stream(self, messages):
+        try:
+            for i in range(self.n_tokens):
+                time.sleep(self.delay)
+                yield AIMessageChunk(f'token{i} ')
+        finally:
+            self.closed = True
+
+class _BagOfWordsEmbedder:
+    """Stub embedder that counts hashed words, so questions sharing most words are similar"""
+    def embed_query(self, text):
+        vector = [0.] * 64
+        for word in text.replace('?', '').split(): vector[hash(word) % 64] += 1
+        return vector
+
+    def embed_documents(self, texts):
+        self.n_embedded = getattr(self, 'n_embedded', 0) + len(texts)
+        return [self.embed_query(text) for text in texts]
+
 # Tests
 def test_parse_conversation(chatbot):
     msgs = [{'sender': '', 'content': 'Hi.'}, {'sender': 'chatbot', 'content': 'Hello.'}, {'sender': 'system', 'content': '...'}]
-    chatbot._parse_conversation(msgs)
-    all_msgs = [msg.content for msg in chatbot.history]
-    assert len(chatbot.history) == 4, 'Invalid conversation history'
+    ctx = _ChatContext('')
+    chatbot._parse_conversation(ctx, msgs)
+    all_msgs = [msg.content for msg in ctx.conversation]
+    assert len(ctx.conversation) == 3, 'Invalid conversation history'
     assert all(msg['content'] in all_msgs for msg in msgs), 'Could not parse messages'
 
 
 def test_memory(chatbot):
     conv = [
-        {'sender': '', 'content': 'my name is Beraw'}, 
+        {'sender': '', 'content': 'my name is Beraw'},
         {'sender': 'chatbot', 'content': "Hello Beraw! Welcome to EcomGo's customer support! It's great to have you on board. I don't see any specific questions or concerns from you yet, so feel free to ask me anything about our products, services, or platform in general. I'm here to help!"}
     ]
     answer = chatbot('what is my name', conv=conv)
-    assert len(chatbot.history) == 1, 'Memory was not reset'
+    assert not hasattr(chatbot, 'history'), 'Chatbot kept conversation state'
     assert 'beraw' in answer.lower(), 'Could not remember past info'
 
 
 def test_retrieve_docs(chatbot):
     response = chatbot.chat('What is my username?', sender='GadgetCo')
-    assert len(chatbot.history) == 1, 'Memory was not reset'
-    assert 'gadgetco' in response.lower(), 'Answer was not in response'
\ No newline at end of file
+    assert not hasattr(chatbot, 'history'), 'Chatbot kept conversation state'
+    assert 'gadgetco' in response.lower(), 'Answer was not in response'
+
+
+def test_immutable(chatbot):
+    with pytest.raises(AttributeError):
+        chatbot.llm = None
+
+
+def test_concurrent_conversations_do_not_cross_talk(monkeypatch):
+    class _StubRetriever:
+        def invoke(self, query):
+            time.sleep(random.random() / 100)
+            return [Document(page_content=f'doc for {query}')]
+
+    marker = lambda text: re.search(r'<\d+>', text).group()
+    product = lambda name: SimpleNamespace(name=name, owner='', price=1., discount=0.)
+    monkeypatch.setattr(chatbot_module, '_condition', lambda question: True)
+    monkeypatch.setattr(chatbot_module, 'search_products', lambda prompt: [product(f'product {marker(prompt)}')])
+    monkeypatch.setattr(chatbot_module, 'search_users', lambda prompt: [SimpleNamespace(username=f'seller {marker(prompt)}')])
+    monkeypatch.setattr(chatbot_module, 'get_users_info', lambda usernames: [{'username': u, 'bio': '', 'owned_product_names': []} for u in usernames])
+    monkeypatch.setattr(chatbot_module, 'get_user_info', lambda username: {'username': username, 'bio': f'bio of {username}'})
+    monkeypatch.setattr(Chatbot, '_build_retriever', lambda self: _StubRetriever())
+    monkeypatch.setattr(Chatbot, '_build_cache', lambda self: SemanticCache(_BagOfWordsEmbedder(), threshold=.99, max_size=2, ttl=None))
+    chatbot = Chatbot(llm=_EchoLLM())
+
+    def turn(i: int) -> str:
+        return chatbot.chat(f'question <{i}>', sender=f'customer <{i}>', conv=[{'sender': '', 'content': f'conv <{i}>'}, {'sender': 'chatbot', 'content': 'ok'}])
+
+    with ThreadPoolExecutor(max_workers=32) as pool:
+        answers = list(pool.map(turn, range(256)))
+
+    for i, answer in enumerate(answers):
+        assert set(re.findall(r'<\d+>', answer)) == {f'<{i}>'}, f'Conversation {i} leaked into another one: "{answer}"'
+        assert all(part in answer for part in (f'conv <{i}>', f'doc for question <{i}>', f'product <{i}>', f'seller <{i}>', f'customer <{i}>')), f'Conversation {i} lost context: "{answer}"'
+
+
+def test_stream_time_to_first_token():
+    llm = _SlowStreamLLM()
+    chatbot = Chatbot(llm=llm)
+    ctx = _ChatContext('hi')
+    ctx.history.append(HumanMessage('hi'))
+
+    start = time.perf_counter()
+    tokens = chatbot._stream(ctx)
+    first = next(tokens)
+    ttft = time.perf_counter() - start
+    rest = list(tokens)
+    total = time.perf_counter() - start
+    assert first == 'token0 ' and len(rest) == llm.n_tokens - 1, 'Tokens were not streamed'
+    assert ttft < total / 5, f'First token was not sent early ({ttft=:.3f}s, {total=:.3f}s)'
+
+
+def test_stream_cancellation():
+    llm = _SlowStreamLLM(n_tokens=1000)
+    tokens = Chatbot(llm=llm)._stream(_ChatContext('hi'))
+    next(tokens)
+    tokens.close()
+    assert llm.closed, 'LLM stream was not closed after cancellation'
+
+
+def test_semantic_cache():
+    cache = SemanticCache(_BagOfWordsEmbedder(), threshold=.8, max_size=2, ttl=60)
+    cache.seed([('What is your return policy?', 'FAQ answer')])
+    cache.store('Do you ship to Canada?', 'Learned answer')
+    assert cache.lookup('what is your   return policy') == 'FAQ answer', 'Seeded answer was not found'
+    assert cache.lookup('Do you ship to Canada') == 'Learned answer', 'Near-duplicate question missed the cache'
+    assert cache.lookup('Do you ship to Canada', pinned_only=True) is None, 'Learned answer was shared with a known sender'
+    assert cache.lookup('How do I reset my password?') is None, 'Unrelated question hit the cache'
+
+
+def test_semantic_cache_seeds_match_queries():
+    class _AsymmetricEmbedder(_BagOfWordsEmbedder):
+        """Prefixes documents & queries differently (like "passage: " vs. "query: "), so their vectors differ"""
+        def embed_query(self, text): return super().embed_query(f'query: {text}')
+        def embed_documents(self, texts): return [super().embed_query(f'passage: {text}') for text in texts]
+
+    cache = SemanticCache(_AsymmetricEmbedder(), threshold=.95, max_size=2, ttl=None)
+    cache.seed([('What is your return policy?', 'FAQ answer')])
+    assert cache.lookup('What is your return policy?') == 'FAQ answer', 'Seed & identical question were embedded differently'
+
+
+def test_semantic_cache_eviction():
+    cache = SemanticCache(_BagOfWordsEmbedder(), threshold=.99, max_size=2, ttl=None)
+    cache.seed([('What is EcomGo?', 'FAQ answer')])
+    for i in range(3): cache.store(f'question number {i}', f'answer {i}')
+    assert cache.lookup('question number 0') is None and len(cache) == 3, 'Least recently used answer was not evicted'
+    assert cache.lookup('What is EcomGo?') == 'FAQ answer', 'Pinned answer was evicted'
+
+    expiring = SemanticCache(_BagOfWordsEmbedder(), threshold=.99, max_size=2, ttl=0)
+    expiring.store('question', 'answer')
+    assert expiring.lookup('question') is None, 'Expired answer was returned'
+
+
+def test_cached_embeddings(tmp_path):
+    embedder = _BagOfWordsEmbedder()
+    cached = CachedEmbeddings(embedder, max_size=8, persist_path=str(tmp_path / 'cache.sqlite'))
+    vectors = cached.embed_documents(['Return policy', 'return  POLICY', 'Shipping'])
+    cached.embed_documents(['shipping'])
+    assert embedder.n_embedded == 2 and vectors[0] == vectors[1], 'Identical texts were embedded twice'
+
+    reloaded = CachedEmbeddings(embedder, max_size=8, persist_path=str(tmp_path / 'cache.sqlite'))
+    assert reloaded.embed_documents(['Return policy']) == vectors[:1] and embedder.n_embedded == 2, 'Persisted embeddings were not reused'
+
+
+def test_prompt_budget():
+    summarized = []
+    builder = PromptBuilder(lambda previous, new: summarized.append(new) or 'SUMMARY', budget=200, recent_turns=2)
+    conversation = [HumanMessage(f'message {i} ' * 20) for i in range(6)]
+    chunks = ['Returns are free within 30 days of delivery.'] * 3 + ['Unrelated chunk ' * 60]
+    messages, n_tokens = builder.build(SystemMessage('Base'), 'What is the return policy?', '{docs} {question}', conversation, [], [], chunks)
+    assert n_tokens['total'] <= 200 and n_tokens['total'] == sum(count_tokens(m.content) for m in messages), 'Prompt exceeded its budget'
+    assert 'SUMMARY' in messages[1].content and len(summarized) == 1, 'Older turns were not summarized'
+    assert messages[-1].content.count('Returns are free') == 1, 'Duplicate chunks were not removed'
+
+    conversation.append(HumanMessage('message 6'))
+    builder.build(SystemMessage('Base'), 'Anything else?', '{docs} {question}', conversation, [], [], [])
+    assert len(summarized) == 2 and 'message 0' not in summarized[1], 'Summary was not extended incrementally'
+
+
+def test_hybrid_retrieval(tmp_path):
+    class _StubVectorstore:
+        def __init__(self, ranking, delay=0): self.ranking, self.delay, self.n_calls = ranking, delay, 0
+        def similarity_search(self, query, k):
+            self.n_calls += 1
+            time.sleep(self.delay)
+            return [Document(page_content=text) for text in self.ranking[:k]]
+
+    texts = ['The X-100 blender has a 2 year warranty.', 'Returns are free within 30 days.', 'We ship worldwide.', 'Gift cards never expire.']
+    save_chunks([make_chunk(text, 'docs.txt') for text in texts], str(tmp_path / 'chunks.json'))
+    retriever = HybridRetriever(k=2, mode='lexical', chunk_store_path=str(tmp_path / 'chunks.json'))
+    assert retriever.invoke('x-100 warranty')[0].page_content == texts[0], 'Exact terms were not matched lexically'
+
+    retriever.mode, retriever.vectorstore = 'hybrid', _StubVectorstore([texts[2], texts[1]])
+    assert [doc.page_content for doc in retriever.invoke('free returns')] == [texts[1], texts[2]], 'Rankings were not fused'
+
+    retriever.vectorstore = _StubVectorstore(texts, delay=5)
+    start = time.perf_counter()
+    assert retriever.invoke('gift cards')[0].page_content == texts[3] and time.perf_counter() - start < 5, 'Slow embedder was not bypassed'
+    retriever.invoke('gift cards')
+    assert retriever.vectorstore.n_calls == 1, 'Dense retrieval was retried during its cooldown'
+
+
+def test_incremental_vectorstore(tmp_path, monkeypatch):
+    embedder = _BagOfWordsEmbedder()
+    monkeypatch.setattr(create_vectorstore, 'EMBEDDER', embedder)
+    paragraphs = [f'Paragraph {i}: ' + ' '.join(f'policy{i}_{j}' for j in range(80)) for i in range(10)]
+    (tmp_path / 'a.txt').write_text('\n\n'.join(paragraphs))
+    (tmp_path / 'b.txt').write_text('Shipping takes 3 days.')
+    update = lambda: create_vectorstore.update_vectorstore([str(tmp_path / '*.txt')], str(tmp_path / 'vectorstore'), str(tmp_path / 'chunks.json'))
+
+    n_chunks = update()
+    assert n_chunks == len(load_chunks(str(tmp_path / 'chunks.json'))) > 10, 'Sources were not fully indexed'
+    assert update() == 0, 'Unchanged chunks were re-embedded'
+
+    paragraphs[4] = 'Paragraph 4 was rewritten.'
+    (tmp_path / 'a.txt').write_text('\n\n'.join(paragraphs))
+    (tmp_path / 'b.txt').unlink()
+    assert 0 < update() <= 3, 'Unchanged chunks were re-embedded after a small edit'
+    chunks = load_chunks(str(tmp_path / 'chunks.json'))
+    stored = create_vectorstore.Chroma(persist_directory=str(tmp_path / 'vectorstore'), embedding_function=embedder).get(include=[])['ids']
+    assert sorted(stored) == sorted(c['id'] for c in chunks) and all(c['source'].endswith('a.txt') for c in chunks), 'Stale chunks were not deleted'
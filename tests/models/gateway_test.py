@@ -0,0 +1,103 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+from threading import Event, Lock, Semaphore
+from src.lib.utils.gateway import LLMGateway, Priority
+
+# Stub backends
+class _StubLLM:
+    """Records calls & the max. number of concurrent ones"""
+    def __init__(self, delay: float = .02) -> None:
+        self.delay, self.calls, self.active, self.max_active = delay, [], 0, 0
+        self._lock = Lock()
+
+    def invoke(self, prompt):
+        with self._lock:
+            self.calls.append(prompt)
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+        time.sleep(self.delay)
+        with self._lock: self.active -= 1
+        return f'answer to {prompt}'
+
+class _StubEmbeddings:
+    def __init__(self) -> None:
+        self.batches = []
+
+    def embed_documents(self, texts):
+        self.batches.append(list(texts))
+        return [[float(len(text))] for text in texts]
+
+    def embed_query(self, text):
+        return self.embed_documents([text])[0]
+
+# Tests
+def test_concurrency_limit():
+    backend = _StubLLM()
+    llm = LLMGateway(default_limit=2).llm(backend, 'stub')
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        answers = list(pool.map(llm.invoke, [f'prompt {i}' for i in range(16)]))
+    assert answers == [f'answer to prompt {i}' for i in range(16)], 'Wrong answers'
+    assert backend.max_active == 2, f'Concurrency limit was not respected ({backend.max_active} in flight)'
+
+
+def test_priority_queue():
+    backend, gateway, started = _StubLLM(delay=0), LLMGateway(default_limit=1), Event()
+    blocker_release = Event()
+
+    def block():
+        with gateway.lane('stub').slot(Priority.INTERACTIVE):
+            started.set()
+            blocker_release.wait()
+
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        pool.submit(block)
+        started.wait()
+        background = gateway.llm(backend, 'stub', Priority.BACKGROUND)
+        interactive = gateway.llm(backend, 'stub', Priority.INTERACTIVE)
+        futures = [pool.submit(background.invoke, f'background {i}') for i in range(3)]
+        assert gateway.lane('stub').wait_queued(3, timeout=5), 'Background requests were not queued'
+        futures += [pool.submit(interactive.invoke, f'interactive {i}') for i in range(3)]
+        assert gateway.lane('stub').wait_queued(6, timeout=5), 'Interactive requests were not queued'
+        blocker_release.set()
+        for future in futures: future.result()
+    assert all(call.startswith('interactive') for call in backend.calls[:3]), f'Interactive requests did not go first: {backend.calls}'
+
+
+def test_lanes_are_isolated():
+    class _StubStreamLLM(_StubLLM):
+        def stream(self, prompt):
+            started.release()
+            streaming.wait()
+            yield f'answer to {prompt}'
+
+    backend, gateway, started, streaming = _StubStreamLLM(delay=0), LLMGateway(default_limit=2), Semaphore(0), Event()
+    chat, conditional = gateway.llm(backend, 'chat', Priority.INTERACTIVE), gateway.llm(backend, 'conditional', Priority.INTERACTIVE)
+    embedder = gateway.embeddings(_StubEmbeddings(), 'embeddings', window=0)
+    streams = [chat.stream(f'stream {i}') for i in range(2)]
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        futures = [pool.submit(next, stream) for stream in streams]
+        assert all(started.acquire(timeout=5) for _ in streams) and gateway.metrics()['chat/stream']['in_flight'] == 2, 'Streams did not start'
+        assert conditional.invoke('check') == 'answer to check' and embedder.embed_query('abc') == [3.], 'Streams starved other lanes'
+        assert chat.invoke('question') == 'answer to question', 'Streams starved chat requests'
+        streaming.set()
+        assert [future.result() for future in futures] == ['answer to stream 0', 'answer to stream 1'], 'Wrong streamed answers'
+
+
+def test_single_flight():
+    backend = _StubLLM(delay=.1)
+    gateway = LLMGateway(default_limit=4)
+    llm = gateway.llm(backend, 'stub')
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        answers = list(pool.map(llm.invoke, ['same prompt'] * 8))
+    assert len(backend.calls) == 1 and set(answers) == {'answer to same prompt'}, 'Identical in-flight requests were not coalesced'
+    assert gateway.metrics()['stub']['coalesced'] == 7, 'Coalesced requests were not counted'
+
+
+def test_embedding_micro_batching():
+    backend = _StubEmbeddings()
+    embedder = LLMGateway(default_limit=1).embeddings(backend, 'stub', window=.05, max_batch=64)
+    with ThreadPoolExecutor(max_workers=16) as pool:
+        vectors = list(pool.map(lambda text: embedder.embed_documents([text])[0], ['x' * i for i in range(32)]))
+    assert vectors == [[float(i)] for i in range(32)], 'Wrong embeddings'
+    assert len(backend.batches) < 32, 'Embedding requests were not batched'
+    assert embedder.embed_query('abc') == [3.], 'Wrong query embedding'
\ No newline at end of file
@@ -0,0 +1,224 @@
+from time import time_ns
+import os, pytest, pandas as pd, numpy as np
+from sklearn.metrics.pairwise import cosine_similarity
+from sklearn.preprocessing import LabelEncoder
+from src.lib.utils.artifacts import save_feature_store, load_feature_store, list_versions, create_staging
+from src.server.models.recommender import RecommenderService, precompute_recommendations
+from src.server.models.similarity import SimilarityEngine, normalize_rows
+from src.server.models.profiles import aggregate_rows, signal_weights, rank_popular
+from src.server.models.compression import fit_reducer, compress, recall_at_k
+from src.server.models.neighbors import NeighborIndex, SimilarProductsService
+from src.lib.utils.events import ChangeEvent
+from src.lib.data.db import InteractionData
+
+def _publish(path, rows, recommendations=None, preprocessing=None):
+    df = pd.DataFrame([row[1:] for row in rows], columns=['product_id', 'rating', 0, 1])
+    unit_vectors = normalize_rows(df.to_numpy())
+    usernames, user_vectors = aggregate_rows(unit_vectors, [row[0] for row in rows])
+    product_ids, item_vectors = aggregate_rows(unit_vectors, df['product_id'])
+    return save_feature_store(path, df.columns, usernames, user_vectors, product_ids, item_vectors, recommendations, 5 if recommendations else 0, preprocessing)
+
+
+def _publish_random(path, n_rows, n_products, recommendations=None):
+    vectors, product_ids = _random_data(n_rows, n_products)
+    usernames = [f'user{i}' for i in np.random.default_rng(1).integers(0, 50, n_rows)]
+    users, user_vectors = aggregate_rows(normalize_rows(vectors), usernames)
+    products, item_vectors = aggregate_rows(normalize_rows(vectors), product_ids)
+    save_feature_store(path, range(8), users, user_vectors, products, item_vectors, recommendations, 5 if recommendations else 0)
+    return SimilarityEngine(item_vectors, products), users, user_vectors
+
+
+def _random_data(n_rows, n_products, seed=0):
+    rng = np.random.default_rng(seed)
+    return rng.normal(size=(n_rows, 8)).astype(np.float32), rng.integers(1, n_products + 1, n_rows)
+
+
+def test_feature_store(tmp_path):
+    path = str(tmp_path / 'artifacts')
+    versions = [_publish(path, [['alice', i, 5, 1., 0.]], preprocessing={'encoders': {'username': LabelEncoder().fit(['alice'])}}) for i in range(4)]
+    store = load_feature_store(path)
+    assert store.version == versions[-1] and store.usernames == ['alice'] and store.product_ids.tolist() == [3] and store.item_vectors.dtype == 'float32', 'Wrong feature store'
+    assert store.preprocessing['encoders']['username'].transform(['alice']).tolist() == [0], 'Encoders were not published'
+    assert list_versions(path) == versions[1:] and not list(tmp_path.glob('artifacts/*.tmp')), 'Old versions were not cleaned up'
+    assert load_feature_store(path, versions[1]).product_ids.tolist() == [1], 'Pinned version was not loaded'
+
+    vectors = np.ones((1, 2), dtype=np.float32)
+    np.save(os.path.join(create_staging(path)[1], 'interactions.npy'), vectors)  # Crashed before publishing
+    latest = [save_feature_store(path, range(2), ['alice'], vectors, [1], vectors, keep=2, pinned=[versions[1]]) for _ in range(3)]
+    assert list_versions(path) == [versions[1], *latest[1:]], 'Pinned version was cleaned up'
+    assert not list(tmp_path.glob('artifacts/*.tmp')), 'Stale staging directory was not cleaned up'
+
+    save_feature_store(path, range(2), ['alice', 'bob'], np.ones((2, 2)), [1, 2], np.ones((2, 2)), interaction_weights=([1, 0, 1], [0, 1, 0], [1., 2., 3.]))
+    store = load_feature_store(path)
+    assert isinstance(store.interaction_keys, np.memmap) and store.interaction_keys.tolist() == [1, 2] and store.interaction_weights.tolist() == [2., 4.], 'Wrong interaction weights'
+    assert 'interaction_weights' not in (tmp_path / 'artifacts' / store.version / 'manifest.json').read_text(), 'Interaction weights were put in the manifest'
+
+
+def test_hot_reload(tmp_path):
+    path = str(tmp_path / 'artifacts')
+    service = RecommenderService(path)
+    assert service.recommend('alice') is None, 'Recommended without data'
+
+    version = _publish(path, [['alice', 1, 5, 1., 0.], ['bob', 2, 5, 1., .1], ['bob', 3, 1, -1., 1.], ['carol', 3, 1, -1., 1.]])
+    assert service.recommend('alice', top_k=2) == [1, 2] and service.recommend('bob'), 'Wrong recommendations'
+    assert service.recommend('dave') == [], 'Unknown user got recommendations'
+    first = service._snapshot
+
+    _publish(path, [['alice', 1, 5, 1., 0.], ['bob', 4, 5, 1., 0.], ['carol', 2, 1, -1., 1.]])
+    assert service.recommend('alice', top_k=2) == [1, 4] and service._snapshot is not first, 'New data was not hot-swapped'
+    assert RecommenderService(path, version).recommend('alice', top_k=2) == [1, 2], 'Pinned version was not served'
+
+
+def test_user_profiles():
+    vectors, _ = _random_data(6, 1)
+    weights = signal_weights([1, 0, 0, 1, 0, 0], [True, False, False, False, False, True], [2, -1, -9, 0, 0, 0])
+    assert weights.tolist() == [4, .5, pytest.approx(.1), 2, 1, 2], 'Wrong signal weights'
+    usernames, profiles = aggregate_rows(vectors, ['bob', 'alice', 'bob', 'alice', 'bob', 'alice'], weights)
+    expected = normalize_rows(np.stack([weights[1::2] @ vectors[1::2], weights[::2] @ vectors[::2]]))
+    assert usernames.tolist() == ['alice', 'bob'] and np.allclose(profiles, expected, atol=1e-6), 'Wrong user profiles'
+
+
+def test_similarity_engine():
+    vectors, product_ids = _random_data(500, 40)
+    engine = SimilarityEngine(normalize_rows(vectors), product_ids, block_size=1000)  # 2 queries per block
+    for row, top in zip(range(10), engine.top_products_for_rows(np.arange(10), top_k=5)):
+        similarities = cosine_similarity(vectors[row:row+1], vectors)[0]
+        expected = list(dict.fromkeys(product_ids[np.argsort(similarities)[::-1][1:]]))[:5]
+        assert top == expected, 'Wrong top products'
+    assert engine.top_products(vectors[:3] * 7, top_k=1) == [[p] for p in product_ids[:3]], 'Unnormalized queries were not matched'
+
+
+def test_precomputed_recommendations(tmp_path):
+    path = str(tmp_path / 'artifacts')
+    engine, usernames, user_vectors = _publish_random(path, 300, 40)
+    recommendations = precompute_recommendations(engine, usernames, user_vectors, top_k=5)
+    on_demand = RecommenderService(path)
+    assert recommendations == {username: on_demand.recommend(username, 5) for username in usernames}, 'Precomputed & on-demand recommendations differ'
+
+    _publish_random(path, 300, 40, {'user0': [42]})
+    assert on_demand.recommend('user0') == [42] and on_demand.recommend('user1') == recommendations['user1'], 'Lookup table was not used'
+
+
+def test_recommend_batch(tmp_path):
+    path = str(tmp_path / 'artifacts')
+    _publish_random(path, 300, 40, {'user0': [42]})
+    service = RecommenderService(path)
+    batch = service.recommend_batch(['user0', 'user1', 'nobody', 'user2'])
+    assert batch == {username: service.recommend(username) for username in ['user0', 'user1', 'nobody', 'user2']}, 'Batch & single recommendations differ'
+
+
+def test_cold_start(tmp_path):
+    product_ids, weights = [1, 2, 2, 3, 3, 3, 4], signal_weights([1, 0, 0, 0, 0, 0, 1], [False] * 7, [0] * 7)
+    popular, trending = rank_popular(product_ids, weights, {1: 'Books', 2: 'Toys', 3: 'Tech', 4: 'Toys'}, top_n=3)
+    assert popular == [3, 1, 2] and trending == {'Tech': [3], 'Books': [1], 'Toys': [2, 4]}, 'Wrong popular products'
+
+    path = str(tmp_path / 'artifacts')
+    vectors, _ = _random_data(4, 1)
+    save_feature_store(path, range(8), ['alice'], vectors[:1], [1, 2, 3, 4], vectors, popular=popular, trending=trending)
+    service = RecommenderService(path)
+    assert service.is_cold_start('dave') and not service.is_cold_start('alice'), 'Wrong cold-start users'
+    assert service.recommend('dave', top_k=2) == [3, 1], 'Popular products were not recommended'
+    assert service.recommend('dave', top_k=3, categories=['Toys', 'Nope']) == [2, 3, 4], 'Trending products were not blended'
+    assert service.recommend_batch(['dave'], top_k=3, categories={'dave': ['Toys']}) == {'dave': [2, 3, 4]}, 'Batch & single recommendations differ'
+
+
+def test_compression(tmp_path):
+    rng = np.random.default_rng(0)
+    vectors = normalize_rows(rng.normal(size=(600, 8)) @ rng.normal(size=(8, 64)))  # Low intrinsic dimension
+    users, items, product_ids = vectors[:100], vectors[100:], np.arange(500)
+    expected = SimilarityEngine(items, product_ids).top_products(users, 5)
+    reducer = fit_reducer(vectors, 'pca', 16)
+    compressed_users, compressed_items = compress(users, reducer, 'int8'), compress(items, reducer, 'int8')
+    assert compressed_items.shape == (500, 16) and compressed_items.dtype == np.int8, 'Vectors were not compressed'
+    actual = SimilarityEngine(compressed_items, product_ids).top_products(compressed_users, 5)
+    assert recall_at_k(expected, actual, 5) > .9 and recall_at_k(expected, expected, 5) == 1, 'Compressed vectors lost too much recall'
+    np.save(tmp_path / 'items.npy', compressed_items)
+    mapped = np.load(tmp_path / 'items.npy', mmap_mode='r')
+    engine = SimilarityEngine(mapped, product_ids, block_size=64)  # Upcasts 4 rows at a time
+    assert np.shares_memory(engine.unit_vectors, mapped) and engine.top_products(compressed_users, 5) == actual, 'Memory-mapped quantized vectors were copied'
+
+    path = str(tmp_path / 'artifacts')
+    save_feature_store(path, range(16), [f'user{i}' for i in range(100)], compressed_users, product_ids, compressed_items)
+    assert load_feature_store(path).item_vectors.dtype == np.int8 and RecommenderService(path).recommend('user7') == actual[7], 'Compressed vectors were not served'
+
+
+def test_similar_products(tmp_path):
+    rng = np.random.default_rng(0)
+    vectors, product_ids = rng.normal(size=(40, 8)).astype(np.float32), np.arange(1, 41)
+    brute_force = lambda ids, vecs: {p: SimilarityEngine(normalize_rows(np.delete(vecs, i, 0)), np.delete(ids, i)).top_products(vecs[i], 3)[0] for i, p in enumerate(ids)}
+    index = NeighborIndex(product_ids, vectors, k=3, block_size=64)
+    assert dict(zip(*(t.tolist() for t in index.table()))) == brute_force(product_ids, vectors), 'Wrong neighbors'
+
+    new_vectors = rng.normal(size=(3, 8)).astype(np.float32)
+    index.upsert(41, new_vectors[0])  # Created
+    index.upsert(5, new_vectors[1])  # Updated
+    index.upsert(6, vectors[7])  # Updated to duplicate a product
+    index.remove(8)  # Deleted
+    vectors = np.vstack([vectors, new_vectors[:1]])
+    vectors[4], vectors[5] = new_vectors[1], vectors[7]
+    vectors, product_ids = np.delete(vectors, 7, 0), np.delete(np.append(product_ids, 41), 7)
+    assert dict(zip(*(t.tolist() for t in index.table()))) == brute_force(product_ids, vectors), 'Incremental neighbors differ from a rebuild'
+
+    batch = NeighborIndex(product_ids, vectors, k=3, block_size=64)
+    new_vectors = rng.normal(size=(3, 8)).astype(np.float32)
+    batch.upsert_many([42, 2, 43], new_vectors)  # Created, updated & created at once
+    vectors[1] = new_vectors[1]
+    vectors, product_ids = np.vstack([vectors, new_vectors[[0, 2]]]), np.append(product_ids, [42, 43])
+    assert dict(zip(*(t.tolist() for t in batch.table()))) == brute_force(product_ids, vectors), 'Batched neighbors differ from a rebuild'
+
+    path = str(tmp_path / 'artifacts')
+    service = SimilarProductsService(path)
+    assert service.similar(1) is None, 'Missing table was served'
+    publish = lambda table: save_feature_store(path, range(8), ['alice'], vectors[:1], product_ids, vectors, neighbors=table)
+    pinned = publish(index.table())
+    assert service.similar(6, 2) == index.table()[1][index.table()[0].tolist().index(6), :2].tolist() and service.similar(8) == [], 'Wrong similar products'
+    publish(batch.table())
+    assert service.similar(42) == batch.table()[1][-2].tolist(), 'New table was not hot-reloaded'
+    assert SimilarProductsService(path, pinned).similar(42) == [], 'Pinned version was not served'
+
+
+def test_online_updates(tmp_path, monkeypatch):
+    path, interactions, queries = str(tmp_path / 'artifacts'), {}, []
+    monkeypatch.setattr('src.server.models.recommender.get_interactions_by_keys', lambda keys: queries.append(keys) or [interactions[key] for key in keys if key in interactions])
+    publish = lambda synced_at=None: save_feature_store(
+        path, range(4), ['alice'], np.eye(4)[:1], [1, 2, 3, 4], np.eye(4), recommendations={'alice': [1]}, recommendations_k=1,
+        user_weights=[2.], interaction_weights=([0], [0], [2.]), synced_at=synced_at
+    )
+    change = lambda username, product_id: service.on_change(ChangeEvent('interactions', 'update', {'username': username, 'product_id': product_id}))
+    publish()
+    service = RecommenderService(path)
+    assert service.recommend('alice', top_k=1) == [1], 'Wrong initial recommendations'
+
+    interactions[('alice', 3)] = InteractionData('alice', 3, rating=1, in_cart=True)
+    change('alice', 3)
+    assert service.recommend('alice', top_k=2) == [3, 1] and service.recommend_batch(['alice'], top_k=1) == {'alice': [3]}, 'Signals were not folded in'
+    interactions[('dave', 2)] = InteractionData('dave', 2)
+    change('dave', 2)
+    assert not service.is_cold_start('dave') and service.recommend('dave', top_k=1) == [2], 'Cold-start user was not updated'
+
+    profile = service._snapshot.online.vectors['alice']
+    scored = profile.copy()
+    del interactions[('alice', 3)]
+    change('alice', 3)
+    assert service.recommend('alice', top_k=1) == [1], 'Deleted interaction was not removed'
+    assert np.array_equal(profile, scored), 'Profile was updated in place while requests may score it'
+    interactions[('alice', 3)] = InteractionData('alice', 3, rating=1, in_cart=True)
+    change('alice', 3)
+    publish()
+    assert service.recommend('alice', top_k=1) == [1] and service.is_cold_start('dave'), 'Profiles were not re-based on the new version'
+
+    synced_at = time_ns()
+    del interactions[('alice', 3)]
+    change('alice', 3)
+    change('alice', 1)  # Deleted, as it is missing from `interactions`
+    interactions[('alice', 2)] = InteractionData('alice', 2)
+    change('alice', 2)
+    assert service.recommend('alice', top_k=1) == [2], 'Published interaction was counted twice'
+    publish(synced_at)  # Read before the changes
+    assert service.recommend('alice', top_k=1) == [2], 'Changes missing from the new version were dropped'
+
+    queries.clear()
+    interactions[('erin', 4)] = InteractionData('erin', 4)
+    for username, product_id in [('alice', 4), ('dave', 3), ('erin', 4)]: change(username, product_id)
+    batch = service.recommend_batch(['alice', 'dave', 'erin', 'frank'], top_k=1, categories=lambda cold_start: queries.append(cold_start) or {})
+    assert queries[1:] == [['frank']] and batch['erin'] == [4], 'Batch changes were not folded with a single query'